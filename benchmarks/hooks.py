@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+# -*- coding: ascii -*-
+
+"""
+Measure the overhead of operation hooks.
+
+Runs a sequence of get operations against an in-process server over the
+loopback interface with no hooks registered, with hooks registered and
+removed again (which should be indistinguishable from the former), and with
+no-op hooks registered on the server and the client, and reports the mean
+time per operation of the best of several rounds for each configuration.
+
+The baseline ("unhooked") is a copy of the hkv module with the hook checks
+stripped from the server's and the client's command processing paths (see
+UNHOOK_PATTERNS), run against a server of its own; the other configurations
+are reported relative to it.
+"""
+
+import sys, os
+import re
+import types
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+import hkv
+
+# Regular expressions matching the code removed from the hkv module to obtain
+# the baseline; each must match exactly as often as given.
+UNHOOK_PATTERNS = (
+    # ClientHandler.main(): pre-command hooks.
+    (r'^( *)pre_hooks = self\.parent\.pre_hooks\n\1if pre_hooks:\n'
+     r'(?:\1 .*\n)+', 1),
+    # ClientHandler.main(): post-command hooks.
+    (r'^( *)post_hooks = self\.parent\.post_hooks\n\1if post_hooks:\n'
+     r'(?:\1 .*\n)+', 1),
+    # ClientHandler: bookkeeping of the operation result for hooks.
+    (r'^ *self\.op_result = .*\n', 3),
+    # RemoteDataStore._run_command(): dispatch to hooked commands.
+    (r'^( *)if self\.pre_hooks or self\.post_hooks:\n(?:\1 .*\n)+', 1))
+
+def load_unhooked():
+    """
+    Return a copy of the hkv module with the hook checks removed.
+
+    Raises a RuntimeError if the code to be removed cannot be found (e.g.
+    because it was changed without updating UNHOOK_PATTERNS).
+    """
+    filename = os.path.splitext(hkv.__file__)[0] + '.py'
+    with open(filename) as f:
+        source = f.read()
+    for pattern, expected in UNHOOK_PATTERNS:
+        source, count = re.subn(pattern, '', source, flags=re.M)
+        if count != expected:
+            raise RuntimeError('Pattern %r matched %d times instead of %d' %
+                               (pattern, count, expected))
+    module = types.ModuleType('hkv_unhooked')
+    module.__file__ = filename
+    exec(compile(source, filename, 'exec'), module.__dict__)
+    return module
+
+def noop(event):
+    "A hook that does nothing."
+    pass
+
+def start_server(module=hkv):
+    """
+    Start a server (implemented by module) on an ephemeral loopback port in
+    a background thread and return it.
+    """
+    server = module.DataStoreServer(('127.0.0.1', 0))
+    server.listen()
+    def accept_loop():
+        while 1:
+            server.accept()
+    module.spawn_thread(accept_loop)
+    return server
+
+def connect(server, module=hkv):
+    """
+    Return a client (implemented by module) connected to server, with the
+    key used by measure() populated.
+    """
+    client = module.RemoteDataStore(server.socket.getsockname(), b'bench')
+    client.connect()
+    client.put([b'bench', b'key'], b'value')
+    return client
+
+def measure(client, count):
+    """
+    Perform count get operations using client and return the mean time per
+    operation in seconds.
+    """
+    path = [b'bench', b'key']
+    start = hkv.timer()
+    for _ in range(count):
+        client.get(path)
+    return (hkv.timer() - start) / count
+
+def main():
+    "Main function."
+    p = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    p.add_argument('--count', '-n', type=int, default=20000,
+                   help='Operations per round (default 20000)')
+    p.add_argument('--rounds', '-r', type=int, default=5,
+                   help='Rounds per configuration (default 5)')
+    args = p.parse_args()
+    unhooked = load_unhooked()
+    base_server = start_server(unhooked)
+    base_client = connect(base_server, unhooked)
+    server = start_server()
+    client = connect(server)
+    def no_hooks():
+        pass
+    def removed_hooks():
+        server.add_hook(noop, noop)
+        server.remove_hook(noop, noop)
+        client.add_hook(noop, noop)
+        client.remove_hook(noop, noop)
+    def noop_hooks():
+        server.add_hook(noop, noop)
+        client.add_hook(noop, noop)
+    def cleanup():
+        server.remove_hook(noop, noop)
+        client.remove_hook(noop, noop)
+    configs = (('unhooked', base_client, no_hooks),
+               ('none', client, no_hooks),
+               ('removed', client, removed_hooks),
+               ('noop', client, noop_hooks))
+    results = dict((name, []) for name, _, _ in configs)
+    measure(base_client, args.count // 10)
+    measure(client, args.count // 10)
+    for _ in range(args.rounds):
+        for name, conn, setup in configs:
+            setup()
+            try:
+                results[name].append(measure(conn, args.count))
+            finally:
+                cleanup()
+    client.close()
+    base_client.close()
+    baseline = min(results['unhooked'])
+    for name, _, _ in configs:
+        best = min(results[name])
+        print ('%-8s %8.2f us/op %+7.2f%%' % (name, best * 1e6,
+            (best / baseline - 1) * 100))
+
+if __name__ == '__main__': main()
@@ -0,0 +1,490 @@
+#!/usr/bin/env python3
+# -*- coding: ascii -*-
+
+"""
+Microbenchmarks for hkv internals.
+
+The "run" subcommand times a fixed set of cases (exercising DataStore path
+traversal and filtering, Codec serialization, and ConvertingDataStore
+conversion on synthetic datasets with deep paths, wide nodes, and large
+values) and writes the results as JSON; the "compare" subcommand reports the
+relative change of each case between two such result files and exits with a
+nonzero status if any case became slower than a threshold allows.
+
+Only the standard library is used.
+"""
+
+import sys, os
+import io
+import array
+import json
+import time
+import platform
+import argparse
+import fnmatch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+import hkv
+
+# Version of the JSON result format.
+FORMAT_VERSION = 1
+
+# Mapping from case names to setup functions; see case().
+CASES = {}
+
+DEEP = 64
+WIDE = 10000
+LARGE = 1 << 20
+HUGE_CHUNKS = 16
+
+def case(name):
+    """
+    Decorator registering a benchmark case.
+
+    The decorated function performs any setup and returns a callable taking
+    no arguments, which is what is timed.
+    """
+    def callback(func):
+        CASES[name] = func
+        return func
+    return callback
+
+def deep_path(depth=DEEP):
+    "Return a path of the given length."
+    return [('level%d' % i).encode('ascii') for i in range(depth)]
+
+def wide_mapping(width=WIDE, size=16):
+    "Return a mapping with width keys and values of the given size."
+    return dict((('key%d' % i).encode('ascii'), b'v' * size)
+                for i in range(width))
+
+def deep_store():
+    "Return a DataStore holding a single value at the end of deep_path()."
+    ds = hkv.DataStore()
+    ds.put(deep_path(), b'value')
+    return ds
+
+def wide_store():
+    """
+    Return a DataStore with a node at b'wide' holding WIDE scalars and
+    WIDE // 10 nested nodes.
+    """
+    ds = hkv.DataStore()
+    ds.put_all([b'wide'], wide_mapping())
+    for i in range(WIDE // 10):
+        ds.put([b'wide', ('node%d' % i).encode('ascii'), b'x'], b'y')
+    return ds
+
+def reader(data):
+    "Return a Codec reading from the given bytes."
+    return hkv.Codec(io.BytesIO(data), None)
+
+def encoded(format, *args, **kwds):
+    """
+    Return the serialization of args according to format (using the
+    protocol version given by the protocol keyword argument, if any).
+    """
+    buf = io.BytesIO()
+    hkv.Codec(None, buf, kwds.get('protocol', 1)).writef(format, *args)
+    return buf.getvalue()
+
+@case('datastore.follow_path.deep')
+def bench_follow_path_deep():
+    ds, path = deep_store(), deep_path()[:-1]
+    return lambda: ds._follow_path(path)
+
+@case('datastore.get.deep')
+def bench_get_deep():
+    ds, path = deep_store(), deep_path()
+    return lambda: ds.get(path)
+
+@case('datastore.put.deep')
+def bench_put_deep():
+    ds, path = deep_store(), deep_path()
+    return lambda: ds.put(path, b'other')
+
+@case('datastore.get.wide')
+def bench_get_wide():
+    ds, path = wide_store(), [b'wide', b'key%d' % (WIDE // 2)]
+    return lambda: ds.get(path)
+
+@case('datastore.get_all.wide')
+def bench_get_all_wide():
+    ds = wide_store()
+    return lambda: ds.get_all([b'wide'])
+
+@case('datastore.list.wide.scalar')
+def bench_list_wide_scalar():
+    ds = wide_store()
+    return lambda: ds.list([b'wide'], hkv.LCLASS_SCALAR)
+
+@case('datastore.list.wide.nested')
+def bench_list_wide_nested():
+    ds = wide_store()
+    return lambda: ds.list([b'wide'], hkv.LCLASS_NESTED)
+
+@case('datastore.put_all.wide')
+def bench_put_all_wide():
+    ds, values = hkv.DataStore(), wide_mapping()
+    return lambda: ds.put_all([b'wide'], values)
+
+@case('datastore.get.deep.handle')
+def bench_get_deep_handle():
+    ds, path = deep_store(), deep_path()
+    path = ds.handle(path[:-1]).join(path[-1:])
+    return lambda: ds.get(path)
+
+@case('datastore.stat.deep')
+def bench_stat_deep():
+    ds, path = deep_store(), deep_path()[:-1]
+    return lambda: ds.stat(path)
+
+@case('datastore.query.wide')
+def bench_query_wide():
+    ds, pattern = wide_store(), [b'wide', hkv.QUERY_ONE, b'x']
+    return lambda: ds.query(pattern)
+
+@case('datastore.query.deep.any')
+def bench_query_deep_any():
+    ds, pattern = deep_store(), [hkv.QUERY_ANY, b'level%d' % (DEEP - 1)]
+    return lambda: ds.query(pattern)
+
+@case('datastore.copy.wide')
+def bench_copy_wide():
+    ds = wide_store()
+    return lambda: ds.copy([b'wide'], [b'copy'])
+
+@case('datastore.move.deep')
+def bench_move_deep():
+    ds, path = deep_store(), deep_path()
+    src, dst = path[:-1] + [b'a'], path[:-1] + [b'b']
+    ds.put(src, b'value')
+    def run():
+        ds.move(src, dst)
+        ds.move(dst, src)
+    return run
+
+@case('datastore.put.wide.indexed')
+def bench_put_wide_indexed():
+    ds = wide_store()
+    ds.create_index([b'wide', hkv.QUERY_ONE])
+    path = [b'wide', b'key%d' % (WIDE // 2)]
+    return lambda: ds.put(path, b'other')
+
+@case('datastore.lookup.wide')
+def bench_lookup_wide():
+    ds = wide_store()
+    ds.create_index([b'wide', hkv.QUERY_ONE, b'x'])
+    return lambda: ds.lookup([b'wide', hkv.QUERY_ONE, b'x'], b'y')
+
+@case('datastore.put.large')
+def bench_put_large():
+    ds, value = hkv.DataStore(), b'x' * LARGE
+    return lambda: ds.put([b'large'], value)
+
+@case('datastore.snapshot.wide')
+def bench_snapshot_wide():
+    ds = wide_store()
+    def run():
+        ds.snapshot()
+        ds.put([b'wide', b'key0'], b'v')
+    return run
+
+@case('codec.writef.path')
+def bench_writef_path():
+    path = deep_path()
+    def run():
+        hkv.Codec(None, io.BytesIO()).writef('cas', b'p', path, b'value')
+    return run
+
+@case('codec.readf.path')
+def bench_readf_path():
+    data = encoded('as', deep_path(), b'value')
+    return lambda: reader(data).readf('as')
+
+@case('codec.write_bytedict.wide')
+def bench_write_bytedict_wide():
+    values = wide_mapping()
+    return lambda: hkv.Codec(None, io.BytesIO()).write_bytedict(values)
+
+@case('codec.read_bytedict.wide')
+def bench_read_bytedict_wide():
+    data = encoded('m', wide_mapping())
+    return lambda: reader(data).read_bytedict()
+
+@case('codec.writef.path.v2')
+def bench_writef_path_v2():
+    path = deep_path()
+    def run():
+        hkv.Codec(None, io.BytesIO(), 2).writef('cas', b'p', path, b'value')
+    return run
+
+@case('codec.readf.path.v2')
+def bench_readf_path_v2():
+    data = encoded('as', deep_path(), b'value', protocol=2)
+    return lambda: hkv.Codec(io.BytesIO(data), None, 2).readf('as')
+
+@case('codec.write_bytedict.wide.v2')
+def bench_write_bytedict_wide_v2():
+    values = wide_mapping()
+    return lambda: hkv.Codec(None, io.BytesIO(), 2).write_bytedict(values)
+
+@case('codec.read_bytedict.wide.v2')
+def bench_read_bytedict_wide_v2():
+    data = encoded('m', wide_mapping(), protocol=2)
+    return lambda: hkv.Codec(io.BytesIO(data), None, 2).read_bytedict()
+
+@case('codec.write_bytedict.wide.zlib')
+def bench_write_bytedict_wide_zlib():
+    values = wide_mapping()
+    def run():
+        codec = hkv.Codec(None, io.BytesIO(), 2)
+        codec.set_compression('zlib')
+        codec.write_bytedict(values)
+        codec.flush()
+    return run
+
+@case('codec.read_bytedict.wide.zlib')
+def bench_read_bytedict_wide_zlib():
+    buf = io.BytesIO()
+    codec = hkv.Codec(None, buf, 2)
+    codec.set_compression('zlib')
+    codec.write_bytedict(wide_mapping())
+    codec.flush()
+    data = buf.getvalue()
+    def run():
+        codec = hkv.Codec(io.BytesIO(data), None, 2)
+        codec.set_compression('zlib')
+        codec.read_bytedict()
+    return run
+
+@case('codec.write_bytes.large')
+def bench_write_bytes_large():
+    value = b'x' * LARGE
+    return lambda: hkv.Codec(None, io.BytesIO()).write_bytes(value)
+
+@case('codec.read_bytes.large')
+def bench_read_bytes_large():
+    data = encoded('s', b'x' * LARGE)
+    return lambda: reader(data).read_bytes()
+
+@case('codec.write_chunked.huge')
+def bench_write_chunked_huge():
+    value = hkv.ChunkedValue([b'x' * LARGE] * HUGE_CHUNKS)
+    return lambda: hkv.Codec(None, io.BytesIO()).write_chunked(value)
+
+@case('codec.read_chunked.huge')
+def bench_read_chunked_huge():
+    data = encoded('S', hkv.ChunkedValue([b'x' * LARGE] * HUGE_CHUNKS))
+    return lambda: reader(data).read_chunked()
+
+@case('datastore.stream.huge')
+def bench_stream_huge():
+    ds, data = hkv.DataStore(), b'x' * (LARGE * HUGE_CHUNKS)
+    def run():
+        ds.put_stream([b'huge'], io.BytesIO(data))
+        for _ in hkv.read_chunks(ds.get_stream([b'huge'])): pass
+    return run
+
+@case('transfer.export.wide.jsonl')
+def bench_export_wide_jsonl():
+    ds = wide_store()
+    return lambda: hkv.Exporter(ds).run(io.BytesIO(), 'jsonl')
+
+@case('transfer.export.wide.binary')
+def bench_export_wide_binary():
+    ds = wide_store()
+    return lambda: hkv.Exporter(ds).run(io.BytesIO(), 'binary')
+
+@case('transfer.import.wide.jsonl')
+def bench_import_wide_jsonl():
+    buf = io.BytesIO()
+    hkv.Exporter(wide_store()).run(buf, 'jsonl')
+    data = buf.getvalue()
+    return lambda: hkv.Importer(hkv.DataStore()).run(io.BytesIO(data))
+
+@case('transfer.import.wide.binary')
+def bench_import_wide_binary():
+    buf = io.BytesIO()
+    hkv.Exporter(wide_store()).run(buf, 'binary')
+    data = buf.getvalue()
+    return lambda: hkv.Importer(hkv.DataStore()).run(io.BytesIO(data))
+
+@case('converting.get.deep')
+def bench_converting_get_deep():
+    ds = hkv.TextDataStore(deep_store())
+    path = '/'.join(p.decode('ascii') for p in deep_path())
+    return lambda: ds.get(path)
+
+@case('converting.get.deep.cached')
+def bench_converting_get_deep_cached():
+    ds = hkv.TextDataStore(deep_store(), cache_size=1024)
+    path = '/'.join(p.decode('ascii') for p in deep_path())
+    return lambda: ds.get(path)
+
+@case('converting.get_all.wide')
+def bench_converting_get_all_wide():
+    ds = hkv.TextDataStore(wide_store())
+    return lambda: ds.get_all('wide')
+
+@case('converting.put_all.wide')
+def bench_converting_put_all_wide():
+    ds = hkv.TextDataStore(hkv.DataStore())
+    values = dict((k.decode('ascii'), v.decode('ascii'))
+                  for k, v in wide_mapping().items())
+    return lambda: ds.put_all('wide', values)
+
+@case('converting.list.wide')
+def bench_converting_list_wide():
+    ds = hkv.TextDataStore(wide_store())
+    return lambda: ds.list('wide', hkv.LCLASS_ANY)
+
+@case('converting.array.get_all.wide')
+def bench_converting_array_get_all_wide():
+    ds = hkv.ArrayDataStore(hkv.DataStore())
+    values = array.array('d', range(1000))
+    ds.put_all([b'series'], dict((('s%d' % i).encode('ascii'), values)
+                                 for i in range(WIDE // 10)))
+    return lambda: ds.get_all([b'series'])
+
+@case('converting.array.put.large')
+def bench_converting_array_put_large():
+    ds, values = hkv.ArrayDataStore(hkv.DataStore()), array.array('d')
+    values.frombytes(b'\0' * LARGE)
+    return lambda: ds.put([b'large'], values)
+
+def calibrate(func, min_time):
+    """
+    Return a loop count for which calling func takes at least min_time
+    seconds.
+    """
+    number = 1
+    while 1:
+        start = hkv.timer()
+        for _ in range(number):
+            func()
+        if hkv.timer() - start >= min_time: return number
+        number *= 2
+
+def measure(func, repeat, min_time):
+    """
+    Time func, returning a dictionary of results.
+
+    The loop count is calibrated so that each of the repeat samples takes at
+    least min_time seconds; the results are given per call.
+    """
+    number = calibrate(func, min_time)
+    samples = []
+    for _ in range(repeat):
+        start = hkv.timer()
+        for _ in range(number):
+            func()
+        samples.append((hkv.timer() - start) / number)
+    samples.sort()
+    return {'best': samples[0], 'median': samples[len(samples) // 2],
+            'mean': sum(samples) / len(samples), 'number': number,
+            'repeat': repeat}
+
+def format_time(seconds):
+    "Format a duration in an appropriate unit."
+    for unit, scale in (('s', 1), ('ms', 1e-3), ('us', 1e-6)):
+        if seconds >= scale: return '%.3f %s' % (seconds / scale, unit)
+    return '%.1f ns' % (seconds * 1e9)
+
+def main_run(args):
+    "Implementation of the run subcommand."
+    names = sorted(CASES)
+    if args.filter:
+        names = [n for n in names
+                 if any(fnmatch.fnmatchcase(n, p) for p in args.filter)]
+    if args.list:
+        for name in names: print (name)
+        return 0
+    results = {}
+    for name in names:
+        func = CASES[name]()
+        results[name] = measure(func, args.repeat, args.min_time)
+        if not args.quiet:
+            sys.stderr.write('%-32s %s\n' % (name,
+                format_time(results[name]['best'])))
+    document = {'format': FORMAT_VERSION,
+                'meta': {'hkv_version': hkv.__version__,
+                         'python': platform.python_version(),
+                         'implementation': platform.python_implementation(),
+                         'platform': platform.platform(),
+                         'time': time.time()},
+                'results': results}
+    if args.output == '-':
+        json.dump(document, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(document, f, indent=2, sort_keys=True)
+            f.write('\n')
+    return 0
+
+def main_compare(args):
+    "Implementation of the compare subcommand."
+    with open(args.old) as f:
+        old = json.load(f)['results']
+    with open(args.new) as f:
+        new = json.load(f)['results']
+    slower = 0
+    for name in sorted(set(old) | set(new)):
+        if name not in old or name not in new:
+            print ('%-32s %s' % (name, 'only in ' +
+                                 (args.old if name in old else args.new)))
+            continue
+        before, after = old[name][args.stat], new[name][args.stat]
+        change = (after / before - 1) * 100 if before else 0.0
+        if change > args.threshold:
+            flag, slower = 'SLOWER', slower + 1
+        elif change < -args.threshold:
+            flag = 'faster'
+        else:
+            flag = ''
+        print ('%-32s %12s %12s %+8.1f%% %s' % (name, format_time(before),
+            format_time(after), change, flag))
+    if slower:
+        print ('%d case(s) slower by more than %g%%' % (slower,
+                                                        args.threshold))
+        return 1
+    return 0
+
+def main():
+    "Main function."
+    p = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    sp = p.add_subparsers(dest='command')
+    pr = sp.add_parser('run', help='Run benchmarks')
+    pr.add_argument('--output', '-o', default='-', metavar='FILE',
+                    help='Write JSON results to FILE (default stdout)')
+    pr.add_argument('--repeat', '-r', type=int, default=5,
+                    help='Samples per case (default 5)')
+    pr.add_argument('--min-time', '-t', type=float, default=0.1,
+                    metavar='SECONDS',
+                    help='Minimum duration of a sample (default 0.1)')
+    pr.add_argument('--list', '-l', action='store_true',
+                    help='List the selected cases instead of running them')
+    pr.add_argument('--quiet', '-q', action='store_true',
+                    help='Do not report progress on stderr')
+    pr.add_argument('filter', nargs='*',
+                    help='Glob patterns selecting cases (default all)')
+    pc = sp.add_parser('compare', help='Compare two result files')
+    pc.add_argument('--threshold', '-T', type=float, default=10.0,
+                    metavar='PERCENT',
+                    help='Flag cases slower by more than PERCENT (default 10)')
+    pc.add_argument('--stat', '-s', default='best',
+                    choices=('best', 'median', 'mean'),
+                    help='Statistic to compare (default best)')
+    pc.add_argument('old', help='Baseline result file')
+    pc.add_argument('new', help='Result file to compare against it')
+    args = p.parse_args()
+    if args.command == 'run':
+        return main_run(args)
+    elif args.command == 'compare':
+        return main_compare(args)
+    else:
+        p.error('Must specify a subcommand')
+
+if __name__ == '__main__': sys.exit(main())
@@ -29,8 +29,22 @@ dictionaries).
 __version__ = '1.0'
 
 import os
+import sys
+import io
+import math
+import time
+import copy
+import array
 import struct
 import errno
+import zlib
+import json
+import bisect
+import random
+import hashlib
+import binascii
+import itertools
+import collections
 import threading
 import socket
 import logging
@@ -40,10 +54,21 @@ try:
 except ImportError:
     from urlparse import urlsplit
 
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
 __all__ = ['ERRORS', 'ERROR_CODES', 'LCLASS_SCALAR', 'LCLASS_NESTED',
-           'LCLASS_ANY', 'HKVError', 'parse_url', 'BaseDataStore',
-           'DataStore', 'NullDataStore', 'ConvertingDataStore',
-           'DataStoreServer', 'RemoteDataStore']
+           'LCLASS_ANY', 'QUERY_ONE', 'QUERY_ANY', 'HKVError', 'parse_url',
+           'Handle', 'HandlePath', 'ChunkedValue', 'ChunkedReader',
+           'BaseDataStore',
+           'DataStore', 'SnapshotDataStore', 'NullDataStore',
+           'ConvertingDataStore', 'ArrayDataStore', 'OperationEvent',
+           'Capture',
+           'HotKeyTracker',
+           'DataStoreServer', 'RemoteDataStore', 'ShardedDataStore',
+           'Exporter', 'Importer']
 
 # Mapping from error names to codes and descriptions.
 ERRORS = {
@@ -57,7 +82,18 @@ ERRORS = {
     'BADPATH': (8, 'Path too short'),
     'BADLCLASS': (9, 'Invalid listing class'),
     'BADUNLOCK': (10, 'Unpaired unlock'),
-    'CONNBROKEN': (11, 'Remote connection broken')}
+    'CONNBROKEN': (11, 'Remote connection broken'),
+    'BADCOUNTER': (12, 'Invalid counter value or width'),
+    'BADVERSION': (13, 'Version precondition failed'),
+    'READONLY': (14, 'Datastore is read-only'),
+    'NOREPL': (15, 'Replication not enabled'),
+    'NOHOTKEYS': (16, 'Hot-key tracking not enabled'),
+    'BADHANDLE': (17, 'Invalid or stale handle'),
+    'BADMOVE': (18, 'Cannot move value below itself'),
+    'NOINDEX': (19, 'No such index'),
+    'BADCOMPRESS': (20, 'Unsupported compression method'),
+    'BUSY': (21, 'Datastore in use'),
+    'NODATASTORE': (22, 'No such datastore')}
 
 # Mapping from error codes to names and descriptions.
 ERROR_CODES = {code: (name, desc) for name, (code, desc) in ERRORS.items()}
@@ -68,12 +104,57 @@ LCLASS_SCALAR = 1 # List values contained in this key.
 LCLASS_NESTED = 2 # List nested keys.
 LCLASS_ANY    = 3 # List both contained values and nested keys.
 
+# Wildcard path components understood by the query() method.
+QUERY_ONE = b'*'  # Match any single key.
+QUERY_ANY = b'**' # Match any sequence of keys (including the empty one).
+
 # The default address on which to listen on / connect to.
 # 8311 is delta-encoded from the alphabet indices of H, K, and V.
 DEFAULT_ADDRESS = ('localhost', 8311)
 
-# Helper object for Codec.
+# Helper objects for Codec.
 INTEGER = struct.Struct('!I')
+SIGNED = struct.Struct('!q')
+VARINT_BYTES = tuple(struct.pack('B', i) for i in range(128))
+VARINT_VALUES = dict((b, i) for i, b in enumerate(VARINT_BYTES))
+
+# The highest version of the remote API wire format supported; see
+# Codec.set_protocol() and RemoteDataStore.negotiate().
+PROTOCOL = 2
+
+# Transport compression methods; see Codec.set_compression(). The values are
+# the compression function and a factory of decompressor objects.
+COMPRESSION_METHODS = {'zlib': (zlib.compress, zlib.decompressobj)}
+if lzma is not None:
+    COMPRESSION_METHODS['lzma'] = (lzma.compress, lzma.LZMADecompressor)
+# Default minimum size of frames to compress.
+COMPRESS_THRESHOLD = 1024
+# Maximum size of the (uncompressed) payload of a frame.
+FRAME_BYTES = 1 << 20
+FRAME_HEADER = struct.Struct('!BI')
+
+# Maximum amount of items in a chunk of Codec's "T" format unit.
+CHUNK_ITEMS = 256
+# Maximum size of a chunk of Codec's "S" format unit (and default size of the
+# chunks read by read_chunks()).
+CHUNK_BYTES = 1 << 20
+
+# Signature at the start of binary export files; see Exporter.
+EXPORT_MAGIC = b'HKV-EXPORT\x00\x01'
+
+# The most precise clock available for measuring durations.
+timer = getattr(time, 'perf_counter', time.time)
+# A clock measuring the CPU time of the calling thread (if available).
+cpu_timer = getattr(time, 'thread_time', timer)
+
+# Fixed-width encodings of counters as supported by incr().
+COUNTER_FORMATS = {1: struct.Struct('!b'), 2: struct.Struct('!h'),
+                   4: struct.Struct('!i'), 8: struct.Struct('!q')}
+
+# Bounds of width-zero (decimal) counters; their deltas and values are
+# transferred as signed 64-bit integers by the remote API.
+COUNTER_MIN = -1 << 63
+COUNTER_MAX = (1 << 63) - 1
 
 class HKVError(Exception):
     """
@@ -147,15 +228,284 @@ def parse_url(url):
     if dsname is not None: ret['dsname'] = dsname
     return ret
 
+def decode_counter(data, width=0):
+    """
+    Utility function converting a stored counter value into a Python integer.
+
+    If width is zero, data must be an ASCII-encoded decimal integer (with an
+    optional sign); otherwise, data must be a big-endian two's complement
+    integer exactly width bytes long (where width is a key of the
+    COUNTER_FORMATS mapping). A BADCOUNTER error is raised if data is not
+    valid.
+    """
+    if width == 0:
+        try:
+            return int(data.decode('ascii'))
+        except (UnicodeDecodeError, ValueError):
+            raise HKVError.for_name('BADCOUNTER')
+    try:
+        return COUNTER_FORMATS[width].unpack(data)[0]
+    except (KeyError, struct.error):
+        raise HKVError.for_name('BADCOUNTER')
+
+def encode_counter(value, width=0):
+    """
+    Utility function converting a Python integer into a stored counter value.
+
+    See decode_counter() for the meaning of width. Fixed-width counters wrap
+    around on overflow; a BADCOUNTER error is raised if a decimal counter
+    would leave the range from COUNTER_MIN to COUNTER_MAX.
+    """
+    if width == 0:
+        if not COUNTER_MIN <= value <= COUNTER_MAX:
+            raise HKVError.for_name('BADCOUNTER')
+        return str(value).encode('ascii')
+    try:
+        fmt = COUNTER_FORMATS[width]
+    except KeyError:
+        raise HKVError.for_name('BADCOUNTER')
+    bits = width * 8
+    value &= (1 << bits) - 1
+    if value >> (bits - 1): value -= 1 << bits
+    return fmt.pack(value)
+
 def spawn_thread(func, *args, **kwds):
     """
     Utility function for creating and starting a daemonic thread.
     """
     thr = threading.Thread(target=func, args=args, kwargs=kwds)
-    thr.setDaemon(True)
+    thr.daemon = True
     thr.start()
     return thr
 
+def read_chunks(fileobj, size=CHUNK_BYTES):
+    """
+    Utility function yielding the contents of the given binary file-like
+    object in chunks of at most size bytes until its end is reached.
+    """
+    while 1:
+        chunk = fileobj.read(size)
+        if not chunk: break
+        yield chunk
+
+def disable_nagle(sock):
+    """
+    Utility function for disabling Nagle's algorithm on a TCP socket.
+
+    Without this, pipelined requests and responses stall waiting for delayed
+    acknowledgements. Sockets of other types are left alone.
+    """
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except (socket.error, AttributeError):
+        pass
+
+class Handle(object):
+    """
+    Handle(owner, path, ident=None) -> new instance
+
+    A reference to a nested key-value collection, as returned by
+    BaseDataStore.handle().
+
+    owner is the datastore that issued the handle; path is the path of the
+    collection (as a tuple); ident is an implementation-specific identifier.
+    The epoch, node, and lent attributes are used by DataStore to cache the
+    collection referenced; the trail, generation, and lends attributes
+    cache the nodes leading to it for modifying operations.
+    """
+
+    __slots__ = ('owner', 'path', 'ident', 'epoch', 'node', 'lent', 'trail',
+                 'generation', 'lends')
+
+    def __init__(self, owner, path, ident=None):
+        "Instance initializer; see class docstring for details."
+        self.owner = owner
+        self.path = tuple(path)
+        self.ident = ident
+        self.epoch = None
+        self.node = None
+        self.lent = None
+        self.trail = None
+        self.generation = None
+        self.lends = None
+
+    def __repr__(self):
+        return '<%s %r of %r>' % (self.__class__.__name__, self.path,
+                                  self.owner)
+
+    def join(self, suffix=()):
+        """
+        Return a HandlePath for the given path relative to this handle.
+        """
+        return HandlePath(self, suffix)
+
+class HandlePath(tuple):
+    """
+    HandlePath(handle, suffix=()) -> new instance
+
+    A path relative to a Handle.
+
+    Instances are tuples holding the full path (i.e. the path of handle
+    followed by suffix), so that they can be used wherever paths are
+    accepted; the datastore that issued handle uses it to avoid traversing
+    (or transmitting) the handle's part of the path. The handle and suffix
+    attributes hold the constructor arguments (the latter as a tuple).
+    """
+
+    def __new__(cls, handle, suffix=()):
+        "Instance constructor; see class docstring for details."
+        suffix = tuple(suffix)
+        self = tuple.__new__(cls, handle.path + suffix)
+        self.handle = handle
+        self.suffix = suffix
+        return self
+
+class ChunkedValue(object):
+    """
+    ChunkedValue(chunks) -> new instance
+
+    A scalar value stored as a sequence of byte strings, as created by
+    BaseDataStore.put_stream().
+
+    chunks is an iterable of byte strings, which is stored as a tuple in the
+    chunks attribute; the size attribute holds their total length.
+    Instances are immutable and behave like the concatenation of the chunks
+    with respect to len(), comparison for equality, and hashing (and the
+    latter two take time proportional to the size); adding a byte string to
+    an instance appends it as a further chunk. tobytes() returns the
+    concatenation proper.
+    """
+
+    __slots__ = ('chunks', 'size')
+
+    def __init__(self, chunks):
+        "Instance initializer; see class docstring for details."
+        self.chunks = tuple(chunks)
+        self.size = sum(len(c) for c in self.chunks)
+
+    def __repr__(self):
+        return '<%s of %d bytes in %d chunks>' % (self.__class__.__name__,
+            self.size, len(self.chunks))
+
+    def __len__(self):
+        return self.size
+
+    def __eq__(self, other):
+        if isinstance(other, ChunkedValue):
+            if other.size != self.size: return False
+            other = other.tobytes()
+        elif not isinstance(other, bytes):
+            return NotImplemented
+        return len(other) == self.size and self.tobytes() == other
+
+    def __ne__(self, other):
+        ret = self.__eq__(other)
+        if ret is NotImplemented: return ret
+        return not ret
+
+    def __hash__(self):
+        return hash(self.tobytes())
+
+    def __add__(self, other):
+        if isinstance(other, ChunkedValue):
+            return ChunkedValue(self.chunks + other.chunks)
+        elif not isinstance(other, bytes):
+            return NotImplemented
+        return ChunkedValue(self.chunks + (other,))
+
+    def tobytes(self):
+        """
+        Return the concatenation of the chunks.
+        """
+        return b''.join(self.chunks)
+
+class ChunkedReader(io.RawIOBase):
+    """
+    ChunkedReader(chunks, on_close=None) -> new instance
+
+    A readable binary file-like object returning the concatenation of a
+    sequence of byte strings, as returned by BaseDataStore.get_stream().
+
+    chunks is an iterable of byte strings, which is consumed lazily; on_close
+    (if not None) is called without arguments when the reader is closed,
+    after the chunks not read yet have been consumed. read() returns whole
+    chunks without copying them where possible, and may hence return less
+    data than requested even if the end of the stream has not been reached
+    yet.
+    """
+
+    def __init__(self, chunks, on_close=None):
+        "Instance initializer; see class docstring for details."
+        super(ChunkedReader, self).__init__()
+        self._chunks = iter(chunks)
+        self._on_close = on_close
+        self._current = b''
+        self._offset = 0
+
+    def _advance(self):
+        """
+        Internal helper method.
+
+        Ensure that the current chunk has unread data; return whether that
+        was possible (i.e. the end of the stream has not been reached).
+        """
+        while self._offset >= len(self._current):
+            self._current, self._offset = next(self._chunks, None), 0
+            if self._current is None:
+                self._current = b''
+                return False
+        return True
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        """
+        Read at most size bytes (or all remaining data if size is negative or
+        None).
+        """
+        if self.closed: raise ValueError('I/O operation on closed file')
+        if size is None or size < 0: return self.readall()
+        if not size or not self._advance(): return b''
+        current, offset = self._current, self._offset
+        if offset == 0 and len(current) <= size:
+            self._offset = len(current)
+            return current
+        ret = current[offset:offset + size]
+        self._offset += len(ret)
+        return ret
+
+    def readall(self):
+        """
+        Read all remaining data.
+        """
+        if self.closed: raise ValueError('I/O operation on closed file')
+        parts = []
+        while self._advance():
+            parts.append(self._current[self._offset:])
+            self._offset = len(self._current)
+        return b''.join(parts)
+
+    def readinto(self, buf):
+        """
+        Read data into the given writable buffer and return the amount of
+        bytes read.
+        """
+        data = self.read(len(buf))
+        buf[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        """
+        Consume any remaining chunks and close this reader.
+        """
+        if self.closed: return
+        try:
+            for _ in self._chunks: pass
+        finally:
+            super(ChunkedReader, self).close()
+            if self._on_close is not None: self._on_close()
+
 class BaseDataStore(object):
     """
     An abstract class defining the operations DataStore et al. support.
@@ -177,6 +527,19 @@ class BaseDataStore(object):
     These errors are not explicitly noted below. Some implementations may
     raise less errors than noted here.
 
+    Every value (whether scalar or nested) has a version, which is a positive
+    integer that increases whenever the value or (for nested values) any of
+    its descendants is modified; nonexistent values have the version zero,
+    and the version of the empty path (i.e. the whole datastore) increases
+    with every modification. The reading operations (get(), get_all(),
+    list()) accept a with_version keyword argument; if it is true, they
+    return a (result, version) tuple, where version is the version of path
+    at the time result was read. The modifying operations accept an
+    if_version keyword argument; if it is not None, the operation is only
+    performed if the version of path equals if_version; otherwise, a
+    BADVERSION error is raised. Together, these allow optimistic concurrency
+    control without locking the datastore.
+
     Datastore objects support the context management protocol; when used in a
     with statement, the datastore is locked before entering the code block and
     unlocked after exiting the code block.
@@ -234,7 +597,7 @@ class BaseDataStore(object):
         """
         raise NotImplementedError
 
-    def get(self, path):
+    def get(self, path, with_version=False):
         """
         Retrieve the scalar value at the given path.
 
@@ -243,7 +606,7 @@ class BaseDataStore(object):
         """
         raise NotImplementedError
 
-    def get_all(self, path):
+    def get_all(self, path, with_version=False):
         """
         Retrieve all keys nested immediately under path and their values.
 
@@ -252,7 +615,7 @@ class BaseDataStore(object):
         """
         raise NotImplementedError
 
-    def list(self, path, lclass):
+    def list(self, path, lclass, with_version=False):
         """
         Enumerate all keys nested below path, filtering by the given listing
         class.
@@ -267,7 +630,7 @@ class BaseDataStore(object):
         """
         raise NotImplementedError
 
-    def put(self, path, value):
+    def put(self, path, value, if_version=None):
         """
         Store the given value at the given path.
 
@@ -279,7 +642,7 @@ class BaseDataStore(object):
         """
         raise NotImplementedError
 
-    def put_all(self, path, values):
+    def put_all(self, path, values, if_version=None):
         """
         Store all key-value pairs from values below path.
 
@@ -290,7 +653,7 @@ class BaseDataStore(object):
         """
         raise NotImplementedError
 
-    def replace(self, path, values):
+    def replace(self, path, values, if_version=None):
         """
         Store the given key-value pairs as descendants of path.
 
@@ -299,7 +662,7 @@ class BaseDataStore(object):
         """
         raise NotImplementedError
 
-    def delete(self, path):
+    def delete(self, path, if_version=None):
         """
         Delete the value residing at path, regardless of its type.
 
@@ -307,7 +670,7 @@ class BaseDataStore(object):
         """
         raise NotImplementedError
 
-    def delete_all(self, path):
+    def delete_all(self, path, if_version=None):
         """
         Delete all descendants of the value residing at path.
 
@@ -316,58 +679,613 @@ class BaseDataStore(object):
         """
         raise NotImplementedError
 
+    def incr(self, path, delta=1, width=0, if_version=None):
+        """
+        Atomically add delta to the integer counter at path and return the
+        new value.
+
+        The counter is stored as a scalar value; width selects its encoding
+        as described for decode_counter(). If path does not exist, it is
+        created (recursively) and the counter is taken to be zero initially.
+        If path refers to a nested key-value collection, a BADTYPE error is
+        raised; if the value stored at path is not a valid counter, or if a
+        decimal counter would leave the range from COUNTER_MIN to
+        COUNTER_MAX, a BADCOUNTER error is raised (and nothing is stored).
+        As deltas are transferred as signed 64-bit integers, remote
+        datastores reject deltas outside that range likewise.
+        """
+        raise NotImplementedError
+
+    def append(self, path, value, if_version=None):
+        """
+        Atomically append value to the scalar value at path.
+
+        If path does not exist, this is equivalent to put(). If path refers to
+        a nested key-value collection, a BADTYPE error is raised.
+        """
+        raise NotImplementedError
+
+    def cas(self, path, expected, value, if_version=None):
+        """
+        Atomically replace the scalar value at path with value if it is equal
+        to expected.
+
+        Returns whether the value was replaced. If path does not refer to a
+        scalar value, a BADTYPE error is raised.
+        """
+        raise NotImplementedError
+
+    def put_if_absent(self, path, value, if_version=None):
+        """
+        Atomically store value at path unless path exists already.
+
+        Returns whether the value was stored. Like put(), this creates path
+        recursively.
+        """
+        raise NotImplementedError
+
+    def put_stream(self, path, source, if_version=None):
+        """
+        Store the contents of a stream as a scalar value at path.
+
+        source is a binary file-like object (which is read until its end) or
+        a ChunkedValue. Otherwise, this is equivalent to put(); differently
+        from it, the value need not be held in memory as a single byte string
+        (neither by the caller nor, depending on the implementation, by the
+        datastore), so that it may be larger than what put() could handle.
+        """
+        raise NotImplementedError
+
+    def get_stream(self, path, with_version=False):
+        """
+        Retrieve the scalar value at path as a readable binary file-like
+        object.
+
+        If path refers to a nested key-value collection, a BADTYPE error is
+        raised. The reader should be closed when it is not needed anymore;
+        see the implementations for further constraints.
+        """
+        raise NotImplementedError
+
+    def copy(self, src, dst, if_version=None):
+        """
+        Atomically store a copy of the value at src at dst.
+
+        The value may be a nested subtree, which is copied as a whole. Like
+        put(), this creates dst recursively and replaces whatever has been
+        there previously. if_version applies to src.
+        """
+        raise NotImplementedError
+
+    def move(self, src, dst, if_version=None):
+        """
+        Atomically move the value at src to dst.
+
+        This is equivalent to copy() followed by deleting src. If dst is
+        equal to src or nested below it, a BADMOVE error is raised.
+        """
+        raise NotImplementedError
+
+    def version(self, path):
+        """
+        Retrieve the version of the value at path.
+
+        path may be empty. If path does not exist, zero is returned.
+        """
+        raise NotImplementedError
+
+    def handle(self, path):
+        """
+        Obtain a Handle for the nested key-value collection at path.
+
+        path may be empty. HandlePath-s created from the handle can be passed
+        to all operations of this datastore in place of paths; in particular
+        for long paths, this may be more efficient than passing the full path
+        every time. Once the collection is deleted or replaced (but not if
+        it is merely modified), operations using the handle raise a
+        BADHANDLE error. If path refers to a scalar, a BADTYPE error is
+        raised.
+        """
+        raise NotImplementedError
+
+    def release_handle(self, handle):
+        """
+        Dispose of a Handle obtained from handle().
+
+        The handle must not be used afterwards.
+        """
+        raise NotImplementedError
+
+    def stat(self, path, with_version=False):
+        """
+        Retrieve aggregate sizes of the value at path.
+
+        The result is a (keys, nodes, bytes) tuple: for a nested key-value
+        collection, keys and nodes are the amounts of scalar and nested
+        values among all of its descendants, and bytes is the total length
+        of their keys and of the scalar values; for a scalar value, the
+        result is (0, 0, length of value). path may be empty.
+        """
+        raise NotImplementedError
+
+    def query(self, pattern, limit=0, values_only=False, with_version=False):
+        """
+        Retrieve all scalar values whose paths match pattern.
+
+        pattern is a path whose components may be the wildcards QUERY_ONE
+        (which matches any single key) and QUERY_ANY (which matches any
+        sequence of keys, including an empty one); all other components only
+        match themselves. The result is a list of (path, value) pairs (where
+        path is a tuple) or, if values_only is true, a list of the values
+        only, in no particular order; if limit is positive, at most that
+        many matches are returned. Nested collections are never matched, and
+        nonexistent paths simply do not match, so that an empty list may be
+        a valid result. If with_version is true, the version returned is that
+        of the empty path.
+        """
+        raise NotImplementedError
+
+    def create_index(self, pattern, if_version=None):
+        """
+        Create a secondary index of the scalar values matching pattern.
+
+        pattern is as for query() and identifies the index afterwards. The
+        index maps values to the paths holding them and is kept up to date
+        by all modifying operations; see lookup(). Creating an index that
+        exists already does nothing.
+        """
+        raise NotImplementedError
+
+    def drop_index(self, pattern, if_version=None):
+        """
+        Remove the secondary index identified by pattern.
+
+        If there is no such index, a NOINDEX error is raised.
+        """
+        raise NotImplementedError
+
+    def lookup(self, pattern, value, with_version=False):
+        """
+        Retrieve the paths holding value among those covered by the index
+        identified by pattern.
+
+        The result is a list of paths (as tuples) in no particular order. If
+        there is no such index, a NOINDEX error is raised. If with_version
+        is true, the version returned is that of the empty path.
+        """
+        raise NotImplementedError
+
+    def snapshot(self):
+        """
+        Create a read-only view of the current contents of this datastore.
+
+        Later modifications of this datastore do not affect the snapshot;
+        modifying operations on the snapshot raise a READONLY error.
+        """
+        raise NotImplementedError
+
 class DataStore(BaseDataStore):
     """
     DataStore() -> new instance
 
     This is an in-memory implementation of the datastore interface.
+
+    Nested key-value collections are represented by instances of the Node
+    class (which is a dict subclass); the root of the hierarchy is stored in
+    the data attribute. Scalar values stored by put_stream() are represented
+    by ChunkedValue instances.
     """
 
+    class Node(dict):
+        """
+        Node(...) -> new instance
+
+        A nested key-value collection of a DataStore.
+
+        Constructor arguments are as for dict. In addition to the key-value
+        pairs, each instance stores the versions of its values in the stamps
+        attribute (a mapping from keys to versions), and the generation of
+        the datastore it was created in in the generation attribute. Nodes
+        from older generations may be shared with snapshots and must not be
+        modified; see DataStore.snapshot() for details. Similarly, nodes may
+        be shared between multiple parents after DataStore.copy(): those
+        children of a node whose born attribute is less than its lent
+        attribute may be shared, and must be copied (see
+        DataStore._unshare()) before being modified.
+
+        The nkeys, nnodes, and nbytes attributes hold the aggregates reported
+        by DataStore.stat(); DataStore maintains them incrementally, but they
+        are not updated by modifying the node directly. The ident attribute
+        identifies the node (and all copies of it) for the purposes of
+        handles.
+        """
+
+        __slots__ = ('stamps', 'generation', 'born', 'lent', 'nkeys',
+                     'nnodes', 'nbytes', 'ident')
+
+        def __init__(self, *args, **kwds):
+            "Instance initializer; see class docstring for details."
+            super(DataStore.Node, self).__init__(*args, **kwds)
+            self.stamps = {}
+            self.generation = 0
+            self.born = 0
+            self.lent = 0
+            self.ident = 0
+            self.nkeys = 0
+            self.nnodes = 0
+            self.nbytes = 0
+
+        def clone(self, generation):
+            """
+            Create a shallow copy of this node belonging to the given
+            generation.
+            """
+            ret = DataStore.Node(self)
+            ret.stamps = dict(self.stamps)
+            ret.generation = generation
+            ret.born = self.born
+            ret.lent = self.lent
+            ret.nkeys = self.nkeys
+            ret.nnodes = self.nnodes
+            ret.nbytes = self.nbytes
+            ret.ident = self.ident
+            return ret
+
+        def recount(self):
+            """
+            Recompute the aggregates of this node and all its descendants
+            from scratch.
+            """
+            stack = [(self, False)]
+            while stack:
+                node, done = stack.pop()
+                if not done:
+                    stack.append((node, True))
+                    stack.extend((v, False) for v in node.values()
+                                 if isinstance(v, dict))
+                    continue
+                keys, nodes, size = 0, 0, 0
+                for k, v in node.items():
+                    if isinstance(v, dict):
+                        keys += v.nkeys
+                        nodes += v.nnodes + 1
+                        size += v.nbytes + len(k)
+                    else:
+                        keys += 1
+                        size += len(k) + len(v)
+                node.nkeys, node.nnodes, node.nbytes = keys, nodes, size
+
+    class Index(object):
+        """
+        Index(pattern) -> new instance
+
+        A secondary index of a DataStore; see DataStore.create_index().
+
+        pattern is the pattern (as a tuple) of the paths covered. The
+        entries attribute maps scalar values to sets of paths (as tuples)
+        holding them; npaths is the amount of paths stored, and nbytes is
+        the total length of the values and path components stored.
+        """
+
+        __slots__ = ('pattern', 'entries', 'npaths', 'nbytes')
+
+        def __init__(self, pattern):
+            "Instance initializer; see class docstring for details."
+            self.pattern = pattern
+            self.entries = {}
+            self.npaths = 0
+            self.nbytes = 0
+
+        def add(self, path, value):
+            """
+            Record that path holds value.
+            """
+            paths = self.entries.get(value)
+            if paths is None:
+                paths = self.entries[value] = set()
+                self.nbytes += len(value)
+            paths.add(path)
+            self.npaths += 1
+            self.nbytes += sum(len(k) for k in path)
+
+        def remove(self, path, value):
+            """
+            Record that path does not hold value anymore.
+            """
+            paths = self.entries[value]
+            paths.remove(path)
+            self.npaths -= 1
+            self.nbytes -= sum(len(k) for k in path)
+            if not paths:
+                del self.entries[value]
+                self.nbytes -= len(value)
+
     # Operation names are mostly inspired by HTTP methods, aside from list,
     # which has no equivalent, and put_all and replace, which correspond to
     # PATCH and PUT (on a nested subtree), respectively.
+    # The entries are formats of the arguments, method names, formats of the
+    # results, and whether the operations only read ('r') or also write
+    # ('w') data.
     _OPERATIONS = {
-        b'g': ('a', 'get', 's'),
-        b'G': ('a', 'get_all', 'm'),
-        b'l': ('ai', 'list', 'a'),
-        b'p': ('as', 'put', '-'),
-        b'P': ('am', 'put_all', '-'),
-        b'r': ('am', 'replace', '-'),
-        b'd': ('a', 'delete', '-'),
-        b'D': ('a', 'delete_all', '-')}
+        b'g': ('a', 'get', 's', 'r'),
+        b'G': ('a', 'get_all', 'm', 'r'),
+        b'l': ('ai', 'list', 'a', 'r'),
+        b'p': ('as', 'put', '-', 'w'),
+        b'P': ('am', 'put_all', '-', 'w'),
+        b'r': ('am', 'replace', '-', 'w'),
+        b'd': ('a', 'delete', '-', 'w'),
+        b'D': ('a', 'delete_all', '-', 'w'),
+        b'i': ('aqi', 'incr', 'q', 'w'),
+        b'a': ('as', 'append', '-', 'w'),
+        b'c': ('ass', 'cas', 'i', 'w'),
+        b'n': ('as', 'put_if_absent', 'i', 'w'),
+        b'v': ('a', 'version', 'q', 'r'),
+        b't': ('a', 'stat', 'Q', 'r'),
+        b'Q': ('aii', 'query', 'T', 'r'),
+        b'C': ('aa', 'copy', '-', 'w'),
+        b'M': ('aa', 'move', '-', 'w'),
+        b'X': ('a', 'create_index', '-', 'w'),
+        b'Z': ('a', 'drop_index', '-', 'w'),
+        b'k': ('as', 'lookup', 'A', 'r'),
+        b'W': ('aS', 'put_stream', '-', 'w'),
+        b'B': ('a', 'get_stream', 'S', 'r')}
 
     def __init__(self):
         "Initializer; see class docstring for details."
-        self.data = {}
+        self.data = self.Node()
+        self._clock = 0
+        self._generation = 0
+        self._epoch = 0
+        self._lends = 0
+        self._idents = itertools.count(1)
+        self._indexes = {}
+        self._chunked = False
         self._lock = threading.RLock()
-        self._operations = {k: (i, getattr(self, m), o)
-                            for k, (i, m, o) in self._OPERATIONS.items()}
+        self._operations = {k: (i, getattr(self, m), o, t)
+                            for k, (i, m, o, t) in self._OPERATIONS.items()}
 
-    def _follow_path(self, path, create=False):
-        "Internal helper method."
+    def _new_node(self, values=()):
+        """
+        Internal helper method.
+
+        values must only contain scalars.
+        """
+        ret = self.Node(values)
+        ret.generation = self._generation
+        ret.born = self._lends
+        ret.ident = next(self._idents)
+        if values:
+            ret.nkeys = len(ret)
+            ret.nbytes = sum(len(k) + len(v) for k, v in ret.items())
+        return ret
+
+    def _follow_path(self, path, create=False, trail=None):
+        """
+        Internal helper method.
+
+        If trail is not None, the path is about to be modified: every node
+        traversed is replaced by a copy if it belongs to an older generation
+        or may be shared (see Node), and a (node, key) pair is appended to
+        trail for every path component traversed. create may only be true if
+        trail is not None; nodes created are stamped with a version of their
+        own immediately, so that they are versioned even if the operation
+        fails afterwards.
+
+        If path is a HandlePath of a handle issued by this datastore, the
+        handle is validated, and traversal starts at the node it references;
+        when modifying, trail is extended with the entries leading there as
+        cached by _resolve_trail().
+        """
         cur = self.data
+        if path.__class__ is HandlePath and path.handle.owner is self:
+            if trail is None:
+                cur = self._resolve(path.handle)
+            else:
+                cur = self._resolve_trail(path.handle, trail)
+            path = path.suffix
+        if trail is None:
+            for ent in path:
+                if not isinstance(cur, dict):
+                    raise HKVError.for_name('BADNEST')
+                try:
+                    cur = cur[ent]
+                except KeyError:
+                    raise HKVError.for_name('NOKEY')
+            return cur
+        generation, version = self._generation, None
+        if cur is self.data and cur.generation != generation:
+            cur = self.data = cur.clone(generation)
         for ent in path:
             if not isinstance(cur, dict):
                 raise HKVError.for_name('BADNEST')
+            trail.append((cur, ent))
             try:
-                cur = cur[ent]
+                nxt = cur[ent]
             except KeyError:
-                if create:
-                    new = {}
-                    cur[ent] = new
-                    cur = new
-                else:
-                    raise HKVError.for_name('NOKEY')
+                if not create: raise HKVError.for_name('NOKEY')
+                nxt = cur[ent] = self._new_node()
+                if version is None:
+                    self._clock += 1
+                    version = self._clock
+                for node, key in trail:
+                    node.nnodes += 1
+                    node.nbytes += len(ent)
+                    node.stamps[key] = version
+            else:
+                if not isinstance(nxt, dict):
+                    pass
+                elif nxt.born < cur.lent:
+                    nxt = cur[ent] = self._unshare(nxt)
+                elif nxt.generation != generation:
+                    nxt = cur[ent] = nxt.clone(generation)
+            cur = nxt
         return cur
 
-    def _split_follow_path(self, path, create=False):
+    def _unshare(self, node):
+        """
+        Internal helper method.
+
+        Return a copy of node (which may be shared between multiple parents)
+        for use by a single parent. The children of node become shared
+        between it and the copy.
+        """
+        self._lends += 1
+        ret = node.clone(self._generation)
+        ret.born = ret.lent = node.lent = self._lends
+        return ret
+
+    def _split_follow_path(self, path, create=False, trail=None):
         "Internal helper method."
         if not path: raise HKVError.for_name('BADPATH')
-        prefix, last = path[:-1], path[-1]
-        res = self._follow_path(prefix, create)
+        last = path[-1]
+        if path.__class__ is not HandlePath or path.handle.owner is not self:
+            prefix = path[:-1]
+        elif len(path.suffix) > 1:
+            prefix = HandlePath(path.handle, path.suffix[:-1])
+        elif path.suffix:
+            if trail is None: return self._resolve(path.handle), last
+            return self._resolve_trail(path.handle, trail), last
+        else:
+            self._resolve(path.handle)
+            prefix = path[:-1]
+        res = self._follow_path(prefix, create, trail)
         if not isinstance(res, dict): raise HKVError.for_name('BADNEST')
         return res, last
 
+    def _begin_write(self, path, if_version):
+        """
+        Internal helper method.
+
+        Invoked at the beginning of every modifying operation; checks the
+        version precondition (if any).
+        """
+        if if_version is not None and self.version(path) != if_version:
+            raise HKVError.for_name('BADVERSION')
+
+    def _resolve(self, handle):
+        """
+        Internal helper method.
+
+        Return the node referenced by handle, or raise a BADHANDLE error if
+        it has been deleted or replaced. The node is cached in the handle as
+        long as no nested node has been removed from the datastore (as
+        tracked by the epoch), no snapshot has been taken since, and the
+        node has not been lent (which happens when it is copied, see
+        _unshare()).
+        """
+        node = handle.node
+        if (handle.epoch == self._epoch and
+                node.generation == self._generation and
+                node.lent == handle.lent):
+            return node
+        try:
+            node = self._follow_path(handle.path)
+        except HKVError:
+            raise HKVError.for_name('BADHANDLE')
+        if not isinstance(node, dict) or node.ident != handle.ident:
+            raise HKVError.for_name('BADHANDLE')
+        handle.node, handle.epoch, handle.trail = node, self._epoch, None
+        handle.lent = node.lent
+        return node
+
+    def _resolve_trail(self, handle, trail):
+        """
+        Internal helper method.
+
+        Return the node referenced by handle as _follow_path() would when
+        collecting trail, and extend trail with the entries leading to it.
+        The entries are cached in the handle along with the node as long as
+        no nested node has been removed and nothing has been snapshotted or
+        lent since, so that repeated modifications through the handle do not
+        traverse its path again.
+        """
+        if (handle.trail is not None and handle.epoch == self._epoch and
+                handle.generation == self._generation and
+                handle.lends == self._lends):
+            trail.extend(handle.trail)
+            return handle.node
+        entries = []
+        try:
+            node = self._follow_path(handle.path, False, entries)
+        except HKVError:
+            raise HKVError.for_name('BADHANDLE')
+        if not isinstance(node, dict) or node.ident != handle.ident:
+            raise HKVError.for_name('BADHANDLE')
+        handle.node, handle.epoch, handle.lent = node, self._epoch, node.lent
+        handle.trail, handle.generation = tuple(entries), self._generation
+        handle.lends = self._lends
+        trail.extend(entries)
+        return node
+
+    def _change(self, trail, key, old, new):
+        """
+        Internal helper method.
+
+        Return the change of the aggregates of the node containing key when
+        its value changes from old to new (where None denotes absence) as a
+        (keys, nodes, bytes) tuple; trail leads to that node (as collected
+        by _follow_path()). Must only be called when the change is actually
+        going to happen, as removing a nested node advances the epoch
+        (invalidating cached handles), and the indexes are updated.
+        """
+        if isinstance(old, dict): self._epoch += 1
+        if self._indexes:
+            self._reindex(tuple(k for n, k in trail) + (key,), old, new)
+        keys, nodes, size = 0, 0, 0
+        for value, sign in ((old, -1), (new, 1)):
+            if value is None:
+                continue
+            elif isinstance(value, dict):
+                keys += sign * value.nkeys
+                nodes += sign * (value.nnodes + 1)
+                size += sign * (value.nbytes + len(key))
+            else:
+                keys += sign
+                size += sign * (len(key) + len(value))
+        return (keys, nodes, size)
+
+    def _account(self, trail, record, keys, nodes, size):
+        """
+        Internal helper method.
+
+        Add the given amounts to the aggregates of record and of its
+        ancestors (as collected into trail by _follow_path()). Must be called
+        before trail is extended with entries for record itself.
+        """
+        if not (keys or nodes or size): return
+        for node, _ in trail:
+            node.nkeys += keys
+            node.nnodes += nodes
+            node.nbytes += size
+        record.nkeys += keys
+        record.nnodes += nodes
+        record.nbytes += size
+
+    def _commit(self, trail, record=None, keys=()):
+        """
+        Internal helper method.
+
+        Allocate a new version and stamp it onto every entry of trail (as
+        collected by _follow_path()), as well as onto the given keys of
+        record (in bulk).
+        """
+        self._clock += 1
+        version = self._clock
+        for node, key in trail:
+            node.stamps[key] = version
+        if keys: record.stamps.update(zip(keys, itertools.repeat(version)))
+        return version
+
+    def _versioned(self, path, result, with_version):
+        "Internal helper method."
+        if not with_version: return result
+        return (result, self.version(path))
+
+    def _unchunk(self, value):
+        "Internal helper method."
+        if value.__class__ is ChunkedValue: return value.tobytes()
+        return value
+
     def lock(self):
         "Lock this DataStore; see BaseDataStore for details."
         self._lock.acquire()
@@ -383,83 +1301,752 @@ class DataStore(BaseDataStore):
         "Dispose of this DataStore; see BaseDataStore for details."
         self.data = None
 
-    def get(self, path):
+    def get(self, path, with_version=False):
         "Retrieve a scalar at path; see BaseDataStore for details."
         with self._lock:
             ret = self._follow_path(path)
             if isinstance(ret, dict): raise HKVError.for_name('BADTYPE')
-            return ret
+            if ret.__class__ is ChunkedValue: ret = ret.tobytes()
+            return self._versioned(path, ret, with_version)
 
-    def get_all(self, path):
+    def get_all(self, path, with_version=False):
         "Retrieve key-value pairs below path; see BaseDataStore for details."
         with self._lock:
             record = self._follow_path(path)
             if not isinstance(record, dict):
                 raise HKVError.for_name('BADTYPE')
-            return {k: v for k, v in record.items()
-                    if not isinstance(v, dict)}
+            ret = {k: v for k, v in record.items()
+                   if not isinstance(v, dict)}
+            if self._chunked:
+                ret = {k: self._unchunk(v) for k, v in ret.items()}
+            return self._versioned(path, ret, with_version)
 
-    def list(self, path, lclass):
+    def list(self, path, lclass, with_version=False):
         "List some keys below path; see BaseDataStore for details."
         with self._lock:
             record = self._follow_path(path)
             if not isinstance(record, dict):
                 raise HKVError.for_name('BADTYPE')
             elif lclass == LCLASS_SCALAR:
-                return [k for k, v in record.items()
-                        if not isinstance(v, dict)]
+                ret = [k for k, v in record.items()
+                       if not isinstance(v, dict)]
             elif lclass == LCLASS_NESTED:
-                return [k for k, v in record.items() if isinstance(v, dict)]
+                ret = [k for k, v in record.items() if isinstance(v, dict)]
             elif lclass == LCLASS_ANY:
-                return list(record)
+                ret = list(record)
             else:
                 raise HKVError.for_name('BADLCLASS')
+            return self._versioned(path, ret, with_version)
 
-    def put(self, path, value):
+    def put(self, path, value, if_version=None):
         "Store value at path; see BaseDataStore for details."
         with self._lock:
-            record, key = self._split_follow_path(path, True)
+            self._begin_write(path, if_version)
+            trail = []
+            record, key = self._split_follow_path(path, True, trail)
+            self._account(trail, record,
+                          *self._change(trail, key, record.get(key),
+                                        value))
             record[key] = value
+            trail.append((record, key))
+            self._commit(trail)
 
-    def put_all(self, path, values):
+    def put_all(self, path, values, if_version=None):
         "Merge pairs from values below path; see BaseDataStore for details."
         with self._lock:
-            record = self._follow_path(path, True)
+            self._begin_write(path, if_version)
+            trail = []
+            record = self._follow_path(path, True, trail)
             if not isinstance(record, dict):
                 raise HKVError.for_name('BADTYPE')
-            for k, v in values.items():
-                record[k] = v
+            prefix = tuple(k for n, k in trail)
+            covering = self._indexes and self._covering_indexes(prefix)
+            if not (covering or record.nnodes):
+                # Only scalars are replaced and no index is concerned, so
+                # that the aggregates can be computed in bulk.
+                olds = list(map(record.get, values))
+                keys, nodes = olds.count(None), 0
+                size = (sum(map(len, values.values())) -
+                        sum(map(len, filter(None, olds))))
+                if keys == len(olds):
+                    size += sum(map(len, values))
+                elif keys:
+                    size += sum(len(k) for k, o in zip(values, olds)
+                                if o is None)
+            else:
+                keys, nodes, size = 0, 0, 0
+                for k, v in values.items():
+                    old = record.get(k)
+                    if covering:
+                        self._reindex(prefix + (k,), old, v, covering)
+                    if old is None:
+                        keys += 1
+                        size += len(k) + len(v)
+                    elif isinstance(old, dict):
+                        keys += 1 - old.nkeys
+                        nodes -= old.nnodes + 1
+                        size += len(v) - old.nbytes
+                        self._epoch += 1
+                    else:
+                        size += len(v) - len(old)
+            self._account(trail, record, keys, nodes, size)
+            record.update(values)
+            self._commit(trail, record, values)
 
-    def replace(self, path, values):
+    def replace(self, path, values, if_version=None):
         "Store values at path; see BaseDataStore for details."
-        self.put(path, values)
-
-    def delete(self, path):
+        with self._lock:
+            self._begin_write(path, if_version)
+            trail = []
+            record, key = self._split_follow_path(path, True, trail)
+            new = self._new_node(values)
+            self._account(trail, record,
+                          *self._change(trail, key, record.get(key), new))
+            record[key] = new
+            trail.append((record, key))
+            self._commit(trail, new, values)
+
+    def delete(self, path, if_version=None):
         "Delete the value at path; see BaseDataStore for details."
         with self._lock:
-            record, key = self._split_follow_path(path)
+            self._begin_write(path, if_version)
+            trail = []
+            record, key = self._split_follow_path(path, False, trail)
             try:
-                del record[key]
+                old = record.pop(key)
             except KeyError:
                 raise HKVError.for_name('NOKEY')
+            self._account(trail, record,
+                          *self._change(trail, key, old, None))
+            record.stamps.pop(key, None)
+            self._commit(trail)
 
-    def delete_all(self, path):
+    def delete_all(self, path, if_version=None):
         "Delete everything below path; see BaseDataStore for details."
         with self._lock:
-            record = self._follow_path(path)
+            self._begin_write(path, if_version)
+            trail = []
+            record = self._follow_path(path, False, trail)
             if not isinstance(record, dict):
                 raise HKVError.for_name('BADTYPE')
+            if record.nnodes: self._epoch += 1
+            if self._indexes:
+                self._reindex(tuple(k for n, k in trail), record, None)
+            self._account(trail, record, -record.nkeys, -record.nnodes,
+                          -record.nbytes)
             record.clear()
+            record.stamps.clear()
+            self._commit(trail)
 
-class NullDataStore(BaseDataStore):
-    """
-    NullDataStore() -> new instance
-
-    A datastore implementation that does not retain any data.
+    def incr(self, path, delta=1, width=0, if_version=None):
+        "Increment a counter at path; see BaseDataStore for details."
+        with self._lock:
+            self._begin_write(path, if_version)
+            trail = []
+            record, key = self._split_follow_path(path, True, trail)
+            old = record.get(key)
+            if old is None:
+                value = delta
+            elif isinstance(old, dict):
+                raise HKVError.for_name('BADTYPE')
+            else:
+                value = decode_counter(self._unchunk(old), width) + delta
+            encoded = encode_counter(value, width)
+            self._account(trail, record,
+                          *self._change(trail, key, old, encoded))
+            record[key] = encoded
+            trail.append((record, key))
+            self._commit(trail)
+            if width: value = decode_counter(encoded, width)
+            return value
+
+    def append(self, path, value, if_version=None):
+        "Append value to the scalar at path; see BaseDataStore for details."
+        with self._lock:
+            self._begin_write(path, if_version)
+            trail = []
+            record, key = self._split_follow_path(path, True, trail)
+            old = record.get(key)
+            if old is None:
+                new = value
+            elif isinstance(old, dict):
+                raise HKVError.for_name('BADTYPE')
+            else:
+                new = old + value
+            self._account(trail, record,
+                          *self._change(trail, key, old, new))
+            record[key] = new
+            trail.append((record, key))
+            self._commit(trail)
+
+    def cas(self, path, expected, value, if_version=None):
+        "Compare-and-swap the scalar at path; see BaseDataStore for details."
+        with self._lock:
+            self._begin_write(path, if_version)
+            trail = []
+            record, key = self._split_follow_path(path, False, trail)
+            try:
+                old = record[key]
+            except KeyError:
+                raise HKVError.for_name('NOKEY')
+            if isinstance(old, dict): raise HKVError.for_name('BADTYPE')
+            if old != expected: return False
+            self._account(trail, record,
+                          *self._change(trail, key, old, value))
+            record[key] = value
+            trail.append((record, key))
+            self._commit(trail)
+            return True
 
-    All reading requests (get(), get_all(), list()) raise a NOKEY error, while
-    all other operations do nothing.
-    """
+    def put_if_absent(self, path, value, if_version=None):
+        "Store value at path if it is absent; see BaseDataStore for details."
+        with self._lock:
+            self._begin_write(path, if_version)
+            trail = []
+            record, key = self._split_follow_path(path, True, trail)
+            if key in record: return False
+            self._account(trail, record,
+                          *self._change(trail, key, None, value))
+            record[key] = value
+            trail.append((record, key))
+            self._commit(trail)
+            return True
+
+    def put_stream(self, path, source, if_version=None):
+        """
+        Store the contents of a stream at path; see BaseDataStore for
+        details.
+
+        source is read (in chunks of CHUNK_BYTES bytes) before the lock is
+        acquired; the value is stored as a ChunkedValue without concatenating
+        the chunks. Reading operations other than get_stream() return such
+        values as byte strings, concatenating them on every access; append()
+        adds further chunks to them.
+        """
+        if source.__class__ is not ChunkedValue:
+            source = ChunkedValue(read_chunks(source))
+        with self._lock:
+            self._chunked = True
+            self.put(path, source, if_version)
+
+    def get_stream(self, path, with_version=False):
+        """
+        Retrieve the scalar at path as a file-like object; see BaseDataStore
+        for details.
+
+        The reader returned is a ChunkedReader over the chunks of the value
+        (or the value itself if it is a plain byte string); as values are
+        immutable, it can be read from without holding the lock.
+        """
+        with self._lock:
+            value = self._follow_path(path)
+            if isinstance(value, dict): raise HKVError.for_name('BADTYPE')
+            version = self.version(path) if with_version else None
+        if value.__class__ is ChunkedValue:
+            ret = ChunkedReader(value.chunks)
+        else:
+            ret = ChunkedReader((value,))
+        if with_version: return (ret, version)
+        return ret
+
+    def _check_creatable(self, path):
+        """
+        Internal helper method.
+
+        Raise an error if path could not be created by a modifying
+        operation.
+        """
+        try:
+            self._split_follow_path(path)
+        except HKVError as exc:
+            if exc.name != 'NOKEY': raise
+
+    def copy(self, src, dst, if_version=None):
+        """
+        Copy the value at src to dst; see BaseDataStore for details.
+
+        Nested subtrees are not copied eagerly: only the node at src itself
+        is duplicated (using _unshare()), which takes time proportional to
+        the amount of keys immediately below it. The nodes below it are
+        shared between src and dst until a modification of either passes
+        through them; the rest of the datastore (including handles
+        referencing it) is not affected.
+        """
+        with self._lock:
+            self._begin_write(src, if_version)
+            record, key = self._split_follow_path(src)
+            try:
+                value = record[key]
+            except KeyError:
+                raise HKVError.for_name('NOKEY')
+            self._check_creatable(dst)
+            if isinstance(value, dict):
+                value = self._unshare(value)
+                value.ident = next(self._idents)
+            trail = []
+            record, key = self._split_follow_path(dst, True, trail)
+            self._account(trail, record,
+                          *self._change(trail, key, record.get(key),
+                                        value))
+            record[key] = value
+            trail.append((record, key))
+            self._commit(trail)
+
+    def move(self, src, dst, if_version=None):
+        """
+        Move the value at src to dst; see BaseDataStore for details.
+
+        The value is unlinked from its old parent and linked into its new
+        one, which takes time proportional to the lengths of the paths only.
+        Handles referencing the value (or anything below it) become invalid.
+        """
+        with self._lock:
+            self._begin_write(src, if_version)
+            if tuple(dst[:len(src)]) == tuple(src):
+                raise HKVError.for_name('BADMOVE')
+            record, key = self._split_follow_path(src)
+            if key not in record: raise HKVError.for_name('NOKEY')
+            self._check_creatable(dst)
+            source_trail = []
+            record, key = self._split_follow_path(src, False, source_trail)
+            value = record.pop(key)
+            if isinstance(value, dict) and value.born < record.lent:
+                # The value may be shared with a copy; keep it marked as
+                # such below any parent.
+                value.born = -1
+            self._account(source_trail, record,
+                          *self._change(source_trail, key, value, None))
+            record.stamps.pop(key, None)
+            trail = []
+            record, key = self._split_follow_path(dst, True, trail)
+            self._account(trail, record,
+                          *self._change(trail, key, record.get(key),
+                                        value))
+            record[key] = value
+            trail.append((record, key))
+            self._commit(source_trail + trail)
+
+    def version(self, path):
+        "Retrieve the version of path; see BaseDataStore for details."
+        with self._lock:
+            if not path: return self._clock
+            try:
+                record, key = self._split_follow_path(path)
+            except HKVError as exc:
+                if exc.name in ('NOKEY', 'BADNEST'): return 0
+                raise
+            return record.stamps.get(key, 0)
+
+    def handle(self, path):
+        """
+        Obtain a handle for the collection at path; see BaseDataStore for
+        details.
+
+        Operations using the handle start traversing at the node it
+        references (as long as the datastore's structure has not changed in
+        a way that could affect it); modifying operations additionally reuse
+        the nodes leading there, as they need to update every one of them.
+        """
+        with self._lock:
+            node = self._follow_path(path)
+            if not isinstance(node, dict): raise HKVError.for_name('BADTYPE')
+            ret = Handle(self, path, node.ident)
+            ret.node, ret.epoch, ret.lent = node, self._epoch, node.lent
+            return ret
+
+    def release_handle(self, handle):
+        "Dispose of a handle; see BaseDataStore for details."
+        handle.node = handle.epoch = handle.trail = None
+
+    def stat(self, path, with_version=False):
+        """
+        Retrieve aggregate sizes of the value at path; see BaseDataStore for
+        details.
+
+        The aggregates are maintained incrementally by all modifying
+        operations, so that this takes time proportional to the length of
+        path only.
+        """
+        with self._lock:
+            record = self._follow_path(path)
+            if isinstance(record, dict):
+                ret = (record.nkeys, record.nnodes, record.nbytes)
+            else:
+                ret = (0, 0, len(record))
+            return self._versioned(path, ret, with_version)
+
+    def _closure(self, pattern, states):
+        """
+        Internal helper method.
+
+        Return the set of states (i.e. indices into pattern) reachable from
+        the given ones by letting QUERY_ANY wildcards match no keys.
+        """
+        end = len(pattern)
+        ret, stack = set(), list(states)
+        while stack:
+            state = stack.pop()
+            if state in ret: continue
+            ret.add(state)
+            if state < end and pattern[state] == QUERY_ANY:
+                stack.append(state + 1)
+        return ret
+
+    def _pattern_states(self, pattern, path):
+        """
+        Internal helper method.
+
+        Return the set of states pattern can be in after matching path;
+        pattern matches path if it contains len(pattern).
+        """
+        states = self._closure(pattern, (0,))
+        for key in path:
+            states = self._step_states(pattern, states, key)
+            if not states: break
+        return states
+
+    def _step_states(self, pattern, states, key):
+        """
+        Internal helper method.
+
+        Return the set of states pattern can be in after matching key when
+        it was in any of states before.
+        """
+        end = len(pattern)
+        following = set()
+        for state in states:
+            if state == end:
+                continue
+            elif pattern[state] == QUERY_ANY:
+                following.add(state)
+            elif pattern[state] in (QUERY_ONE, key):
+                following.add(state + 1)
+        if not following: return following
+        return self._closure(pattern, following)
+
+    def _covering_indexes(self, path):
+        """
+        Internal helper method.
+
+        Return a list of (index, states) pairs for the indexes whose patterns
+        can match path or any of its descendants, where states is the set of
+        states the pattern is in after matching path.
+        """
+        ret = []
+        for index in self._indexes.values():
+            states = self._pattern_states(index.pattern, path)
+            if states: ret.append((index, states))
+        return ret
+
+    def _match(self, root, prefix, pattern, states=None):
+        """
+        Internal helper method.
+
+        Generate (path, value) pairs of all scalars below root (whose path
+        is prefix) matching pattern; if states is not None, it is the set of
+        states pattern is in at root (see _pattern_states()). The pattern is
+        simulated as a nondeterministic automaton whose states are indices
+        into it, so that every node is visited at most once regardless of
+        the amount of QUERY_ANY wildcards; where no wildcard applies,
+        children are looked up rather than enumerated.
+        """
+        pattern = tuple(pattern)
+        end = len(pattern)
+        def closure(states):
+            return self._closure(pattern, states)
+        if states is None: states = closure((0,))
+        stack = [(prefix, root, states)]
+        while stack:
+            path, node, states = stack.pop()
+            # The states reached through wildcards do not depend on the key,
+            # so that they are only computed once per node.
+            wild, literals = set(), {}
+            for state in states:
+                if state == end:
+                    continue
+                elif pattern[state] == QUERY_ANY:
+                    wild.add(state)
+                elif pattern[state] == QUERY_ONE:
+                    wild.add(state + 1)
+                else:
+                    literals.setdefault(pattern[state], set()).add(state + 1)
+            if wild:
+                keys, wild = node, closure(wild)
+            else:
+                keys = [k for k in literals if k in node]
+            for key in keys:
+                following = wild
+                if key in literals: following = closure(wild | literals[key])
+                if not following: continue
+                value = node[key]
+                if isinstance(value, dict):
+                    stack.append((path + (key,), value, following))
+                elif end in following:
+                    yield (path + (key,), value)
+
+    def _reindex(self, path, old, new, covering=None):
+        """
+        Internal helper method.
+
+        Update the indexes for the value at path changing from old to new;
+        either may be None (denoting absence) or a nested node, whose
+        matching descendants are then taken into account. This takes time
+        proportional to the size of the subtrees concerned. If covering is
+        not None, it is the result of _covering_indexes() for the parent of
+        path, which spares matching all of path against every index.
+        """
+        if covering is None:
+            covering = self._covering_indexes(path)
+        else:
+            covering = [(index, self._step_states(index.pattern, states,
+                                                  path[-1]))
+                        for index, states in covering]
+        for index, states in covering:
+            pattern = index.pattern
+            if not states: continue
+            for value, func in ((old, index.remove), (new, index.add)):
+                if value is None:
+                    continue
+                elif isinstance(value, dict):
+                    for p, v in self._match(value, path, pattern, states):
+                        func(p, v)
+                elif len(pattern) in states:
+                    func(path, value)
+
+    def query(self, pattern, limit=0, values_only=False, with_version=False):
+        """
+        Retrieve scalar values matching pattern; see BaseDataStore for
+        details.
+
+        The matches are collected in a single traversal while holding the
+        lock; only subtrees the pattern can match in are descended into. If
+        pattern is a HandlePath, the traversal starts at the handle's node.
+        """
+        with self._lock:
+            if (pattern.__class__ is HandlePath and
+                    pattern.handle.owner is self):
+                root = self._resolve(pattern.handle)
+                prefix, pattern = pattern.handle.path, pattern.suffix
+            else:
+                root, prefix = self.data, ()
+            matches = self._match(root, prefix, pattern)
+            if limit > 0: matches = itertools.islice(matches, limit)
+            if values_only:
+                ret = [v for p, v in matches]
+                if self._chunked: ret = [self._unchunk(v) for v in ret]
+            else:
+                ret = list(matches)
+                if self._chunked:
+                    ret = [(p, self._unchunk(v)) for p, v in ret]
+            return self._versioned((), ret, with_version)
+
+    def create_index(self, pattern, if_version=None):
+        """
+        Create a secondary index; see BaseDataStore for details.
+
+        The index is populated by a query() and maintained incrementally
+        afterwards; every modification then additionally takes time
+        proportional to the amount of indexed values it affects.
+        """
+        with self._lock:
+            self._begin_write(pattern, if_version)
+            pattern = tuple(pattern)
+            if pattern in self._indexes: return
+            index = self.Index(pattern)
+            for path, value in self._match(self.data, (), pattern):
+                index.add(path, value)
+            self._indexes[pattern] = index
+
+    def drop_index(self, pattern, if_version=None):
+        "Remove a secondary index; see BaseDataStore for details."
+        with self._lock:
+            self._begin_write(pattern, if_version)
+            try:
+                del self._indexes[tuple(pattern)]
+            except KeyError:
+                raise HKVError.for_name('NOINDEX')
+
+    def lookup(self, pattern, value, with_version=False):
+        "Look up paths holding value; see BaseDataStore for details."
+        with self._lock:
+            try:
+                index = self._indexes[tuple(pattern)]
+            except KeyError:
+                raise HKVError.for_name('NOINDEX')
+            ret = list(index.entries.get(value, ()))
+            return self._versioned((), ret, with_version)
+
+    def measure(self):
+        """
+        Return a mapping with the amounts of scalar values ("keys"), nested
+        nodes ("nodes"), and bytes in keys and scalar values ("bytes") in
+        this datastore, as well as the amounts of secondary indexes
+        ("indexes"), of paths stored in them ("index_paths"), and of bytes
+        in those paths and the values indexed ("index_bytes").
+
+        The first three are equivalent to stat() on the empty path; this
+        takes time proportional to the amount of indexes.
+        """
+        keys, nodes, size = self.stat(())
+        with self._lock:
+            indexes = [i for i in self._indexes.values() if i is not None]
+            return {'keys': keys, 'nodes': nodes, 'bytes': size,
+                    'indexes': len(self._indexes),
+                    'index_paths': sum(i.npaths for i in indexes),
+                    'index_bytes': sum(i.nbytes for i in indexes)}
+
+    def dump(self, codec):
+        """
+        Serialize the contents of this datastore (including the versions of
+        all values and the patterns of the secondary indexes) to the given
+        Codec.
+
+        The data written can be read back using restore(). The datastore is
+        locked for the whole duration of this; dump a snapshot instead in
+        order not to block writers.
+        """
+        with self._lock:
+            stack = [((), self.data)]
+            while stack:
+                path, node = stack.pop()
+                scalars = {}
+                for k, v in node.items():
+                    if isinstance(v, dict):
+                        stack.append((path + (k,), v))
+                    else:
+                        scalars[k] = self._unchunk(v)
+                stamps = {k: SIGNED.pack(v) for k, v in node.stamps.items()}
+                codec.writef('camm', b'N', path, scalars, stamps)
+            for pattern in self._indexes:
+                codec.writef('ca', b'X', pattern)
+            codec.writef('cq', b'E', self._clock)
+
+    def restore(self, codec):
+        """
+        Replace the contents of this datastore with data read from the given
+        Codec, as written by dump().
+
+        Existing snapshots of this datastore are unaffected. The secondary
+        indexes are replaced by the ones recorded in the dump and rebuilt.
+        """
+        with self._lock:
+            self._generation += 1
+            generation = self._generation
+        root, chain, indexes = None, [], {}
+        while 1:
+            tag = codec.read_char()
+            if tag == b'E':
+                clock = codec.read_signed()
+                break
+            elif tag == b'X':
+                pattern = tuple(codec.read_bytelist())
+                indexes[pattern] = self.Index(pattern)
+                continue
+            elif tag != b'N':
+                raise ValueError('Invalid datastore dump')
+            path, scalars, stamps = codec.readf('amm')
+            node = self.Node(scalars)
+            node.stamps = {k: SIGNED.unpack(v)[0] for k, v in stamps.items()}
+            node.generation = generation
+            node.ident = next(self._idents)
+            if not path:
+                if root is not None: raise ValueError('Invalid datastore dump')
+                root = node
+            else:
+                # The nodes are dumped in pre-order, so that the parent of
+                # every node is the most recent one with a shorter path.
+                del chain[len(path):]
+                chain[len(path) - 1][path[-1]] = node
+            chain.append(node)
+        if root is None: raise ValueError('Invalid datastore dump')
+        root.recount()
+        for pattern, index in indexes.items():
+            for path, value in self._match(root, (), pattern):
+                index.add(path, value)
+        with self._lock:
+            self._epoch += 1
+            self.data = root
+            self._clock = clock
+            self._indexes = indexes
+
+    def snapshot(self):
+        """
+        Create a read-only view of this DataStore; see BaseDataStore for
+        details.
+
+        This takes constant time: the current nodes are frozen by advancing
+        the datastore's generation, and subsequent modifications copy any
+        frozen node they touch (along with its ancestors) before changing it.
+        Reading from the snapshot does not involve the lock of this
+        datastore, so that writers do not have to wait for readers of the
+        snapshot.
+        """
+        with self._lock:
+            self._generation += 1
+            ret = SnapshotDataStore(self.data, self._clock, self._indexes)
+            ret._chunked = self._chunked
+            return ret
+
+class SnapshotDataStore(DataStore):
+    """
+    SnapshotDataStore(data, clock, indexes=()) -> new instance
+
+    A read-only view of the contents of a DataStore at some point in time.
+
+    data is the (frozen) root node; clock is the version of the whole
+    datastore; indexes is a sequence of the patterns of the secondary
+    indexes of the datastore. Instances are normally created by
+    DataStore.snapshot().
+
+    The indexes are not copied (as that would take time proportional to
+    their size); instead, lookup() evaluates the index's pattern as query()
+    does.
+    """
+
+    def __init__(self, data, clock, indexes=()):
+        "Instance initializer; see class docstring for details."
+        super(SnapshotDataStore, self).__init__()
+        self.data = data
+        self._clock = clock
+        self._indexes = dict.fromkeys(tuple(p) for p in indexes)
+
+    def _begin_write(self, path, if_version):
+        "Internal helper method; see DataStore for details."
+        raise HKVError.for_name('READONLY')
+
+    def restore(self, codec):
+        "Refuse to replace the contents of this snapshot."
+        raise HKVError.for_name('READONLY')
+
+    def lookup(self, pattern, value, with_version=False):
+        "Look up paths holding value; see the class docstring for details."
+        pattern = tuple(pattern)
+        if pattern not in self._indexes:
+            raise HKVError.for_name('NOINDEX')
+        ret = [p for p, v in self._match(self.data, (), pattern)
+               if v == value]
+        return self._versioned((), ret, with_version)
+
+    def snapshot(self):
+        "Return this (already immutable) snapshot."
+        return self
+
+class NullDataStore(BaseDataStore):
+    """
+    NullDataStore() -> new instance
+
+    A datastore implementation that does not retain any data.
+
+    All reading requests (get(), get_all(), list(), get_stream()) raise a
+    NOKEY error and query() and lookup() find nothing, while all other
+    operations do nothing. As nothing ever exists, every version is zero,
+    and modifying operations with any other if_version raise a BADVERSION
+    error.
+    """
+
+    def _begin_write(self, if_version):
+        "Internal helper method."
+        if if_version: raise HKVError.for_name('BADVERSION')
 
     def lock(self):
         pass
@@ -470,33 +2057,88 @@ class NullDataStore(BaseDataStore):
     def close(self):
         pass
 
-    def get(self, path):
+    def get(self, path, with_version=False):
         raise HKVError.for_name('NOKEY')
 
-    def get_all(self, path):
+    def get_all(self, path, with_version=False):
         raise HKVError.for_name('NOKEY')
 
-    def list(self, path, lclass):
+    def list(self, path, lclass, with_version=False):
         raise HKVError.for_name('NOKEY')
 
-    def put(self, path, value):
-        pass
+    def put(self, path, value, if_version=None):
+        self._begin_write(if_version)
 
-    def put_all(self, path, values):
-        pass
+    def put_all(self, path, values, if_version=None):
+        self._begin_write(if_version)
 
-    def replace(self, path, values):
-        pass
+    def replace(self, path, values, if_version=None):
+        self._begin_write(if_version)
 
-    def delete(self, path):
-        pass
+    def delete(self, path, if_version=None):
+        self._begin_write(if_version)
+
+    def delete_all(self, path, if_version=None):
+        self._begin_write(if_version)
+
+    def incr(self, path, delta=1, width=0, if_version=None):
+        self._begin_write(if_version)
+        return decode_counter(encode_counter(delta, width), width)
+
+    def append(self, path, value, if_version=None):
+        self._begin_write(if_version)
+
+    def cas(self, path, expected, value, if_version=None):
+        raise HKVError.for_name('NOKEY')
+
+    def put_if_absent(self, path, value, if_version=None):
+        self._begin_write(if_version)
+        return True
+
+    def put_stream(self, path, source, if_version=None):
+        self._begin_write(if_version)
+
+    def get_stream(self, path, with_version=False):
+        raise HKVError.for_name('NOKEY')
 
-    def delete_all(self, path):
+    def copy(self, src, dst, if_version=None):
+        raise HKVError.for_name('NOKEY')
+
+    def move(self, src, dst, if_version=None):
+        raise HKVError.for_name('NOKEY')
+
+    def version(self, path):
+        return 0
+
+    def handle(self, path):
+        raise HKVError.for_name('NOKEY')
+
+    def release_handle(self, handle):
         pass
 
+    def stat(self, path, with_version=False):
+        raise HKVError.for_name('NOKEY')
+
+    def query(self, pattern, limit=0, values_only=False, with_version=False):
+        if with_version: return ([], 0)
+        return []
+
+    def create_index(self, pattern, if_version=None):
+        self._begin_write(if_version)
+
+    def drop_index(self, pattern, if_version=None):
+        self._begin_write(if_version)
+
+    def lookup(self, pattern, value, with_version=False):
+        if with_version: return ([], 0)
+        return []
+
+    def snapshot(self):
+        return self
+
 class ConvertingDataStore(BaseDataStore):
     """
-    ConvertingDataStore(wrapped) -> new instance
+    ConvertingDataStore(wrapped, cache_size=0) -> new instance
 
     A wrapper around another datastore that converts keys and values on the
     fly.
@@ -511,12 +2153,22 @@ class ConvertingDataStore(BaseDataStore):
     to (if any); in particular, the internal format must be self-describing
     enough to accommodate that. Where a key-value mapping is passed or
     returned, the individual keys and values are converted rather than the
-    whole mapping.
+    whole mapping; this is done using the batch conversion methods
+    import_keys(), export_keys(), import_values(), and export_values(),
+    which subclasses may override with more efficient implementations.
+
+    If cache_size is positive, the results of converting (hashable) keys and
+    paths are memoized in caches holding at most that many entries each
+    (which are emptied whenever they become full); the conversion methods
+    must then be deterministic and their results must not be modified.
     """
 
-    def __init__(self, wrapped):
+    def __init__(self, wrapped, cache_size=0):
         "Instance initializer; see class docstring for details."
         self.wrapped = wrapped
+        self.cache_size = cache_size
+        self._import_cache = {}
+        self._export_cache = {}
 
     def import_key(self, key, fragment):
         """
@@ -550,6 +2202,77 @@ class ConvertingDataStore(BaseDataStore):
         """
         raise NotImplementedError
 
+    def import_keys(self, keys, fragment):
+        """
+        Convert a sequence of keys (or paths; see import_key()) from the
+        external to the internal format, returning a list.
+
+        The default implementation invokes import_key() on every item (or
+        consults the cache).
+        """
+        ik = self._import_key
+        return [ik(k, fragment) for k in keys]
+
+    def export_keys(self, keys, fragment):
+        """
+        Convert a sequence of keys (or paths; see export_key()) from the
+        internal to the external format, returning a list.
+
+        The default implementation invokes export_key() on every item (or
+        consults the cache).
+        """
+        ek = self._export_key
+        return [ek(k, fragment) for k in keys]
+
+    def import_values(self, values):
+        """
+        Convert a sequence of scalar values from the external to the
+        internal format, returning a list.
+
+        The default implementation invokes import_value() on every item.
+        """
+        iv = self.import_value
+        return [iv(v) for v in values]
+
+    def export_values(self, values):
+        """
+        Convert a sequence of scalar values from the internal to the
+        external format, returning a list.
+
+        The default implementation invokes export_value() on every item.
+        """
+        ev = self.export_value
+        return [ev(v) for v in values]
+
+    def _convert_cached(self, cache, func, key, fragment):
+        """
+        Internal helper method.
+
+        Return func(key, fragment), memoizing the result in cache.
+        """
+        try:
+            return cache[key, fragment]
+        except KeyError:
+            pass
+        except TypeError:
+            return func(key, fragment)
+        ret = func(key, fragment)
+        if len(cache) >= self.cache_size: cache.clear()
+        cache[key, fragment] = ret
+        return ret
+
+    def _import_key(self, key, fragment):
+        "Internal helper method; import_key() using the cache."
+        if not self.cache_size: return self.import_key(key, fragment)
+        return self._convert_cached(self._import_cache, self.import_key,
+                                    key, fragment)
+
+    def _export_key(self, key, fragment):
+        "Internal helper method; export_key() using the cache."
+        if not self.cache_size: return self.export_key(key, fragment)
+        return self._convert_cached(self._export_cache, self.export_key,
+                                    key, fragment)
+
     def lock(self):
         "Lock this datastore; see BaseDataStore for details."
         self.wrapped.lock()
@@ -562,51 +2285,171 @@ class ConvertingDataStore(BaseDataStore):
         "Dispose of this datastore; see BaseDataStore for details."
         self.wrapped.close()
 
-    def get(self, path):
+    def get(self, path, with_version=False):
         "Retrieve a scalar at path; see BaseDataStore for details."
-        path = self.import_key(path, False)
-        return self.export_value(self.wrapped.get(path))
+        res = self.wrapped.get(self._import_key(path, False), with_version)
+        if with_version: return (self.export_value(res[0]), res[1])
+        return self.export_value(res)
 
-    def get_all(self, path):
+    def get_all(self, path, with_version=False):
         "Retrieve key-value pairs below path; see BaseDataStore for details."
-        res = self.wrapped.get_all(self.import_key(path, False))
-        ek, ev = self.export_key, self.export_value
-        return {ek(k, True): ev(v) for k, v in res.items()}
+        res = self.wrapped.get_all(self._import_key(path, False),
+                                   with_version)
+        if with_version: res, version = res
+        ret = dict(zip(self.export_keys(list(res), True),
+                       self.export_values(list(res.values()))))
+        if with_version: return (ret, version)
+        return ret
 
-    def list(self, path, lclass):
+    def list(self, path, lclass, with_version=False):
         "List some keys below path; see BaseDataStore for details."
-        items = self.wrapped.list(self.import_key(path, False), lclass)
-        ek = self.export_key
-        return [ek(i, True) for i in items]
+        items = self.wrapped.list(self._import_key(path, False), lclass,
+                                  with_version)
+        if with_version: items, version = items
+        ret = self.export_keys(items, True)
+        if with_version: return (ret, version)
+        return ret
 
-    def put(self, path, value):
+    def put(self, path, value, if_version=None):
         "Store value at path; see BaseDataStore for details."
-        self.wrapped.put(self.import_key(path, False),
-                         self.import_value(value))
+        self.wrapped.put(self._import_key(path, False),
+                         self.import_value(value), if_version)
 
-    def put_all(self, path, values):
+    def put_all(self, path, values, if_version=None):
         "Merge pairs from values below path; see BaseDataStore for details."
-        ik, iv = self.import_key, self.import_value
-        ivalues = {ik(k, True): iv(v) for k, v in values.items()}
-        self.wrapped.put_all(self.import_key(path, False), ivalues)
+        ivalues = dict(zip(self.import_keys(list(values), True),
+                           self.import_values(list(values.values()))))
+        self.wrapped.put_all(self._import_key(path, False), ivalues,
+                             if_version)
 
-    def replace(self, path, values):
+    def replace(self, path, values, if_version=None):
         "Store values at path; see BaseDataStore for details."
-        ik, iv = self.import_key, self.import_value
-        ivalues = {ik(k, True): iv(v) for k, v in values.items()}
-        self.wrapped.replace(self.import_key(path, False), ivalues)
+        ivalues = dict(zip(self.import_keys(list(values), True),
+                           self.import_values(list(values.values()))))
+        self.wrapped.replace(self._import_key(path, False), ivalues,
+                             if_version)
 
-    def delete(self, path):
+    def delete(self, path, if_version=None):
         "Delete the value at path; see BaseDataStore for details."
-        self.wrapped.delete(self.import_key(path, False))
+        self.wrapped.delete(self._import_key(path, False), if_version)
 
-    def delete_all(self, path):
+    def delete_all(self, path, if_version=None):
         "Delete everything below path; see BaseDataStore for details."
-        self.wrapped.delete_all(self.import_key(path, False))
+        self.wrapped.delete_all(self._import_key(path, False), if_version)
+
+    def incr(self, path, delta=1, width=0, if_version=None):
+        "Increment a counter at path; see BaseDataStore for details."
+        return self.wrapped.incr(self._import_key(path, False), delta, width,
+                                 if_version)
+
+    def append(self, path, value, if_version=None):
+        "Append value to the scalar at path; see BaseDataStore for details."
+        self.wrapped.append(self._import_key(path, False),
+                            self.import_value(value), if_version)
+
+    def cas(self, path, expected, value, if_version=None):
+        "Compare-and-swap the scalar at path; see BaseDataStore for details."
+        iv = self.import_value
+        return self.wrapped.cas(self._import_key(path, False), iv(expected),
+                                iv(value), if_version)
+
+    def put_if_absent(self, path, value, if_version=None):
+        "Store value at path if it is absent; see BaseDataStore for details."
+        return self.wrapped.put_if_absent(self._import_key(path, False),
+                                          self.import_value(value),
+                                          if_version)
+
+    def put_stream(self, path, source, if_version=None):
+        """
+        Store the contents of a stream at path; see BaseDataStore for
+        details.
+
+        Only the path is converted; the data read from source are stored as
+        they are (i.e. they must be in the internal format already).
+        """
+        self.wrapped.put_stream(self._import_key(path, False), source,
+                                if_version)
+
+    def get_stream(self, path, with_version=False):
+        """
+        Retrieve the scalar at path as a file-like object; see BaseDataStore
+        for details.
+
+        Only the path is converted; the reader returns the value in the
+        internal format.
+        """
+        return self.wrapped.get_stream(self._import_key(path, False),
+                                       with_version)
+
+    def copy(self, src, dst, if_version=None):
+        "Copy the value at src to dst; see BaseDataStore for details."
+        ik = self._import_key
+        self.wrapped.copy(ik(src, False), ik(dst, False), if_version)
+
+    def move(self, src, dst, if_version=None):
+        "Move the value at src to dst; see BaseDataStore for details."
+        ik = self._import_key
+        self.wrapped.move(ik(src, False), ik(dst, False), if_version)
+
+    def version(self, path):
+        "Retrieve the version of path; see BaseDataStore for details."
+        return self.wrapped.version(self._import_key(path, False))
+
+    def stat(self, path, with_version=False):
+        "Retrieve aggregates of path; see BaseDataStore for details."
+        return self.wrapped.stat(self._import_key(path, False), with_version)
+
+    def query(self, pattern, limit=0, values_only=False, with_version=False):
+        """
+        Retrieve scalar values matching pattern; see BaseDataStore for
+        details.
+
+        pattern is converted like any other path; import_key() must map
+        wildcards to the wrapped datastore's ones (as TextDataStore does).
+        """
+        res = self.wrapped.query(self._import_key(pattern, False), limit,
+                                 values_only, with_version)
+        if with_version: res, version = res
+        if values_only:
+            ret = self.export_values(res)
+        else:
+            ret = list(zip(self.export_keys([p for p, v in res], False),
+                           self.export_values([v for p, v in res])))
+        if with_version: return (ret, version)
+        return ret
+
+    def create_index(self, pattern, if_version=None):
+        "Create a secondary index; see BaseDataStore for details."
+        self.wrapped.create_index(self._import_key(pattern, False), if_version)
+
+    def drop_index(self, pattern, if_version=None):
+        "Remove a secondary index; see BaseDataStore for details."
+        self.wrapped.drop_index(self._import_key(pattern, False), if_version)
+
+    def lookup(self, pattern, value, with_version=False):
+        "Look up paths holding value; see BaseDataStore for details."
+        res = self.wrapped.lookup(self._import_key(pattern, False),
+                                  self.import_value(value), with_version)
+        if with_version: res, version = res
+        ret = self.export_keys(res, False)
+        if with_version: return (ret, version)
+        return ret
+
+    def snapshot(self):
+        """
+        Create a read-only view of this datastore; see BaseDataStore for
+        details.
+
+        The result is a shallow copy of this instance wrapping a snapshot of
+        the wrapped datastore.
+        """
+        ret = copy.copy(self)
+        ret.wrapped = self.wrapped.snapshot()
+        return ret
 
 class Codec(object):
     """
-    Codec(rfile, wfile) -> new instance
+    Codec(rfile, wfile, protocol=1) -> new instance
 
     A utility class for serializing (and deserializing) data for the remote
     API.
@@ -616,7 +2459,13 @@ class Codec(object):
     write_*() methods convert the value passed to them into a byte stream and
     write it to wfile (which must be a binary stream open for writing). If
     wfile is buffering internally, use the flush() method to flush it. close()
-    closes both rfile and wfile.
+    closes both rfile and wfile. The bytes_read and bytes_written attributes
+    count the amounts of bytes transferred.
+
+    protocol is the version of the wire format to use, and is stored in the
+    attribute of the same name; see set_protocol() for details. The limits
+    of 2**32-1 noted below apply to version 1; version 2 raises them to
+    2**64-1. Transport compression can be enabled using set_compression().
 
     readf() and writef() methods read or write values according to format
     strings passed to them. Each format string consists of an optional leading
@@ -632,32 +2481,290 @@ class Codec(object):
     "-": A value of None; nothing is actually read/written from/to the
          underlying files.
     "c": A single byte.
-    "i": A Python integer; mapped to an unsigned 32-bit integer.
+    "i": A Python integer; mapped to an unsigned 32-bit integer (or, with
+         protocol version 2, an unsigned variable-length integer).
+    "q": A Python integer; mapped to a signed 64-bit integer.
     "s": A single byte string (at most 2**32-1 bytes large; may contain
          arbitrary byte values).
     "a": A list of at most 2**32-1 byte strings as for format unit "s".
     "m": A mapping with at most 2**32-1 pairs of keys and values, both of
          which may be arbitrary byte strings as above.
+    "M": A list of at most 2**32-1 mappings as for format unit "m".
+    "Q": A sequence of at most 2**32-1 integers as for format unit "q"; read
+         as a list.
+    "A": A list of at most 2**32-1 lists as for format unit "a".
+    "T": An iterable of (path, value) pairs, where path is as for format
+         unit "a" and value is as for "s"; read as a list of pairs. Bare
+         values may be written in place of pairs; they are transmitted
+         with empty paths. The pairs are transmitted in chunks of at most
+         CHUNK_ITEMS each, preceded by the size of the chunk and terminated
+         by an empty chunk, so that the total amount need not be known in
+         advance.
+    "S": A byte string of arbitrary size, transmitted as a sequence of
+         nonempty chunks of at most CHUNK_BYTES bytes (each as for format
+         unit "s") terminated by an empty chunk; read as a ChunkedValue.
+         Byte strings, ChunkedValue instances, and binary file-like objects
+         (which are read until their end) may be written.
     """
 
-    def __init__(self, rfile, wfile):
+    class FrameWriter(object):
+        """
+        FrameWriter(codec, file, method, threshold) -> new instance
+
+        A wrapper around a writable binary stream that groups the data
+        written into frames and compresses them where worthwhile, as used
+        by Codec.set_compression().
+
+        Data are buffered until flush() is called or FRAME_BYTES bytes have
+        accumulated (writes crossing that boundary are split, so that no
+        frame holds more than FRAME_BYTES bytes); every frame consists of a
+        FRAME_HEADER (holding a method number and the length of the payload
+        following it) and the payload, which is compressed using method (a
+        key of COMPRESSION_METHODS) if it is at least threshold bytes long
+        and compression makes it smaller. The method number is 0 for
+        uncompressed payloads and 1 for compressed ones. The statistics of
+        codec are updated.
+        """
+
+        def __init__(self, codec, file, method, threshold):
+            "Instance initializer; see class docstring for details."
+            self.codec = codec
+            self.file = file
+            self.method = method
+            self.threshold = threshold
+            self.buffer = []
+            self.size = 0
+            self._compress = COMPRESSION_METHODS[method][0]
+
+        def write(self, data):
+            """
+            Write data, emitting frames as they fill up.
+            """
+            size = len(data)
+            if self.size + size < FRAME_BYTES:
+                self.buffer.append(data)
+                self.size += size
+                return
+            # Split the data at frame boundaries so that no frame exceeds
+            # FRAME_BYTES (which FrameReader would reject).
+            view, offset = memoryview(data), FRAME_BYTES - self.size
+            self.buffer.append(view[:offset])
+            self.size = FRAME_BYTES
+            self.emit()
+            while size - offset >= FRAME_BYTES:
+                self.buffer = [view[offset:offset + FRAME_BYTES]]
+                self.size = FRAME_BYTES
+                self.emit()
+                offset += FRAME_BYTES
+            if offset < size:
+                self.buffer.append(view[offset:].tobytes())
+                self.size = size - offset
+
+        def emit(self):
+            """
+            Write the buffered data (if any) as a frame.
+            """
+            if not self.size: return
+            payload = b''.join(self.buffer)
+            self.buffer, self.size = [], 0
+            kind = 0
+            if len(payload) >= self.threshold:
+                start = cpu_timer()
+                packed = self._compress(payload)
+                stats = self.codec.compression_stats
+                stats['compress_time'] += cpu_timer() - start
+                if len(packed) < len(payload):
+                    stats['compressed_frames'] += 1
+                    stats['compressed_raw'] += len(payload)
+                    stats['compressed_wire'] += len(packed)
+                    payload, kind = packed, 1
+            self.file.write(FRAME_HEADER.pack(kind, len(payload)))
+            self.file.write(payload)
+
+        def flush(self):
+            """
+            Emit any buffered data as a frame and flush the underlying
+            stream.
+            """
+            self.emit()
+            self.file.flush()
+
+        def close(self):
+            """
+            Flush and close the underlying stream.
+            """
+            try:
+                self.emit()
+            finally:
+                self.file.close()
+
+    class FrameReader(object):
+        """
+        FrameReader(codec, file, method) -> new instance
+
+        A wrapper around a readable binary stream that undoes the framing
+        (and compression) applied by FrameWriter.
+
+        The decompressed size of every frame is limited to FRAME_BYTES (so
+        that a small frame cannot expand into arbitrary amounts of memory);
+        frames violating that raise a ValueError. The statistics of codec
+        are updated.
+        """
+
+        def __init__(self, codec, file, method):
+            "Instance initializer; see class docstring for details."
+            self.codec = codec
+            self.file = file
+            self.method = method
+            self.frame = io.BytesIO()
+            self._decompressor = COMPRESSION_METHODS[method][1]
+
+        def _next_frame(self):
+            """
+            Internal helper method.
+
+            Read the next frame into the frame attribute (a BytesIO); return
+            False at the end of the underlying stream.
+            """
+            header = self.file.read(FRAME_HEADER.size)
+            if not header: return False
+            if len(header) != FRAME_HEADER.size: raise EOFError('Short read')
+            kind, length = FRAME_HEADER.unpack(header)
+            payload = self.file.read(length)
+            if len(payload) != length: raise EOFError('Short read')
+            if kind == 1:
+                start = cpu_timer()
+                decompressor = self._decompressor()
+                data = decompressor.decompress(payload, FRAME_BYTES + 1)
+                if (len(data) > FRAME_BYTES or
+                        not getattr(decompressor, 'eof', True)):
+                    raise ValueError('Invalid compressed frame')
+                stats = self.codec.compression_stats
+                stats['decompress_time'] += cpu_timer() - start
+                stats['decompressed_frames'] += 1
+                stats['decompressed_wire'] += length
+                stats['decompressed_raw'] += len(data)
+                payload = data
+            elif kind != 0:
+                raise ValueError('Invalid frame type: %r' % (kind,))
+            self.frame = io.BytesIO(payload)
+            return True
+
+        def read(self, size=-1):
+            """
+            Read up to size bytes (or everything if size is negative); less
+            data than requested are only returned at the end of the stream.
+            """
+            ret = self.frame.read(size)
+            if len(ret) == size: return ret
+            parts = [ret]
+            if size >= 0: size -= len(ret)
+            while size and self._next_frame():
+                part = self.frame.read(size)
+                parts.append(part)
+                if size >= 0: size -= len(part)
+            return b''.join(parts)
+
+        def close(self):
+            """
+            Close the underlying stream.
+            """
+            self.file.close()
+
+    def __init__(self, rfile, wfile, protocol=1):
         "Instance initializer; see class docstring for details."
         self.rfile = rfile
         self.wfile = wfile
+        self.protocol = 1
+        self.compression = None
+        self.compress_threshold = None
+        self.compression_stats = dict.fromkeys(('compressed_frames',
+            'compressed_raw', 'compressed_wire', 'compress_time',
+            'decompressed_frames', 'decompressed_raw', 'decompressed_wire',
+            'decompress_time'), 0)
+        self.bytes_read = 0
+        self.bytes_written = 0
         self._rmap = {
             '-': self.read_nothing,
             'c': self.read_char,
             'i': self.read_int,
+            'q': self.read_signed,
             's': self.read_bytes,
             'a': self.read_bytelist,
-            'm': self.read_bytedict}
+            'm': self.read_bytedict,
+            'M': self.read_dictlist,
+            'Q': self.read_signedlist,
+            'A': self.read_listlist,
+            'T': self.read_pairstream,
+            'S': self.read_chunked}
         self._wmap = {
             '-': self.write_nothing,
             'c': self.write_char,
             'i': self.write_int,
+            'q': self.write_signed,
             's': self.write_bytes,
             'a': self.write_bytelist,
-            'm': self.write_bytedict}
+            'm': self.write_bytedict,
+            'M': self.write_dictlist,
+            'Q': self.write_signedlist,
+            'A': self.write_listlist,
+            'T': self.write_pairstream,
+            'S': self.write_chunked}
+        if protocol != 1: self.set_protocol(protocol)
+
+    def set_protocol(self, protocol):
+        """
+        Switch to the given version of the wire format.
+
+        In version 1, all lengths and counts (as well as the values of "i"
+        format units) are transmitted as 32-bit big-endian integers; version
+        2 transmits them as unsigned LEB128 variable-length integers of up to
+        64 bits instead (so that values below 128 take a single byte), by
+        making read_int() and write_int() equivalent to read_varint() and
+        write_varint(). The formats are otherwise identical.
+        """
+        if protocol not in (1, 2):
+            raise ValueError('Unsupported protocol version: %r' % (protocol,))
+        self.__dict__.pop('read_int', None)
+        self.__dict__.pop('write_int', None)
+        if protocol == 2:
+            self.read_int = self.read_varint
+            self.write_int = self.write_varint
+        self._rmap['i'] = self.read_int
+        self._wmap['i'] = self.write_int
+        self.protocol = protocol
+
+    def set_compression(self, method, threshold=COMPRESS_THRESHOLD):
+        """
+        Enable transport compression using method (a key of
+        COMPRESSION_METHODS), or disable it if method is None.
+
+        While compression is enabled, the data written are grouped into
+        frames, which are delimited by flush() calls and compressed if they
+        are at least threshold bytes long, and the data read are expected
+        to be framed likewise; see FrameWriter and FrameReader. Both sides
+        of a connection must switch at the same point of the data stream;
+        any data buffered for writing are flushed beforehand. The
+        compression_stats attribute counts frames compressed and
+        decompressed, their sizes before and after, and the CPU time spent
+        on them (in seconds; as measured by cpu_timer).
+        """
+        if method is not None and method not in COMPRESSION_METHODS:
+            raise ValueError('Unsupported compression method: %r' %
+                             (method,))
+        if self.wfile is not None: self.wfile.flush()
+        if isinstance(self.wfile, self.FrameWriter):
+            self.wfile = self.wfile.file
+        if isinstance(self.rfile, self.FrameReader):
+            self.rfile = self.rfile.file
+        if method is not None:
+            if self.wfile is not None:
+                self.wfile = self.FrameWriter(self, self.wfile, method,
+                                              threshold)
+            if self.rfile is not None:
+                self.rfile = self.FrameReader(self, self.rfile, method)
+        self.compression = method
+        self.compress_threshold = threshold if method is not None else None
 
     def close(self):
         """
@@ -701,6 +2808,7 @@ class Codec(object):
         """
         ret = self.rfile.read(1)
         if len(ret) != 1: raise EOFError('Received end-of-file')
+        self.bytes_read += 1
         return ret
 
     def write_char(self, item):
@@ -708,6 +2816,7 @@ class Codec(object):
         Write a single character.
         """
         self.wfile.write(item)
+        self.bytes_written += 1
 
     def read_int(self):
         """
@@ -715,6 +2824,7 @@ class Codec(object):
         """
         data = self.rfile.read(INTEGER.size)
         if len(data) != INTEGER.size: raise EOFError('Short read')
+        self.bytes_read += INTEGER.size
         return INTEGER.unpack(data)[0]
 
     def write_int(self, item):
@@ -722,14 +2832,78 @@ class Codec(object):
         Write a Python integer as an unsigned 32-bit integer.
         """
         self.wfile.write(INTEGER.pack(item))
+        self.bytes_written += INTEGER.size
 
-    def read_bytes(self):
+    def read_varint(self):
         """
-        Read a byte string.
+        Read an unsigned LEB128 variable-length integer of up to 64 bits and
+        return a Python integer.
         """
-        length = self.read_int()
-        ret = self.rfile.read(length)
-        if len(ret) != length: raise EOFError('Short read')
+        read = self.rfile.read
+        data = read(1)
+        ret = VARINT_VALUES.get(data)
+        if ret is not None:
+            self.bytes_read += 1
+            return ret
+        if not data: raise EOFError('Short read')
+        ret, shift = ord(data) & 0x7F, 7
+        while 1:
+            data = read(1)
+            if not data: raise EOFError('Short read')
+            byte = ord(data)
+            # The tenth byte holds bit 63 only and ends the encoding.
+            if shift == 63 and byte > 1:
+                raise ValueError('Variable-length integer too long')
+            ret |= (byte & 0x7F) << shift
+            shift += 7
+            if byte < 0x80: break
+        self.bytes_read += shift // 7
+        return ret
+
+    def write_varint(self, item):
+        """
+        Write a Python integer as an unsigned LEB128 variable-length integer
+        of up to 64 bits.
+        """
+        if 0 <= item < 0x80:
+            self.wfile.write(VARINT_BYTES[item])
+            self.bytes_written += 1
+            return
+        elif not 0 <= item < 1 << 64:
+            raise ValueError('Integer out of range for variable-length '
+                             'encoding: %r' % (item,))
+        data = bytearray()
+        while item >= 0x80:
+            data.append(item & 0x7F | 0x80)
+            item >>= 7
+        data.append(item)
+        self.wfile.write(data)
+        self.bytes_written += len(data)
+
+    def read_signed(self):
+        """
+        Read a 64-bit signed integer and return a Python integer.
+        """
+        data = self.rfile.read(SIGNED.size)
+        if len(data) != SIGNED.size: raise EOFError('Short read')
+        self.bytes_read += SIGNED.size
+        return SIGNED.unpack(data)[0]
+
+    def write_signed(self, item):
+        """
+        Write a Python integer as a signed 64-bit integer.
+        """
+        self.wfile.write(SIGNED.pack(item))
+        self.bytes_written += SIGNED.size
+
+    def read_bytes(self):
+        """
+        Read a byte string.
+        """
+        length = self.read_int()
+        ret = self.rfile.read(length)
+        if len(ret) != length: raise EOFError('Short read')
+        self.bytes_read += length
         return ret
 
     def write_bytes(self, data):
@@ -738,6 +2912,7 @@ class Codec(object):
         """
         self.write_int(len(data))
         self.wfile.write(data)
+        self.bytes_written += len(data)
 
     def read_bytelist(self):
         """
@@ -780,6 +2955,136 @@ class Codec(object):
             self.write_bytes(k)
             self.write_bytes(v)
 
+    def read_signedlist(self):
+        """
+        Read a list of signed integers as for read_signed().
+        """
+        length = self.read_int()
+        size = length * SIGNED.size
+        data = self.rfile.read(size)
+        if len(data) != size: raise EOFError('Short read')
+        self.bytes_read += size
+        return list(struct.unpack('!%dq' % length, data))
+
+    def write_signedlist(self, data):
+        """
+        Write a sequence of integers as for write_signed().
+        """
+        self.write_int(len(data))
+        self.wfile.write(struct.pack('!%dq' % len(data), *data))
+        self.bytes_written += len(data) * SIGNED.size
+
+    def read_dictlist(self):
+        """
+        Read a list of dictionaries as for read_bytedict().
+        """
+        length = self.read_int()
+        ret = []
+        while length:
+            ret.append(self.read_bytedict())
+            length -= 1
+        return ret
+
+    def write_dictlist(self, data):
+        """
+        Write a sequence of mappings as for write_bytedict().
+        """
+        self.write_int(len(data))
+        for item in data:
+            self.write_bytedict(item)
+
+    def read_listlist(self):
+        """
+        Read a list of lists of byte strings as for read_bytelist().
+        """
+        length = self.read_int()
+        ret = []
+        while length:
+            ret.append(self.read_bytelist())
+            length -= 1
+        return ret
+
+    def write_listlist(self, data):
+        """
+        Write a sequence of sequences of byte strings as for write_bytelist().
+        """
+        self.write_int(len(data))
+        for item in data:
+            self.write_bytelist(item)
+
+    def read_pairstream(self):
+        """
+        Read a chunked list of (path, value) pairs.
+        """
+        ret = []
+        while 1:
+            length = self.read_int()
+            if not length: return ret
+            while length:
+                path = self.read_bytelist()
+                ret.append((path, self.read_bytes()))
+                length -= 1
+
+    def write_pairstream(self, data):
+        """
+        Write an iterable of (path, value) pairs (or bare values) in chunks.
+        """
+        def flush_chunk():
+            self.write_int(len(chunk))
+            for item in chunk:
+                if isinstance(item, tuple):
+                    self.write_bytelist(item[0])
+                    self.write_bytes(item[1])
+                else:
+                    self.write_int(0)
+                    self.write_bytes(item)
+        chunk = []
+        for item in data:
+            chunk.append(item)
+            if len(chunk) == CHUNK_ITEMS:
+                flush_chunk()
+                chunk = []
+        if chunk: flush_chunk()
+        self.write_int(0)
+
+    def iter_chunks(self):
+        """
+        Read a chunked byte string incrementally, yielding the chunks as they
+        are received.
+
+        The chunks must be consumed completely before reading anything else.
+        """
+        while 1:
+            chunk = self.read_bytes()
+            if not chunk: break
+            yield chunk
+
+    def read_chunked(self):
+        """
+        Read a chunked byte string and return it as a ChunkedValue.
+        """
+        return ChunkedValue(self.iter_chunks())
+
+    def write_chunked(self, data):
+        """
+        Write a byte string, a ChunkedValue, or the contents of a binary
+        file-like object in chunks.
+        """
+        if isinstance(data, ChunkedValue):
+            chunks = data.chunks
+        elif hasattr(data, 'read'):
+            chunks = read_chunks(data)
+        else:
+            chunks = (data,)
+        for chunk in chunks:
+            if len(chunk) <= CHUNK_BYTES:
+                if chunk: self.write_bytes(chunk)
+                continue
+            view = memoryview(chunk)
+            for offset in range(0, len(view), CHUNK_BYTES):
+                self.write_bytes(view[offset:offset + CHUNK_BYTES])
+        self.write_int(0)
+
     def readf(self, format):
         """
         Read a sequence of values as indicated by the format string.
@@ -820,19 +3125,735 @@ class Codec(object):
         for t, a in zip(format, args):
             self._wmap[t](a)
 
+# Names of the commands of the remote API, as used by Statistics.
+COMMAND_NAMES = {b'q': 'quit', b'o': 'open', b'x': 'detach',
+                 b's': 'begin_consistent_read', b'u': 'end_consistent_read',
+                 b'b': 'lock', b'f': 'unlock', b'R': 'replicate',
+                 b'Y': 'replication_info', b'I': 'stats', b'L': 'slowlog',
+                 b'K': 'hotkeys', b'h': 'handle', b'j': 'release_handle',
+                 b'N': 'negotiate', b'z': 'compress',
+                 b'E': 'list_datastores', b'U': 'drop_datastore'}
+COMMAND_NAMES.update((k, v[1]) for k, v in DataStore._OPERATIONS.items())
+
+class Histogram(object):
+    """
+    Histogram() -> new instance
+
+    A log-bucketed histogram of durations (or other nonnegative quantities),
+    as used by Statistics.
+
+    Every power of two between 2**MIN_EXP and 2**MAX_EXP is split into
+    SUBBUCKETS buckets of equal width, so that recording a value costs only
+    a few arithmetic operations and quantiles are accurate to within
+    1/SUBBUCKETS of the value; smaller and larger values are counted in the
+    first and last buckets, respectively. The count and total attributes
+    hold the amount and the sum of the values recorded.
+    """
+
+    SUBBUCKETS = 4
+    MIN_EXP = -24
+    MAX_EXP = 8
+
+    def __init__(self):
+        "Instance initializer; see class docstring for details."
+        self.counts = [0] * ((self.MAX_EXP - self.MIN_EXP) * self.SUBBUCKETS)
+        self.count = 0
+        self.total = 0.0
+
+    def add(self, value):
+        """
+        Record a single value.
+        """
+        mantissa, exponent = math.frexp(value)
+        if value <= 0 or exponent < self.MIN_EXP:
+            index = 0
+        elif exponent >= self.MAX_EXP:
+            index = len(self.counts) - 1
+        else:
+            index = ((exponent - self.MIN_EXP) * self.SUBBUCKETS +
+                     int((mantissa - 0.5) * 2 * self.SUBBUCKETS))
+        self.counts[index] += 1
+        self.count += 1
+        self.total += value
+
+    def merge(self, other):
+        """
+        Add the values recorded by other to this histogram.
+        """
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.total += other.total
+
+    def bound(self, index):
+        """
+        Return the upper bound of the values counted in the given bucket.
+        """
+        exponent, sub = divmod(index, self.SUBBUCKETS)
+        return math.ldexp(0.5 + (sub + 1) / (2.0 * self.SUBBUCKETS),
+                          exponent + self.MIN_EXP)
+
+    def quantile(self, q):
+        """
+        Return an upper bound for the q-quantile (0 <= q <= 1) of the values
+        recorded, or zero if there are none.
+        """
+        if not self.count: return 0.0
+        rank, seen = q * self.count, 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank: return self.bound(index)
+        return self.bound(len(self.counts) - 1)
+
+    def summary(self, prefix, scale=1000.0):
+        """
+        Return a mapping of textual summary values (with keys starting with
+        prefix) suitable for Statistics.report().
+
+        Durations are reported in milliseconds (as per the default scale).
+        """
+        mean = self.total / self.count if self.count else 0.0
+        return {prefix + 'count': str(self.count),
+                prefix + 'mean': '%.6f' % (mean * scale),
+                prefix + 'p50': '%.6f' % (self.quantile(0.5) * scale),
+                prefix + 'p99': '%.6f' % (self.quantile(0.99) * scale),
+                prefix + 'p999': '%.6f' % (self.quantile(0.999) * scale),
+                prefix + 'max': '%.6f' % (self.quantile(1) * scale)}
+
+class Statistics(object):
+    """
+    Statistics() -> new instance
+
+    A collection of performance counters for a DataStoreServer.
+
+    The ops attribute maps command codes of the remote API to
+    [count, errors, Histogram of durations] lists; lock_wait and lock_hold
+    are Histograms of the times spent waiting for and holding datastore
+    locks on behalf of clients; bytes_in and bytes_out count the amounts of
+    bytes transferred (before compression); compression holds counters as
+    found in Codec.compression_stats.
+
+    Instances are not thread-safe; every ClientHandler maintains its own
+    instance, and DataStoreServer.statistics() merges them.
+    """
+
+    def __init__(self):
+        "Instance initializer; see class docstring for details."
+        self.ops = {}
+        self.lock_wait = Histogram()
+        self.lock_hold = Histogram()
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.compression = {}
+
+    def record(self, cmd, duration, failed=False):
+        """
+        Record the execution of a command.
+        """
+        entry = self.ops.get(cmd)
+        if entry is None:
+            entry = self.ops[cmd] = [0, 0, Histogram()]
+        entry[0] += 1
+        if failed: entry[1] += 1
+        entry[2].add(duration)
+
+    def merge(self, other):
+        """
+        Add the counters of other to this instance.
+        """
+        for cmd, (count, errors, hist) in list(other.ops.items()):
+            entry = self.ops.get(cmd)
+            if entry is None:
+                entry = self.ops[cmd] = [0, 0, Histogram()]
+            entry[0] += count
+            entry[1] += errors
+            entry[2].merge(hist)
+        self.lock_wait.merge(other.lock_wait)
+        self.lock_hold.merge(other.lock_hold)
+        self.bytes_in += other.bytes_in
+        self.bytes_out += other.bytes_out
+        for key, value in other.compression.items():
+            self.compression[key] = self.compression.get(key, 0) + value
+
+    def report(self):
+        """
+        Return a mapping of textual values summarizing this instance.
+
+        The keys are of the form "op.NAME.FIELD" (where NAME is the name of
+        a command as found in COMMAND_NAMES), "lock.wait.FIELD",
+        "lock.hold.FIELD", "bytes.in"/"bytes.out", and "compression.FIELD"
+        (where FIELD is a key of Codec.compression_stats, with the times in
+        milliseconds, or one of "out_ratio" and "in_ratio", which are the
+        ratios of compressed to uncompressed sizes).
+        """
+        ret = {'bytes.in': str(self.bytes_in),
+               'bytes.out': str(self.bytes_out)}
+        comp = self.compression
+        for key, value in comp.items():
+            if key.endswith('_time'):
+                ret['compression.' + key] = '%.6f' % (value * 1000)
+            else:
+                ret['compression.' + key] = str(value)
+        for name, prefix in (('out_ratio', 'compressed_'),
+                             ('in_ratio', 'decompressed_')):
+            if comp.get(prefix + 'raw'):
+                ret['compression.' + name] = '%.6f' % (
+                    comp[prefix + 'wire'] / float(comp[prefix + 'raw']))
+        for cmd, (count, errors, hist) in sorted(self.ops.items()):
+            name = COMMAND_NAMES.get(cmd, repr(cmd))
+            ret.update(hist.summary('op.%s.' % name))
+            ret['op.%s.errors' % name] = str(errors)
+        ret.update(self.lock_wait.summary('lock.wait.'))
+        ret.update(self.lock_hold.summary('lock.hold.'))
+        return ret
+
+class HotKeyTracker(object):
+    """
+    HotKeyTracker(depths=(1,), sample=16, width=1024, rows=4, size=16)
+        -> new instance
+
+    A low-overhead estimator of the most frequently accessed paths of the
+    datastores of a DataStoreServer.
+
+    Only one in sample accesses passed to sample() is actually counted. For
+    every counted access, the prefixes of the path with the lengths given by
+    depths (as far as the path is long enough) are counted into a count-min
+    sketch (with the given amount of rows of width counters each) and the
+    size prefixes with the highest estimated counts are retained. Reads and
+    writes are tracked separately per datastore.
+
+    Instances are thread-safe.
+    """
+
+    class Sketch(object):
+        """
+        Sketch(width, rows, size) -> new instance
+
+        A count-min sketch with a top-k list, as used by HotKeyTracker.
+
+        The top attribute maps the (up to) size most frequent keys seen to
+        their estimated counts.
+        """
+
+        def __init__(self, width, rows, size):
+            "Instance initializer; see class docstring for details."
+            self.width = width
+            self.rows = [[0] * width for _ in range(rows)]
+            self.size = size
+            self.top = {}
+
+        def add(self, key):
+            """
+            Count an occurrence of key (which must be hashable) and update
+            the top-k list.
+            """
+            estimate = None
+            for seed, row in enumerate(self.rows):
+                index = hash((seed, key)) % self.width
+                row[index] += 1
+                if estimate is None or row[index] < estimate:
+                    estimate = row[index]
+            top = self.top
+            if key in top or len(top) < self.size:
+                top[key] = estimate
+            else:
+                victim = min(top, key=top.get)
+                if top[victim] < estimate:
+                    del top[victim]
+                    top[key] = estimate
+
+    def __init__(self, depths=(1,), sample=16, width=1024, rows=4, size=16):
+        "Instance initializer; see class docstring for details."
+        if not depths or min(depths) < 1 or sample < 1:
+            raise ValueError('Depths and sampling interval must be positive')
+        self.depths = tuple(sorted(set(depths)))
+        self.sample_interval = sample
+        self.width = width
+        self.rows = rows
+        self.size = size
+        self.sketches = {}
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+
+    def sample(self, dsname, kind, path):
+        """
+        Account for an access of the given kind ('r' or 'w', as in the
+        DataStore._OPERATIONS table) to path in the datastore named dsname.
+        """
+        if next(self._counter) % self.sample_interval: return
+        with self._lock:
+            sketch = self.sketches.get((dsname, kind))
+            if sketch is None:
+                sketch = self.Sketch(self.width, self.rows, self.size)
+                self.sketches[(dsname, kind)] = sketch
+            for depth in self.depths:
+                if depth > len(path): break
+                sketch.add(tuple(path[:depth]))
+
+    def report(self, clear=False):
+        """
+        Return a list of mappings of strings describing the hottest paths.
+
+        Each mapping has the keys "datastore", "kind" ("read" or "write"),
+        "depth", "path", and "count" (the estimated amount of accesses,
+        extrapolated from the sampled ones); the list is sorted by descending
+        count. If clear is true, all counts are reset afterwards.
+        """
+        with self._lock:
+            sketches = self.sketches
+            if clear: self.sketches = {}
+            entries = []
+            for (dsname, kind), sketch in sketches.items():
+                for path, count in sketch.top.items():
+                    entries.append((count, dsname, kind, path))
+        entries.sort(key=lambda e: (-e[0], e[1], e[2], e[3]))
+        return [{'datastore': dsname.decode('utf-8', 'replace'),
+                 'kind': 'read' if kind == 'r' else 'write',
+                 'depth': str(len(path)),
+                 'path': '/'.join(p.decode('utf-8', 'replace')
+                                  for p in path),
+                 'count': str(count * self.sample_interval)}
+                for count, dsname, kind, path in entries]
+
+class OperationEvent(object):
+    """
+    OperationEvent(source, cmd, start) -> new instance
+
+    A description of a remote API command, as passed to operation hooks (see
+    DataStoreServer.add_hook() and RemoteDataStore.add_hook()).
+
+    source is the DataStoreServer.ClientHandler or RemoteDataStore processing
+    the command; cmd is the command code (see COMMAND_NAMES); start is the
+    timer() value at which processing the command started.
+
+    Hooks run before a command only see these attributes; hooks run after a
+    command additionally see path (the path the command concerned, or None),
+    size_in and size_out (the amounts of bytes received and sent while
+    processing the command), duration (in seconds), result (the value
+    returned by the datastore operation, or None), and error (the HKVError
+    raised or reported, or None). For commands with the b'V' and b'w'
+    prefixes, cmd is updated to the code of the operation performed.
+    """
+
+    __slots__ = ('source', 'cmd', 'start', 'path', 'size_in', 'size_out',
+                 'duration', 'result', 'error')
+
+    def __init__(self, source, cmd, start):
+        "Instance initializer; see class docstring for details."
+        self.source = source
+        self.cmd = cmd
+        self.start = start
+        self.path = None
+        self.size_in = 0
+        self.size_out = 0
+        self.duration = None
+        self.result = None
+        self.error = None
+
+    @property
+    def name(self):
+        """
+        The name of the command as given by COMMAND_NAMES.
+        """
+        return COMMAND_NAMES.get(self.cmd, repr(self.cmd))
+
+class Capture(object):
+    """
+    Capture(file) -> new instance
+
+    A recording of the commands received by a DataStoreServer, for replaying
+    using main_replay().
+
+    file is a binary stream open for writing; MAGIC is written to it
+    immediately. It is followed by records, each of which is either b'F',
+    a timestamp, a connection ID, and a byte string holding a command frame
+    (the command code followed by its arguments, exactly as received by the
+    server), or b'X', a timestamp, and a connection ID (denoting that the
+    connection was closed). Timestamps are signed 64-bit integers counting
+    microseconds since the epoch; connection ID-s are unsigned 32-bit
+    integers. read() parses such a stream.
+
+    Instances are thread-safe; recording after close() has been called is
+    silently ignored.
+    """
+
+    MAGIC = b'HKVCAP\x00\x01'
+
+    class Tee(object):
+        """
+        Tee(file) -> new instance
+
+        A wrapper around a readable binary stream that retains everything
+        read from it in the data attribute (a list of byte strings), as used
+        by ClientHandler to record command frames.
+        """
+
+        def __init__(self, file):
+            "Instance initializer; see class docstring for details."
+            self.file = file
+            self.data = []
+
+        def read(self, size=-1):
+            """
+            Read from the underlying stream and retain the result.
+            """
+            ret = self.file.read(size)
+            self.data.append(ret)
+            return ret
+
+        def close(self):
+            """
+            Close the underlying stream.
+            """
+            self.file.close()
+
+    def __init__(self, file):
+        "Instance initializer; see class docstring for details."
+        self.file = file
+        self.codec = Codec(None, file)
+        self.codec.wfile.write(self.MAGIC)
+        self._lock = threading.Lock()
+
+    def record(self, connid, timestamp, frame):
+        """
+        Record a command frame received at the given time.
+        """
+        with self._lock:
+            if self.file is None: return
+            self.codec.writef('cqis', b'F', int(timestamp * 1e6), connid,
+                              frame)
+
+    def record_close(self, connid, timestamp):
+        """
+        Record that a connection was closed at the given time.
+        """
+        with self._lock:
+            if self.file is None: return
+            self.codec.writef('cqi', b'X', int(timestamp * 1e6), connid)
+
+    def close(self):
+        """
+        Flush and close the underlying stream.
+        """
+        with self._lock:
+            if self.file is None: return
+            try:
+                self.file.close()
+            finally:
+                self.file = None
+
+    @classmethod
+    def read(cls, file):
+        """
+        Parse a capture from the binary stream file.
+
+        This is a generator yielding (timestamp, connid, frame) tuples, where
+        timestamp is in seconds and frame is None for connection closes. A
+        truncated final record (as left behind by a server that did not shut
+        down cleanly) is ignored.
+        """
+        if file.read(len(cls.MAGIC)) != cls.MAGIC:
+            raise ValueError('Not a capture file')
+        codec = Codec(file, None)
+        while 1:
+            try:
+                kind = codec.read_char()
+                if kind == b'F':
+                    ts, connid, frame = codec.readf('qis')
+                elif kind == b'X':
+                    ts, connid = codec.readf('qi')
+                    frame = None
+                else:
+                    raise ValueError('Invalid capture record: %r' % kind)
+            except EOFError:
+                break
+            yield (ts / 1e6, connid, frame)
+
 class DataStoreServer(object):
     """
-    DataStoreServer(addr, addrfamily=None) -> new instance
+    DataStoreServer(addr, addrfamily=None, backlog=0, primary=None,
+                    primary_family=None, slowlog_threshold=None,
+                    slowlog_size=128, hotkeys=None, spill_dir=None,
+                    spill_after=3600) -> new instance
 
     The server part of remote datastores.
 
     addr is the socket address to bind to; addrfamily is the address family
     for it (defaulting to socket.AF_INET).
 
+    If backlog is nonzero, the server acts as a replication primary: it
+    records the last backlog modifications of its datastores in a
+    ReplicationLog, and streams them to replicas that connect to it. If
+    primary is not None, the server acts as a replica of the server at that
+    address (with the address family primary_family, defaulting to
+    socket.AF_INET): it keeps its datastores in sync with the primary's
+    using a Replica, and rejects modifying operations from its own clients
+    with READONLY errors. Chaining replicas is not supported.
+
+    If slowlog_threshold is not None, every command that takes at least that
+    many seconds to process, as well as every span of a client holding a
+    datastore lock for at least that long, is logged and recorded in the
+    slowlog attribute, a ring buffer retaining the last slowlog_size entries
+    (see record_slow() for details).
+
+    Callables registered using add_hook() are invoked with an OperationEvent
+    before and/or after every command processed by a ClientHandler. When no
+    hooks are registered, no events are created.
+
+    start_capture() makes the server record all commands it receives into a
+    Capture until stop_capture() is called.
+
+    hotkeys, if not None, is a HotKeyTracker that is informed about the path
+    of every datastore operation performed.
+
+    If spill_dir is not None, datastores that no client has had open for
+    spill_after seconds are written to files in that directory and removed
+    from memory by spill_idle() (which main() calls periodically); they are
+    loaded back transparently when they are used again. Files found in
+    spill_dir when the server is created are adopted as spilled
+    datastores. See spill() for details.
+
     In order to use a server, create an instance and call its main() method
     (potentially in a background thread).
     """
 
+    class ReplicationLog(object):
+        """
+        ReplicationLog(backlog) -> new instance
+
+        A bounded record of the modifications performed on the datastores of
+        a DataStoreServer.
+
+        backlog is the maximum amount of entries to retain. Every entry is
+        a (offset, timestamp, dsname, cmd, args) tuple, where offset is a
+        sequence number (starting from 1 and increasing by 1 with every
+        entry), timestamp is the time.time() at which the modification was
+        performed, dsname is the name of the modified datastore, cmd is the
+        DataStore operation code, and args are the operation's arguments;
+        the removal of a whole datastore is recorded with cmd and args being
+        None. The replid attribute is a random byte string identifying the log
+        (and thus its sequence of offsets).
+
+        Modifications must be recorded while the modified datastore is still
+        locked, so that the order of the log matches the order in which the
+        modifications were applied.
+        """
+
+        # Maximum interval (in seconds) between messages sent to replicas.
+        heartbeat = 1.0
+
+        def __init__(self, backlog):
+            "Instance initializer; see class docstring for details."
+            self.backlog = backlog
+            self.replid = binascii.hexlify(os.urandom(8))
+            self.offset = 0
+            self.entries = collections.deque(maxlen=backlog)
+            self.replicas = 0
+            self.lock = threading.Condition(threading.RLock())
+
+        def record(self, dsname, cmd, args):
+            """
+            Append an entry for a modification to the log.
+            """
+            with self.lock:
+                self.offset += 1
+                self.entries.append((self.offset, time.time(), dsname, cmd,
+                                     args))
+                self.lock.notify_all()
+
+        def since(self, offset):
+            """
+            Return a list of all entries whose offsets are at least offset.
+
+            If some of those entries have already been discarded, None is
+            returned instead. The caller must hold the lock of the log.
+            """
+            if offset > self.offset:
+                return []
+            elif not self.entries or self.entries[0][0] > offset:
+                return None
+            start = offset - self.entries[0][0]
+            return list(itertools.islice(self.entries, start, None))
+
+    class Replica(object):
+        """
+        Replica(parent, addr, addrfamily=None) -> new instance
+
+        A replication client keeping the datastores of a DataStoreServer in
+        sync with those of another server (the "primary").
+
+        parent is the DataStoreServer to be kept in sync; addr and addrfamily
+        denote the primary, as for RemoteDataStore.
+
+        The replica connects to the primary and asks it to replicate from the
+        last offset the replica has seen (if any); the primary continues from
+        there if its ReplicationLog still contains all entries after the
+        offset, and otherwise sends a full copy of its datastores (each taken
+        from a snapshot) before streaming entries. The replica reconnects
+        automatically if the connection is lost; its progress is kept in
+        memory only.
+
+        Normally, users do not need to instantiate this class directly;
+        DataStoreServer does that.
+        """
+
+        # Delay (in seconds) before reconnecting to the primary.
+        retry_delay = 1.0
+
+        def __init__(self, parent, addr, addrfamily=None):
+            "Instance initializer; see class docstring for details."
+            self.parent = parent
+            self.addr = addr
+            self.addrfamily = addrfamily
+            self.replid = b''
+            self.offset = -1
+            self.sync_point = 0
+            self.primary_offset = 0
+            self.connected = False
+            self.full_syncs = 0
+            self.partial_syncs = 0
+            self.applied = 0
+            self.lag = 0.0
+            self.last_contact = None
+            self.logger = logging.getLogger('replica')
+
+        def info(self):
+            """
+            Return a mapping of textual replication metrics.
+
+            offset is -1 while the replica has no consistent copy of the
+            primary's data; lag is the delay (in seconds) between the primary
+            performing the most recently applied modification and the
+            replica receiving it.
+            """
+            if self.last_contact is None:
+                contact_age = -1
+            else:
+                contact_age = time.time() - self.last_contact
+            lag_ops = max(self.primary_offset - max(self.offset, 0), 0)
+            return {'primary': '%s:%s' % self.addr[:2],
+                    'connected': str(int(self.connected)),
+                    'replid': self.replid.decode('ascii'),
+                    'offset': str(self.offset),
+                    'primary_offset': str(self.primary_offset),
+                    'lag_ops': str(lag_ops),
+                    'lag_seconds': '%.3f' % self.lag,
+                    'last_contact_age': '%.3f' % contact_age,
+                    'applied': str(self.applied),
+                    'full_syncs': str(self.full_syncs),
+                    'partial_syncs': str(self.partial_syncs)}
+
+        def main(self):
+            """
+            Run the main loop of this replica; this never returns.
+            """
+            while 1:
+                try:
+                    self.sync()
+                except (IOError, EOFError, ValueError, HKVError) as exc:
+                    self.logger.warning('Replication interrupted: %s', exc)
+                time.sleep(self.retry_delay)
+
+        def sync(self):
+            """
+            Connect to the primary and apply its modifications until the
+            connection breaks.
+            """
+            client = RemoteDataStore(self.addr, addrfamily=self.addrfamily)
+            client.connect()
+            try:
+                codec = client.codec
+                codec.writef('csq', b'R', self.replid, self.offset)
+                codec.flush()
+                resp = codec.read_char()
+                if resp == b'e':
+                    raise HKVError.for_code(codec.read_int())
+                elif resp == b'F':
+                    self.full_sync(codec)
+                elif resp == b'+':
+                    self.logger.info('Resuming replication from offset %s',
+                                     self.offset)
+                    self.sync_point = self.offset
+                    self.partial_syncs += 1
+                else:
+                    raise HKVError.for_name('NORESP')
+                self.connected = True
+                self.stream(codec)
+            finally:
+                self.connected = False
+                client.close()
+
+        def full_sync(self, codec):
+            """
+            Receive a full copy of the primary's datastores.
+
+            Local datastores the primary does not have are removed.
+            """
+            self.offset = -1
+            self.replid = codec.read_bytes()
+            self.logger.info('Performing full synchronization')
+            seen = set()
+            while 1:
+                tag = codec.read_char()
+                if tag == b'-':
+                    self.sync_point = codec.read_signed()
+                    break
+                elif tag != b'S':
+                    raise HKVError.for_name('NORESP')
+                name = codec.read_bytes()
+                self.parent.get_datastore(name).restore(codec)
+                seen.add(name)
+            with self.parent._lock:
+                stale = [name for name in (list(self.parent.datastores) +
+                                           list(self.parent.spilled))
+                         if name not in seen]
+                for name in stale:
+                    self.parent._discard(name)
+            self.full_syncs += 1
+            self.logger.info('Full synchronization done (consistent from '
+                             'offset %s)', self.sync_point)
+
+        def stream(self, codec):
+            """
+            Apply modifications streamed by the primary.
+
+            The replica's offset is only advanced once the primary has
+            progressed past the sync point (i.e. the offset as of which all
+            datastores received during a full synchronization are
+            consistent). Dropped datastores are removed regardless of
+            whether local clients have them open; such clients continue to
+            see the contents as of the drop.
+            """
+            while 1:
+                tag = codec.read_char()
+                now = self.last_contact = time.time()
+                if tag == b'M':
+                    offset, timestamp, name, cmd = codec.readf('qqsc')
+                    operation = DataStore._OPERATIONS.get(cmd)
+                    if operation is None:
+                        raise HKVError.for_name('NORESP')
+                    args = codec.readf(operation[0])
+                    datastore = self.parent.get_datastore(name)
+                    try:
+                        datastore._operations[cmd][1](*args)
+                    except HKVError as exc:
+                        self.logger.warning('Could not apply entry %s: %s',
+                                            offset, exc)
+                    self.applied += 1
+                    self.lag = max(now - timestamp / 1000.0, 0.0)
+                elif tag == b'D':
+                    offset, timestamp, name = codec.readf('qqs')
+                    with self.parent._lock:
+                        self.parent._discard(name)
+                    self.applied += 1
+                    self.lag = max(now - timestamp / 1000.0, 0.0)
+                elif tag == b'H':
+                    offset, timestamp = codec.readf('qq')
+                    self.primary_offset = offset
+                else:
+                    raise HKVError.for_name('NORESP')
+                if offset >= self.sync_point:
+                    self.offset = offset
+
     class ClientHandler(object):
         """
         ClientHandler(parent, id, conn, addr) -> new instance
@@ -854,10 +3875,21 @@ class DataStoreServer(object):
             self.id = id
             self.conn = conn
             self.addr = addr
+            disable_nagle(self.conn)
             self.codec = Codec(self.conn.makefile('rb'),
                                self.conn.makefile('wb'))
             self.datastore = None
+            self.dsname = None
+            self.snapshot = None
             self.locked = 0
+            self.lock_start = None
+            self.error = None
+            self.op_path = None
+            self.op_result = None
+            self.handles = {}
+            self.next_handle = 1
+            self.tee = None
+            self.stats = Statistics()
             self.logger = logging.getLogger('client/%s' % self.id)
 
         def init(self):
@@ -896,7 +3928,10 @@ class DataStoreServer(object):
             Do not call this is no datastore has been opened.
             """
             if self.locked == 0:
+                start = timer()
                 self.datastore.lock()
+                self.lock_start = timer()
+                self.stats.lock_wait.add(self.lock_start - start)
             self.locked += 1
 
         def unlock(self, full=False):
@@ -910,34 +3945,221 @@ class DataStoreServer(object):
             if full:
                 if self.locked > 0 and self.datastore:
                     self.datastore.unlock()
+                    self.lock_released()
                 self.locked = 0
             elif self.locked == 0:
                 raise HKVError.for_name('BADUNLOCK')
             elif self.locked == 1:
                 self.locked = 0
                 self.datastore.unlock()
+                self.lock_released()
             else:
                 self.locked -= 1
 
+        def lock_released(self):
+            """
+            Account for the underlying datastore having been unlocked.
+
+            Called by unlock().
+            """
+            held = timer() - self.lock_start
+            self.stats.lock_hold.add(held)
+            threshold = self.parent.slowlog_threshold
+            if threshold is not None and held >= threshold:
+                self.parent.record_slow(self, 'lock_hold', None, held, 0)
+
+        def detach(self):
+            """
+            Close the datastore this client handler has open (if any).
+
+            The datastore is fully unlocked, and any snapshot and handles
+            are discarded.
+            """
+            self.unlock(True)
+            if self.dsname is not None:
+                self.parent.detach_datastore(self.dsname)
+            self.datastore = None
+            self.dsname = None
+            self.snapshot = None
+            self.handles.clear()
+
         def write_error(self, exc):
             """
             Convenience method for writing an error message to the client.
 
             exc is either an error name, or a HKVError instance, or anything
             else. The corresponding error code is sent in the first two cases,
-            and a generic error in the latter case.
+            and a generic error in the latter case. The error attribute is set
+            to a corresponding HKVError.
             """
             if isinstance(exc, str):
-                code = ERRORS[exc][0]
-            elif isinstance(exc, HKVError):
-                code = exc.code
-            else:
-                code = ERRORS['UNKNOWN'][0]
-            self.codec.writef('ci', b'e', code)
+                exc = HKVError.for_name(exc)
+            elif not isinstance(exc, HKVError):
+                exc = HKVError.for_name('UNKNOWN')
+            self.error = exc
+            self.codec.writef('ci', b'e', exc.code)
 
-        def main(self):
+        def run_operation(self, cmd):
             """
-            Run the main loop of this client handler.
+            Read the arguments of a datastore operation, perform it, and
+            write its result to the client.
+
+            cmd is either a key of DataStore._OPERATIONS or one of the prefix
+            commands b'V' (which is followed by a reading operation whose
+            result is to be accompanied by the version of its path) and b'w'
+            (which is followed by a version and a modifying operation that is
+            only to be performed if its path has that version). Either of
+            these may in turn be preceded by the prefix command b'H' and a
+            handle number, in which case the operation's path is relative to
+            the handle. Returns the code of the operation actually performed.
+            """
+            kwds, handle_id = {}, None
+            try:
+                if cmd == b'H':
+                    handle_id = self.codec.read_int()
+                    cmd = self.codec.read_char()
+                if cmd == b'V':
+                    kwds['with_version'] = True
+                    cmd, kind = self.codec.read_char(), 'r'
+                elif cmd == b'w':
+                    kwds['if_version'] = self.codec.read_signed()
+                    cmd, kind = self.codec.read_char(), 'w'
+                else:
+                    kind = None
+                operation = DataStore._OPERATIONS.get(cmd)
+                if (operation is None or kind not in (None, operation[3]) or
+                        kwds and cmd == b'v'):
+                    raise HKVError.for_name('NOCMD')
+                args = self.codec.readf(operation[0])
+                self.op_path = args[0]
+                if self.datastore is None:
+                    raise HKVError.for_name('NOSTORE')
+                if handle_id is not None:
+                    handle = self.handles.get(handle_id)
+                    if handle is None: raise HKVError.for_name('BADHANDLE')
+                    args[0] = self.op_path = HandlePath(handle, args[0])
+                hotkeys = self.parent.hotkeys
+                if hotkeys is not None:
+                    hotkeys.sample(self.dsname, operation[3], args[0])
+                log = self.parent.replog
+                if operation[3] == 'r':
+                    if self.snapshot is not None:
+                        target = self.snapshot
+                    else:
+                        target = self.datastore
+                    result = target._operations[cmd][1](*args, **kwds)
+                elif self.parent.replica is not None:
+                    raise HKVError.for_name('READONLY')
+                elif log is not None:
+                    self.datastore.lock()
+                    try:
+                        func = self.datastore._operations[cmd][1]
+                        result = func(*args, **kwds)
+                        log.record(self.dsname, cmd, args)
+                    finally:
+                        self.datastore.unlock()
+                else:
+                    func = self.datastore._operations[cmd][1]
+                    result = func(*args, **kwds)
+            except HKVError as exc:
+                self.write_error(exc)
+                return cmd
+            self.op_result = result
+            if kwds.get('with_version'):
+                result, version = result
+                self.codec.writef('cq', b'v', version)
+            self.codec.write_char(operation[2].encode('ascii'))
+            self.codec.writef(operation[2], result)
+            return cmd
+
+        def serve_replica(self):
+            """
+            Stream the modifications of the server's datastores to a replica.
+
+            This takes over the connection until it breaks; see the Replica
+            class for details.
+            """
+            replid, offset = self.codec.readf('sq')
+            log = self.parent.replog
+            if log is None:
+                self.write_error('NOREPL')
+                return
+            with log.lock:
+                resumable = (replid == log.replid and
+                             log.since(offset + 1) is not None)
+                start = log.offset
+                log.replicas += 1
+            try:
+                if resumable:
+                    self.logger.info('Resuming replication from offset %s',
+                                     offset)
+                    self.codec.write_char(b'+')
+                    sync, position = {}, offset + 1
+                else:
+                    self.logger.info('Starting full synchronization')
+                    sync, position = self.send_full_sync(), start + 1
+                while 1:
+                    with log.lock:
+                        if log.offset < position: log.lock.wait(log.heartbeat)
+                        entries = log.since(position)
+                        current = log.offset
+                    if entries is None:
+                        self.logger.warning('Replica fell behind backlog')
+                        return
+                    for offset, timestamp, name, cmd, args in entries:
+                        if offset <= sync.get(name, 0): continue
+                        if cmd is None:
+                            self.codec.writef('cqqs', b'D', offset,
+                                              int(timestamp * 1000), name)
+                            continue
+                        self.codec.writef('cqqsc', b'M', offset,
+                                          int(timestamp * 1000), name, cmd)
+                        self.codec.writef('*' + DataStore._OPERATIONS[cmd][0],
+                                          args)
+                    position = current + 1
+                    self.codec.writef('cqq', b'H', current,
+                                      int(time.time() * 1000))
+                    self.codec.flush()
+            except IOError:
+                pass
+            finally:
+                with log.lock:
+                    log.replicas -= 1
+
+        def send_full_sync(self):
+            """
+            Send a full copy of the server's datastores to a replica.
+
+            Returns a mapping from datastore names to the offsets of the last
+            ReplicationLog entries included in the respective copies.
+            """
+            log = self.parent.replog
+            with self.parent._lock:
+                names = (list(self.parent.datastores) +
+                         list(self.parent.spilled))
+            self.codec.writef('cs', b'F', log.replid)
+            sync = {}
+            for name in names:
+                # Spilled datastores are loaded back for this; they will be
+                # spilled again in due course.
+                datastore = self.parent.get_datastore(name)
+                datastore.lock()
+                try:
+                    with log.lock:
+                        snapshot = datastore.snapshot()
+                        sync[name] = log.offset
+                finally:
+                    datastore.unlock()
+                self.codec.writef('cs', b'S', name)
+                snapshot.dump(self.codec)
+            with log.lock:
+                sync_point = max([log.offset] + list(sync.values()))
+            self.codec.writef('cq', b'-', sync_point)
+            return sync
+
+        def main(self):
+            """
+            Run the main loop of this client handler.
             """
             try:
                 while 1:
@@ -945,62 +4167,289 @@ class DataStoreServer(object):
                         cmd = self.codec.read_char()
                     except EOFError:
                         break
+                    start = timer()
+                    read_start = self.codec.bytes_read - 1
+                    written_start = self.codec.bytes_written
+                    self.error = None
+                    self.op_path = None
+                    self.op_result = None
+                    pre_hooks = self.parent.pre_hooks
+                    if pre_hooks:
+                        self.parent.run_hooks(pre_hooks,
+                                              OperationEvent(self, cmd, start))
+                    capture = self.parent.capture
+                    if capture is not None or self.tee is not None:
+                        frame_cmd = cmd
+                        self.update_capture(capture)
                     if cmd == b'q':
                         self.codec.write_char(b'-')
                         break
                     elif cmd == b'o':
-                        self.unlock(True)
                         name = self.codec.read_bytes()
-                        self.datastore = self.parent.get_datastore(name)
-                        self.codec.write_char(b'-')
+                        try:
+                            datastore = self.parent.attach_datastore(name)
+                        except HKVError as exc:
+                            self.write_error(exc)
+                        else:
+                            self.detach()
+                            self.datastore = datastore
+                            self.dsname = name
+                            self.codec.write_char(b'-')
                     elif cmd == b'x':
-                        self.unlock(True)
-                        self.datastore = None
+                        self.detach()
                         self.codec.write_char(b'-')
-                    elif cmd == b'b':
+                    elif cmd == b's':
                         if self.datastore is None:
                             self.write_error('NOSTORE')
-                        self.lock()
+                        else:
+                            self.snapshot = self.datastore.snapshot()
+                            self.codec.write_char(b'-')
+                    elif cmd == b'u':
+                        self.snapshot = None
                         self.codec.write_char(b'-')
+                    elif cmd == b'b':
+                        if self.datastore is None:
+                            self.write_error('NOSTORE')
+                        else:
+                            self.lock()
+                            self.codec.write_char(b'-')
                     elif cmd == b'f':
                         if self.datastore is None:
                             self.write_error('NOSTORE')
+                        else:
+                            try:
+                                self.unlock()
+                                self.codec.write_char(b'-')
+                            except HKVError as exc:
+                                self.write_error(exc)
+                    elif cmd in DataStore._OPERATIONS or cmd in b'VwH':
+                        cmd = self.run_operation(cmd)
+                    elif cmd == b'h':
+                        path = self.codec.read_bytelist()
                         try:
-                            self.unlock()
-                            self.codec.write_char(b'-')
+                            if self.datastore is None:
+                                raise HKVError.for_name('NOSTORE')
+                            handle = self.datastore.handle(path)
                         except HKVError as exc:
                             self.write_error(exc)
-                    elif cmd in DataStore._OPERATIONS:
+                        else:
+                            self.handles[self.next_handle] = handle
+                            self.codec.writef('ci', b'i', self.next_handle)
+                            self.next_handle += 1
+                    elif cmd == b'j':
+                        if self.handles.pop(self.codec.read_int(), None):
+                            self.codec.write_char(b'-')
+                        else:
+                            self.write_error('BADHANDLE')
+                    elif cmd == b'N':
+                        self.negotiate(ord(self.codec.read_char()))
+                    elif cmd == b'z':
+                        method, threshold = self.codec.readf('si')
+                        self.compress(method.decode('ascii', 'replace') or
+                                      None, threshold)
+                    elif cmd == b'R':
+                        self.serve_replica()
+                        break
+                    elif cmd == b'Y':
+                        info = self.parent.replication_info()
+                        self.codec.writef('cm', b'm',
+                            {k.encode('ascii'): v.encode('utf-8')
+                             for k, v in info.items()})
+                    elif cmd == b'I':
+                        info = self.parent.statistics()
+                        self.codec.writef('cm', b'm',
+                            {k.encode('ascii'): v.encode('utf-8')
+                             for k, v in info.items()})
+                    elif cmd == b'L':
+                        clear = self.codec.read_int()
+                        entries = list(self.parent.slowlog)
+                        if clear: self.parent.slowlog.clear()
+                        self.codec.writef('cM', b'M',
+                            [{k.encode('ascii'): v.encode('utf-8')
+                              for k, v in e.items()} for e in entries])
+                    elif cmd == b'K':
+                        clear = self.codec.read_int()
+                        if self.parent.hotkeys is None:
+                            self.write_error('NOHOTKEYS')
+                        else:
+                            entries = self.parent.hotkeys.report(clear)
+                            self.codec.writef('cM', b'M',
+                                [{k.encode('ascii'): v.encode('utf-8')
+                                  for k, v in e.items()} for e in entries])
+                    elif cmd == b'E':
+                        entries = self.parent.list_datastores()
+                        self.codec.writef('cM', b'M',
+                            [{k.encode('ascii'): v.encode('utf-8')
+                              for k, v in e.items()} for e in entries])
+                    elif cmd == b'U':
+                        name = self.codec.read_bytes()
+                        if name == self.dsname: self.detach()
                         try:
-                            operation = DataStore._OPERATIONS[cmd]
-                            args = self.codec.readf(operation[0])
-                            if self.datastore is None:
-                                raise HKVError.for_name('NOSTORE')
-                            result = self.datastore._operations[cmd][1](*args)
+                            self.parent.drop_datastore(name)
                         except HKVError as exc:
                             self.write_error(exc)
                         else:
-                            resp = operation[2].encode('ascii')
-                            self.codec.write_char(resp)
-                            self.codec.writef(operation[2], result)
+                            self.codec.write_char(b'-')
                     else:
                         self.write_error('NOCMD')
                     self.codec.flush()
+                    elapsed = timer() - start
+                    self.stats.record(cmd, elapsed, self.error is not None)
+                    threshold = self.parent.slowlog_threshold
+                    if threshold is not None and elapsed >= threshold:
+                        size = (self.codec.bytes_read - read_start +
+                                self.codec.bytes_written - written_start)
+                        self.parent.record_slow(self,
+                            COMMAND_NAMES.get(cmd, repr(cmd)), self.op_path,
+                            elapsed, size)
+                    post_hooks = self.parent.post_hooks
+                    if post_hooks:
+                        event = OperationEvent(self, cmd, start)
+                        event.path = self.op_path
+                        event.size_in = self.codec.bytes_read - read_start
+                        event.size_out = (self.codec.bytes_written -
+                                          written_start)
+                        event.duration = elapsed
+                        event.result = self.op_result
+                        event.error = self.error
+                        self.parent.run_hooks(post_hooks, event)
+                    if self.tee is not None:
+                        capture.record(self.id, time.time() - elapsed,
+                                       frame_cmd + b''.join(self.tee.data))
+            except (EOFError, IOError) as exc:
+                # The client went away in the middle of a command (e.g. an
+                # aborted put_stream()); whatever it had sent is discarded.
+                self.logger.info('Connection broken: %s', exc)
             finally:
-                self.codec.flush()
-                self.unlock(True)
+                if self.tee is not None:
+                    self.tee = None
+                    capture = self.parent.capture
+                    if capture is not None:
+                        capture.record_close(self.id, time.time())
+                try:
+                    self.codec.flush()
+                except IOError:
+                    pass
+                self.detach()
                 self.close()
+                self.parent.retire(self)
+
+        def negotiate(self, protocol):
+            """
+            Answer a protocol negotiation request from the client, which
+            supports protocol versions up to the given one.
+
+            The response (a mapping of capabilities, including the chosen
+            protocol version) is written in the current version of the wire
+            format; everything afterwards uses the chosen one. Called by
+            main().
+            """
+            protocol = max(1, min(protocol, PROTOCOL))
+            methods = ','.join(sorted(COMPRESSION_METHODS))
+            self.codec.writef('cm', b'm',
+                              {b'protocol': str(protocol).encode('ascii'),
+                               b'compression': methods.encode('ascii')})
+            self.codec.flush()
+            self.codec.set_protocol(protocol)
+
+        def compress(self, method, threshold):
+            """
+            Answer a request to enable transport compression using method
+            (or to disable it if method is None), where threshold is the
+            minimum size of frames to compress.
+
+            The response is written before the switch. Called by main().
+            """
+            if method is not None and method not in COMPRESSION_METHODS:
+                self.write_error('BADCOMPRESS')
+                return
+            self.codec.write_char(b'-')
+            self.codec.flush()
+            # When recording, the capture must see the data after
+            # decompression.
+            tee = self.tee
+            if tee is not None: self.codec.rfile = tee.file
+            self.codec.set_compression(method, threshold)
+            if tee is not None:
+                tee.file = self.codec.rfile
+                self.codec.rfile = tee
+
+        def update_capture(self, capture):
+            """
+            Prepare recording the current command into capture (or stop
+            recording if capture is None).
 
-    def __init__(self, addr, addrfamily=None):
+            When recording starts, synthetic commands switching to the
+            connection's protocol version and compression method and opening
+            its datastore (if any) are recorded first. Called by main().
+            """
+            if capture is None:
+                self.codec.rfile = self.tee.file
+                self.tee = None
+                return
+            if self.tee is None:
+                self.tee = Capture.Tee(self.codec.rfile)
+                self.codec.rfile = self.tee
+                protocol = self.codec.protocol
+                if protocol != 1:
+                    capture.record(self.id, time.time(),
+                                   b'N' + struct.pack('B', protocol))
+                if self.codec.compression is not None:
+                    buf = io.BytesIO()
+                    Codec(None, buf, protocol).writef('csi', b'z',
+                        self.codec.compression.encode('ascii'),
+                        self.codec.compress_threshold)
+                    capture.record(self.id, time.time(), buf.getvalue())
+                if self.dsname is not None:
+                    buf = io.BytesIO()
+                    Codec(None, buf, protocol).writef('cs', b'o',
+                                                      self.dsname)
+                    capture.record(self.id, time.time(), buf.getvalue())
+            self.tee.data = []
+
+        def statistics(self):
+            """
+            Return the Statistics of this client handler, including the byte
+            counts of its Codec.
+            """
+            self.stats.bytes_in = self.codec.bytes_read
+            self.stats.bytes_out = self.codec.bytes_written
+            self.stats.compression = dict(self.codec.compression_stats)
+            return self.stats
+
+    def __init__(self, addr, addrfamily=None, backlog=0, primary=None,
+                 primary_family=None, slowlog_threshold=None,
+                 slowlog_size=128, hotkeys=None, spill_dir=None,
+                 spill_after=3600):
         "Instance initializer; see the class docstring for details."
         if addrfamily is None: addrfamily = socket.AF_INET
         self.addr = addr
         self.addrfamily = addrfamily
         self.socket = None
         self.datastores = {}
+        self.spilled = {}
+        self.spill_dir = spill_dir
+        self.spill_after = spill_after
+        self.replog = self.ReplicationLog(backlog) if backlog else None
+        if primary is None:
+            self.replica = None
+        else:
+            self.replica = self.Replica(self, primary, primary_family)
+        self.handlers = set()
+        self.stats = Statistics()
+        self.slowlog_threshold = slowlog_threshold
+        self.slowlog = collections.deque(maxlen=slowlog_size)
+        self.pre_hooks = []
+        self.post_hooks = []
+        self.capture = None
+        self.hotkeys = hotkeys
+        self.started = time.time()
         self._next_id = 1
+        self._attached = {}
+        self._used = {}
         self._lock = threading.RLock()
         self.logger = logging.getLogger('server')
+        if spill_dir is not None: self._adopt_spilled()
 
     def listen(self):
         """
@@ -1023,6 +4472,8 @@ class DataStoreServer(object):
         conn, addr = self.socket.accept()
         handler = self.ClientHandler(self, self._next_id, conn, addr)
         self._next_id += 1
+        with self._lock:
+            self.handlers.add(handler)
         handler.init()
         spawn_thread(handler.main)
 
@@ -1039,25 +4490,414 @@ class DataStoreServer(object):
         except Exception:
             pass
 
+    def add_hook(self, pre=None, post=None):
+        """
+        Register callables to be invoked around every command processed.
+
+        pre (if not None) is called with an OperationEvent before a command's
+        arguments are read; post (if not None) is called with a completed
+        OperationEvent after the command's response has been sent. Hooks run
+        in the thread of the ClientHandler processing the command; exceptions
+        raised by them are logged and otherwise ignored.
+        """
+        with self._lock:
+            if pre is not None:
+                self.pre_hooks = self.pre_hooks + [pre]
+            if post is not None:
+                self.post_hooks = self.post_hooks + [post]
+
+    def remove_hook(self, pre=None, post=None):
+        """
+        Unregister callables previously registered using add_hook().
+        """
+        with self._lock:
+            if pre is not None:
+                self.pre_hooks = [h for h in self.pre_hooks if h != pre]
+            if post is not None:
+                self.post_hooks = [h for h in self.post_hooks
+                                   if h != post]
+
+    def start_capture(self, file):
+        """
+        Start recording all commands received into a Capture writing to the
+        binary stream file.
+
+        Any capture already in progress is stopped.
+        """
+        self.stop_capture()
+        self.logger.info('Starting capture')
+        self.capture = Capture(file)
+
+    def stop_capture(self):
+        """
+        Stop recording commands and close the capture file (if any).
+        """
+        capture, self.capture = self.capture, None
+        if capture is not None:
+            self.logger.info('Stopping capture')
+            capture.close()
+
+    def run_hooks(self, hooks, event):
+        """
+        Invoke each of hooks with event, logging any exceptions raised.
+
+        Called by ClientHandler.
+        """
+        for hook in hooks:
+            try:
+                hook(event)
+            except Exception:
+                self.logger.exception('Operation hook %r failed', hook)
+
+    def record_slow(self, handler, opname, path, duration, size):
+        """
+        Record a slow operation in the slowlog and log it.
+
+        handler is the ClientHandler that performed the operation; opname is
+        the name of the operation (as in COMMAND_NAMES, or "lock_hold" for a
+        span of holding a datastore lock); path is the path the operation
+        concerned (or None); duration is the time (in seconds) the operation
+        took; size is the amount of bytes the operation transferred. Entries
+        are mappings of strings with the keys "time", "duration" (in
+        milliseconds), "client", "addr", "datastore", "op", "path", and
+        "size".
+        """
+        if path is None:
+            path = ''
+        else:
+            path = '/'.join(p.decode('utf-8', 'replace') for p in path)
+        if handler.dsname is None:
+            dsname = ''
+        else:
+            dsname = handler.dsname.decode('utf-8', 'replace')
+        entry = {'time': '%.3f' % time.time(),
+                 'duration': '%.3f' % (duration * 1000),
+                 'client': str(handler.id),
+                 'addr': '%s:%s' % tuple(handler.addr[:2]),
+                 'datastore': dsname, 'op': opname, 'path': path,
+                 'size': str(size)}
+        self.slowlog.append(entry)
+        self.logger.warning('Slow %s by client %s (%s) on %r path %r: %s ms, '
+            '%s bytes', opname, entry['client'], entry['addr'], dsname,
+            path, entry['duration'], size)
+
+    def retire(self, handler):
+        """
+        Remove a closed client handler, retaining its statistics.
+
+        Called by ClientHandler.
+        """
+        with self._lock:
+            self.handlers.discard(handler)
+            self.stats.merge(handler.statistics())
+
+    def statistics(self):
+        """
+        Return a mapping of textual performance metrics of this server.
+
+        Aside from the keys described in Statistics.report() (covering all
+        connections ever served), the result includes general information
+        ("server.*"), the key, node, and byte counts of every datastore
+        ("datastore.NAME.*"; see DataStore.measure()), and the replication
+        state ("replication.*"; see replication_info()).
+        """
+        total = Statistics()
+        with self._lock:
+            total.merge(self.stats)
+            handlers = list(self.handlers)
+            datastores = list(self.datastores.items())
+        for handler in handlers:
+            total.merge(handler.statistics())
+        ret = {'server.uptime': '%.3f' % (time.time() - self.started),
+               'server.connections.active': str(len(handlers)),
+               'server.connections.total': str(self._next_id - 1),
+               'server.datastores': str(len(datastores)),
+               'server.datastores.spilled': str(len(self.spilled))}
+        ret.update(total.report())
+        for name, datastore in sorted(datastores):
+            prefix = 'datastore.%s.' % name.decode('utf-8', 'replace')
+            for k, v in datastore.measure().items():
+                ret[prefix + k] = str(v)
+        for k, v in self.replication_info().items():
+            ret['replication.' + k] = v
+        return ret
+
     def get_datastore(self, name):
         """
         Retrieve a datastore for the given name or return a new one.
 
-        Used by ClientHandler.
+        A datastore that has been spilled is loaded back (while holding the
+        server's lock); if that fails, the error is logged and an UNKNOWN
+        error is raised. Used by ClientHandler and Replica.
         """
         with self._lock:
+            self._used[name] = time.time()
             try:
                 return self.datastores[name]
             except KeyError:
+                pass
+            if name in self.spilled:
+                try:
+                    ret = self._read_spilled(name)[1]
+                except (IOError, ValueError, EOFError):
+                    self.logger.exception('Could not load spilled datastore '
+                                          '%r', name)
+                    raise HKVError.for_name('UNKNOWN')
+                os.remove(self._spill_path(name))
+                del self.spilled[name]
+                self.logger.info('Loaded spilled datastore %r', name)
+            else:
                 ret = DataStore()
-                self.datastores[name] = ret
-                return ret
+            self.datastores[name] = ret
+            return ret
+
+    def attach_datastore(self, name):
+        """
+        Retrieve a datastore as get_datastore() does and record that a
+        client has it open.
+
+        Datastores that clients have open are never spilled or dropped.
+        Used by ClientHandler.
+        """
+        with self._lock:
+            ret = self.get_datastore(name)
+            self._attached[name] = self._attached.get(name, 0) + 1
+            return ret
+
+    def detach_datastore(self, name):
+        """
+        Record that a client no longer has the given datastore open.
+
+        Used by ClientHandler.
+        """
+        with self._lock:
+            count = self._attached.pop(name, 0) - 1
+            if count > 0: self._attached[name] = count
+            self._used[name] = time.time()
+
+    def list_datastores(self):
+        """
+        Return a list of mappings describing the datastores of this server.
+
+        The keys and values of the mappings are strings; the keys are "name",
+        "state" (either "memory" or "spilled"), "clients" (the amount of
+        clients having the datastore open), "idle" (the time in seconds
+        since the datastore was last used, or zero if clients have it
+        open), and those of DataStore.measure() (which, for spilled
+        datastores, describe them as of spilling).
+        """
+        now = time.time()
+        with self._lock:
+            entries = [(name, 'memory', ds) for name, ds in
+                       self.datastores.items()]
+            entries.extend((name, 'spilled', sizes) for name, sizes in
+                           self.spilled.items())
+            attached, used = dict(self._attached), dict(self._used)
+        ret = []
+        for name, state, info in sorted(entries):
+            sizes = info.measure() if state == 'memory' else info
+            clients = attached.get(name, 0)
+            idle = 0 if clients else now - used.get(name, self.started)
+            entry = {'name': name.decode('utf-8', 'replace'),
+                     'state': state, 'clients': str(clients),
+                     'idle': '%.3f' % idle}
+            entry.update((k, str(v)) for k, v in sizes.items())
+            ret.append(entry)
+        return ret
+
+    def drop_datastore(self, name):
+        """
+        Remove the datastore with the given name, whether it is in memory or
+        spilled.
+
+        Raises a BUSY error if clients have the datastore open, a NODATASTORE
+        error if there is no such datastore, and a READONLY error if this
+        server is a replica. If this server is a replication primary, the
+        datastore is removed from the replicas as well.
+        """
+        if self.replica is not None:
+            raise HKVError.for_name('READONLY')
+        with self._lock:
+            if self._attached.get(name):
+                raise HKVError.for_name('BUSY')
+            if not self._discard(name):
+                raise HKVError.for_name('NODATASTORE')
+            if self.replog is not None:
+                self.replog.record(name, None, None)
+        self.logger.info('Dropped datastore %r', name)
+
+    def _discard(self, name):
+        """
+        Internal helper method.
+
+        Remove the datastore with the given name from memory or from
+        spill_dir and return whether there was one. The caller must hold the
+        server's lock.
+        """
+        if name in self.datastores:
+            del self.datastores[name]
+        elif name in self.spilled:
+            del self.spilled[name]
+            os.remove(self._spill_path(name))
+        else:
+            return False
+        self._used.pop(name, None)
+        return True
+
+    def _spill_path(self, name):
+        "Internal helper method."
+        filename = binascii.hexlify(name).decode('ascii') + '.hkv'
+        return os.path.join(self.spill_dir, filename)
+
+    def _read_spilled(self, name, sizes_only=False, path=None):
+        """
+        Internal helper method.
+
+        Returns a (sizes, datastore) pair read from the file of a spilled
+        datastore (or from path if that is not None), where datastore is
+        None if sizes_only is true.
+        """
+        if path is None: path = self._spill_path(name)
+        with open(path, 'rb') as f:
+            codec = Codec(f, None, 2)
+            codec.set_compression('zlib')
+            sizes = dict((k.decode('ascii'), int(v))
+                         for k, v in codec.read_bytedict().items())
+            if sizes_only: return (sizes, None)
+            ret = DataStore()
+            ret.restore(codec)
+            return (sizes, ret)
+
+    def _adopt_spilled(self):
+        "Internal helper method."
+        if not os.path.isdir(self.spill_dir): os.makedirs(self.spill_dir)
+        for filename in os.listdir(self.spill_dir):
+            stem, ext = os.path.splitext(filename)
+            if ext != '.hkv': continue
+            try:
+                name = binascii.unhexlify(stem.encode('ascii'))
+                self.spilled[name] = self._read_spilled(name, True)[0]
+            except (TypeError, ValueError, IOError, EOFError):
+                self.logger.warning('Ignoring invalid spill file %r',
+                                    filename)
+
+    def spill(self, name):
+        """
+        Write the datastore with the given name to a file in spill_dir and
+        remove it from memory.
+
+        The file consists of the DataStore.measure() of the datastore and a
+        DataStore.dump(), written using a Codec with version 2 of the wire
+        format and zlib compression. The datastore is written from a
+        snapshot, so that it remains usable meanwhile; if a client opens or
+        modifies it in the meantime, or if clients have it open to begin
+        with, the spill is abandoned. The file is read back and checked
+        against the datastore before the latter is removed from memory; if
+        that fails, the file is discarded and a ValueError (or the error
+        encountered while reading) is raised. Returns whether the datastore
+        was spilled.
+        """
+        with self._lock:
+            datastore = self.datastores.get(name)
+            if datastore is None or self._attached.get(name): return False
+            with datastore._lock:
+                clock = datastore._clock
+                indexes = tuple(datastore._indexes)
+                snapshot = datastore.snapshot()
+                # Snapshots do not carry the contents of the secondary
+                # indexes; the spill is abandoned below if the data or the
+                # set of indexes change afterwards.
+                sizes = datastore.measure()
+        path = self._spill_path(name)
+        temp = path + '.tmp'
+        with open(temp, 'wb') as f:
+            codec = Codec(None, f, 2)
+            codec.set_compression('zlib')
+            codec.write_bytedict(dict((k.encode('ascii'),
+                                       str(v).encode('ascii'))
+                                      for k, v in sizes.items()))
+            snapshot.dump(codec)
+            codec.flush()
+        try:
+            stored, restored = self._read_spilled(name, path=temp)
+            if stored != sizes or restored.measure() != sizes:
+                raise ValueError('Spill file does not match datastore')
+        except Exception:
+            os.remove(temp)
+            raise
+        with self._lock:
+            if (self.datastores.get(name) is not datastore or
+                    self._attached.get(name) or datastore._clock != clock or
+                    tuple(datastore._indexes) != indexes):
+                os.remove(temp)
+                return False
+            os.rename(temp, path)
+            del self.datastores[name]
+            self.spilled[name] = sizes
+        self.logger.info('Spilled datastore %r (%s bytes)', name,
+                         sizes['bytes'])
+        return True
+
+    def spill_idle(self):
+        """
+        Spill every datastore that no client has had open for spill_after
+        seconds.
+
+        Returns the amount of datastores spilled; failures are logged. See
+        spill() for details.
+        """
+        now = time.time()
+        with self._lock:
+            names = [name for name in self.datastores
+                     if not self._attached.get(name) and
+                     now - self._used.get(name, self.started) >=
+                     self.spill_after]
+        count = 0
+        for name in names:
+            try:
+                if self.spill(name): count += 1
+            except (IOError, OSError, ValueError, EOFError):
+                self.logger.exception('Could not spill datastore %r', name)
+        return count
+
+    def replication_info(self):
+        """
+        Return a mapping describing the replication state of this server.
+
+        The keys and values are strings; the keys of the Replica.info()
+        mapping are included with a "replica_" prefix if this server is a
+        replica.
+        """
+        ret = {}
+        if self.replog is not None:
+            log = self.replog
+            with log.lock:
+                first = log.entries[0][0] if log.entries else log.offset + 1
+                ret.update(role='primary', replid=log.replid.decode('ascii'),
+                           offset=str(log.offset), backlog=str(log.backlog),
+                           backlog_first=str(first),
+                           replicas=str(log.replicas))
+        if self.replica is not None:
+            ret['role'] = 'replica'
+            for k, v in self.replica.info().items():
+                ret['replica_' + k] = v
+        ret.setdefault('role', 'standalone')
+        return ret
+
+    def _spill_loop(self):
+        "Internal helper method; calls spill_idle() periodically."
+        interval = min(max(self.spill_after / 4.0, 1), 60)
+        while 1:
+            time.sleep(interval)
+            self.spill_idle()
 
     def main(self):
         """
         Run the main loop of the server.
         """
         self.listen()
+        if self.replica is not None: spawn_thread(self.replica.main)
+        if self.spill_dir is not None: spawn_thread(self._spill_loop)
         try:
             while 1:
                 try:
@@ -1069,44 +4909,156 @@ class DataStoreServer(object):
 
 class RemoteDataStore(BaseDataStore):
     """
-    RemoteDataStore(addr, dsname=None, addrfamily=None) -> new instance
+    RemoteDataStore(addr, dsname=None, addrfamily=None, protocol=PROTOCOL,
+                    compression=None, compress_threshold=COMPRESS_THRESHOLD)
+        -> new instance
 
     A proxy for a remote datastore.
 
     addr is the socket address to connect to; dsname is the name of the remote
     datastore to use (if omitted, a datastore must be explicitly opened using
     open() before use); addrfamily is the address family for the socket to be
-    created (defaulting to socket.AF_INET).
+    created (defaulting to socket.AF_INET); protocol is the highest version
+    of the wire format to negotiate with the server (see negotiate());
+    compression and compress_threshold configure transport compression (see
+    compress()), which is enabled if the server supports it.
 
     Prior to use, the connect() method has to be called; if no datastore name
     is configured when it is called, open() has to be called in addition after
     it but before use.
+
+    The snapshot() method is not supported; see begin_consistent_read() for
+    a remote equivalent.
+
+    Callables registered using add_hook() are invoked with an OperationEvent
+    around every command sent to the server.
+
+    The pipeline() and pipeline_calls() methods allow submitting a batch of
+    operations in a single round trip.
+
+    get_stream() occupies the connection until the reader it returns has
+    been read completely or closed.
     """
 
-    def __init__(self, addr, dsname=None, addrfamily=None):
+    class Deferred(Exception):
+        """
+        Deferred() -> new instance
+
+        Internal exception aborting the calls passed to pipeline_calls()
+        after they have sent their commands.
+        """
+
+    # Mapping from operation names to remote API command codes.
+    _OPCODES = dict((v[1], k) for k, v in DataStore._OPERATIONS.items())
+
+    def __init__(self, addr, dsname=None, addrfamily=None, protocol=PROTOCOL,
+                 compression=None, compress_threshold=COMPRESS_THRESHOLD):
         "Instance initializer; see the class docstring for details."
         if addrfamily is None: addrfamily = socket.AF_INET
         self.addr = addr
         self.dsname = dsname
         self.addrfamily = addrfamily
+        self.protocol = protocol
+        self.compression = compression
+        self.compress_threshold = compress_threshold
         self.socket = None
         self.codec = None
+        self.capabilities = {}
+        self.pre_hooks = []
+        self.post_hooks = []
+        self.logger = logging.getLogger('remote')
         self._lock = threading.RLock()
 
     def connect(self):
         """
         Establish a connection to the datastore server.
 
-        If the dsname attribute is not None, an open() call is automatically
-        performed after successfully connecting.
+        If the protocol attribute is greater than 1, the protocol version is
+        negotiated using negotiate(); if the compression attribute is not
+        None and the server supports the method it names, compress() is
+        called. If the dsname attribute is not None, an open() call is
+        automatically performed after successfully connecting.
         """
         if self.socket is not None: self.close()
         self.socket = socket.socket(self.addrfamily)
         self.socket.connect(self.addr)
+        disable_nagle(self.socket)
         self.codec = Codec(self.socket.makefile('rb'),
                            self.socket.makefile('wb'))
+        self.capabilities = {}
+        if self.protocol > 1: self.negotiate(self.protocol)
+        if (self.compression is not None and
+                self.compression in self.supported_compression()):
+            self.compress(self.compression, self.compress_threshold)
         if self.dsname is not None: self.open(self.dsname)
 
+    def negotiate(self, protocol=PROTOCOL):
+        """
+        Agree with the server on the version of the wire format to use.
+
+        The highest version supported by both sides that does not exceed
+        protocol is selected and used for everything sent or received
+        afterwards. Returns the capabilities reported by the server (a
+        mapping from byte strings to byte strings, including the selected
+        version as b'protocol'), which are also stored in the capabilities
+        attribute. Servers that do not support negotiation are detected, and
+        version 1 is used with them. Hooks are not invoked.
+        """
+        with self._lock:
+            try:
+                self.codec.write_char(b'N')
+                self.codec.write_char(struct.pack('B', protocol))
+                self.codec.flush()
+            except IOError as exc:
+                if exc.errno != errno.EPIPE: raise
+                raise HKVError.for_name('CONNBROKEN')
+            try:
+                try:
+                    info = self._read_response()
+                except HKVError as exc:
+                    if exc.code != ERRORS['NOCMD'][0]: raise
+                    # Servers predating negotiation reject the command and
+                    # then the version byte (which is never a valid command)
+                    # separately.
+                    try:
+                        self._read_response()
+                    except HKVError:
+                        pass
+                    info = {b'protocol': b'1'}
+            except EOFError:
+                raise HKVError.for_name('CONNBROKEN')
+            self.codec.set_protocol(int(info[b'protocol']))
+            self.capabilities = info
+            return info
+
+    def supported_compression(self):
+        """
+        Return a list of the transport compression methods supported by
+        both the server (as reported during negotiate()) and this side.
+        """
+        methods = self.capabilities.get(b'compression', b'')
+        return [m for m in methods.decode('ascii').split(',')
+                if m in COMPRESSION_METHODS]
+
+    def compress(self, method, threshold=COMPRESS_THRESHOLD):
+        """
+        Enable transport compression using method (or disable it if method
+        is None).
+
+        method must be one of the names returned by supported_compression();
+        otherwise, a BADCOMPRESS error is raised. Frames of at least
+        threshold bytes are compressed by both sides. The effect of the
+        compression is counted in the compression_stats attribute of the
+        codec attribute (and, on the server side, in the "compression.*"
+        statistics). Hooks are not invoked.
+        """
+        if method is not None and method not in self.supported_compression():
+            raise HKVError.for_name('BADCOMPRESS')
+        with self._lock:
+            encoded = method.encode('ascii') if method is not None else b''
+            self._transact(b'z', 'si', (encoded, threshold))
+            self.codec.set_compression(method, threshold)
+
     def open(self, dsname):
         """
         Open the named remote datastore.
@@ -1131,6 +5083,45 @@ class RemoteDataStore(BaseDataStore):
         except Exception:
             pass
 
+    def add_hook(self, pre=None, post=None):
+        """
+        Register callables to be invoked around every command.
+
+        pre (if not None) is called with an OperationEvent before a command is
+        sent; post (if not None) is called with a completed OperationEvent
+        after its response has been received (or an error occurred). Hooks
+        run in the thread issuing the command; exceptions raised by them are
+        logged and otherwise ignored.
+        """
+        with self._lock:
+            if pre is not None:
+                self.pre_hooks = self.pre_hooks + [pre]
+            if post is not None:
+                self.post_hooks = self.post_hooks + [post]
+
+    def remove_hook(self, pre=None, post=None):
+        """
+        Unregister callables previously registered using add_hook().
+        """
+        with self._lock:
+            if pre is not None:
+                self.pre_hooks = [h for h in self.pre_hooks if h != pre]
+            if post is not None:
+                self.post_hooks = [h for h in self.post_hooks
+                                   if h != post]
+
+    def run_hooks(self, hooks, event):
+        """
+        Invoke each of hooks with event, logging any exceptions raised.
+
+        Called by _run_command().
+        """
+        for hook in hooks:
+            try:
+                hook(event)
+            except Exception:
+                self.logger.exception('Operation hook %r failed', hook)
+
     def _run_command(self, cmd, format, *args):
         """
         Helper method for executing a remote API command.
@@ -1145,6 +5136,17 @@ class RemoteDataStore(BaseDataStore):
         response is an error or invalid, an HKVError exception is raised;
         otherwise, the value responded with is returned.
         """
+        if self.pre_hooks or self.post_hooks:
+            return self._run_hooked(cmd, format, args)
+        return self._transact(cmd, format, args)
+
+    def _transact(self, cmd, format, args):
+        """
+        Helper method for sending a command and receiving its response
+        without invoking hooks.
+
+        See _run_command() for details.
+        """
         with self._lock:
             try:
                 self.codec.write_char(cmd)
@@ -1154,45 +5156,346 @@ class RemoteDataStore(BaseDataStore):
                 if exc.errno != errno.EPIPE: raise
                 raise HKVError.for_name('CONNBROKEN')
             try:
-                resp = self.codec.read_char()
-                if resp == b'e':
-                    code = self.codec.read_int()
-                    raise HKVError.for_code(code)
-                elif resp in b'sam-':
-                    return self.codec.readf('@' + resp.decode('ascii'))
-                else:
-                    raise HKVError.for_name('NORESP')
+                return self._read_response()
             except EOFError:
                 raise HKVError.for_name('CONNBROKEN')
 
-    def _run_operation(self, opname, *args):
-        "Helper method performing a remote datastore operation."
-        operation = DataStore._OPERATIONS[opname]
-        return self._run_command(opname, operation[0], *args)
+    def _run_hooked(self, cmd, format, args):
+        """
+        Helper method for executing a remote API command while invoking the
+        registered hooks.
 
-    def lock_remote(self):
+        See _run_command() for details.
         """
-        Lock the remote datastore.
+        with self._lock:
+            event = OperationEvent(self, cmd, timer())
+            if self.pre_hooks: self.run_hooks(self.pre_hooks, event)
+            opargs = args
+            if event.cmd == b'H':
+                event.cmd, opargs = opargs[1], opargs[2:]
+            if event.cmd == b'V':
+                event.cmd, opargs = opargs[0], opargs[1:]
+            elif event.cmd == b'w':
+                event.cmd, opargs = opargs[1], opargs[2:]
+            if event.cmd in DataStore._OPERATIONS: event.path = opargs[0]
+            read_start = self.codec.bytes_read
+            written_start = self.codec.bytes_written
+            try:
+                event.result = self._transact(cmd, format, args)
+                return event.result
+            except HKVError as exc:
+                event.error = exc
+                raise
+            finally:
+                event.duration = timer() - event.start
+                event.size_in = self.codec.bytes_read - read_start
+                event.size_out = self.codec.bytes_written - written_start
+                if self.post_hooks: self.run_hooks(self.post_hooks, event)
 
-        Differently to lock(), this only performs the corresponding remote API
-        command and does not acquire this object's local lock in addition;
-        hence, multiple threads can use the object concurrently after this
-        has been called.
+    def _run_frame(self, frame):
         """
-        return self._run_command(b'b', '')
+        Helper method for sending a pre-encoded command frame (as recorded
+        in a Capture) and receiving its response.
 
-    def unlock_remote(self):
+        See _run_command() for details; hooks are not invoked.
         """
-        Unlock the remote datastore.
+        with self._lock:
+            try:
+                self.codec.wfile.write(frame)
+                self.codec.bytes_written += len(frame)
+                self.codec.flush()
+            except IOError as exc:
+                if exc.errno != errno.EPIPE: raise
+                raise HKVError.for_name('CONNBROKEN')
+            try:
+                return self._read_response()
+            except EOFError:
+                raise HKVError.for_name('CONNBROKEN')
 
-        See the nodes to lock_remote() for details.
+    def pipeline(self, operations):
         """
-        return self._run_command(b'f', '')
+        Perform a sequence of datastore operations in a single round trip.
+
+        operations is a sequence of (name, args) pairs, where name is the name
+        of a datastore method (such as "get" or "put_all") and args is a tuple
+        of positional arguments for it. All operations are sent before any
+        response is read. Returns a list of the results of the operations,
+        where an operation that failed has the HKVError describing the
+        failure in place of its result. Hooks are not invoked.
+        """
+        with self._lock:
+            try:
+                for name, args in operations:
+                    cmd = self._OPCODES[name]
+                    self.codec.write_char(cmd)
+                    self.codec.writef(DataStore._OPERATIONS[cmd][0], *args)
+                self.codec.flush()
+            except IOError as exc:
+                if exc.errno != errno.EPIPE: raise
+                raise HKVError.for_name('CONNBROKEN')
+            ret = []
+            try:
+                for _ in operations:
+                    try:
+                        ret.append(self._read_response())
+                    except HKVError as exc:
+                        if exc.code == ERRORS['NORESP'][0]: raise
+                        ret.append(exc)
+            except EOFError:
+                raise HKVError.for_name('CONNBROKEN')
+            return ret
 
-    def lock(self):
+    def pipeline_calls(self, calls):
+        """
+        Perform a sequence of arbitrary calls in a single round trip.
+
+        calls is a sequence of callables taking no arguments, each of which
+        performs exactly one remote API command using this object (possibly
+        through a wrapper such as a ConvertingDataStore) and returns a
+        result; get_stream() and pipeline() are not permitted. Every callable
+        is invoked twice: the first time, the command it performs is sent
+        but the callable is aborted (by raising a Deferred exception) instead
+        of waiting for the response; after all commands have been sent, every
+        callable is invoked once more, and the command it performs receives
+        the corresponding response instead of being sent again. Hence, the
+        callables should not have side effects beyond performing the
+        command.
+
+        Returns a list of the results of the calls, where a call that raised
+        an exception (other than a broken connection) has the exception in
+        place of its result. Hooks are not invoked. If sending or receiving
+        fails otherwise, this object is closed, as it cannot tell how far
+        the server has gotten.
+        """
+        def send(cmd, format, args):
+            # Encode into a side buffer first so that a command whose
+            # arguments fail to encode leaves nothing half-written.
+            buf = io.BytesIO()
+            encoder = Codec(None, buf, self.codec.protocol)
+            encoder.write_char(cmd)
+            encoder.writef(format, *args)
+            frame = buf.getvalue()
+            try:
+                self.codec.wfile.write(frame)
+                self.codec.bytes_written += len(frame)
+            except IOError as exc:
+                if exc.errno != errno.EPIPE: raise
+                raise HKVError.for_name('CONNBROKEN')
+            raise self.Deferred()
+        def receive(cmd, format, args):
+            if not waiting:
+                raise ValueError('Cannot pipeline more than one command '
+                    'per call')
+            waiting.pop()
+            try:
+                return self._read_response()
+            except EOFError:
+                raise HKVError.for_name('CONNBROKEN')
+        def divert(handler):
+            def run_command(cmd, format, *args):
+                return handler(cmd, format, args)
+            self._run_command = run_command
+            self._transact = handler
+        def invoke(call):
+            try:
+                return call()
+            except self.Deferred:
+                return self.Deferred
+            except IOError:
+                raise
+            except Exception as exc:
+                if getattr(exc, 'code', None) == ERRORS['CONNBROKEN'][0]:
+                    raise
+                return exc
+        with self._lock:
+            try:
+                divert(send)
+                results = [invoke(call) for call in calls]
+                self.codec.flush()
+                divert(receive)
+                for i, call in enumerate(calls):
+                    if results[i] is not self.Deferred: continue
+                    waiting = [True]
+                    results[i] = invoke(call)
+                    # Stay synchronized even if the call changed its mind.
+                    if waiting: invoke(lambda: receive(None, None, None))
+            except (IOError, HKVError):
+                self.close()
+                raise
+            finally:
+                del self._transact, self._run_command
+            return results
+
+    def _read_response(self):
+        """
+        Helper method for receiving and decoding a response.
+
+        See _run_command() for details. A versioned response (as triggered by
+        the b'V' prefix command) is returned as a (result, version) tuple.
+        """
+        resp = self.codec.read_char()
+        if resp == b'e':
+            code = self.codec.read_int()
+            raise HKVError.for_code(code)
+        elif resp == b'v':
+            version = self.codec.read_signed()
+            return (self._read_response(), version)
+        elif resp in b'samMiqQTAS-':
+            return self.codec.readf('@' + resp.decode('ascii'))
+        else:
+            raise HKVError.for_name('NORESP')
+
+    def _encode_operation(self, opname, args, kwds):
+        """
+        Helper method returning the command, format, and arguments (as for
+        _run_command()) that perform a remote datastore operation.
+
+        See _run_operation() for details.
+        """
+        operation = DataStore._OPERATIONS[opname]
+        path = args[0]
+        if path.__class__ is HandlePath and path.handle.owner is self:
+            args = (path.suffix,) + args[1:]
+            if kwds.get('with_version'):
+                return (b'H', 'icc' + operation[0],
+                        (path.handle.ident, b'V', opname) + args)
+            elif kwds.get('if_version') is not None:
+                return (b'H', 'icqc' + operation[0],
+                        (path.handle.ident, b'w', kwds['if_version'],
+                         opname) + args)
+            return (b'H', 'ic' + operation[0],
+                    (path.handle.ident, opname) + args)
+        if kwds.get('with_version'):
+            return (b'V', 'c' + operation[0], (opname,) + args)
+        elif kwds.get('if_version') is not None:
+            return (b'w', 'qc' + operation[0],
+                    (kwds['if_version'], opname) + args)
+        return (opname, operation[0], args)
+
+    def _run_operation(self, opname, *args, **kwds):
+        """
+        Helper method performing a remote datastore operation.
+
+        The keyword arguments with_version and if_version are handled as
+        described in BaseDataStore.
+        """
+        cmd, format, args = self._encode_operation(opname, args, kwds)
+        return self._run_command(cmd, format, *args)
+
+    def lock_remote(self):
+        """
+        Lock the remote datastore.
+
+        Differently to lock(), this only performs the corresponding remote API
+        command and does not acquire this object's local lock in addition;
+        hence, multiple threads can use the object concurrently after this
+        has been called.
+        """
+        return self._run_command(b'b', '')
+
+    def unlock_remote(self):
+        """
+        Unlock the remote datastore.
+
+        See the nodes to lock_remote() for details.
+        """
+        return self._run_command(b'f', '')
+
+    def begin_consistent_read(self):
+        """
+        Enter consistent-read mode.
+
+        A snapshot of the remote datastore is taken, and all subsequent
+        reading operations are served from it (without blocking writers of
+        the remote datastore) until end_consistent_read() is called or
+        another datastore is opened. Modifying operations continue to affect
+        the remote datastore itself; in particular, their effects are not
+        visible to reads in consistent-read mode. Calling this while already
+        in consistent-read mode takes a fresh snapshot.
+        """
+        return self._run_command(b's', '')
+
+    def end_consistent_read(self):
+        """
+        Leave consistent-read mode.
+
+        See begin_consistent_read() for details.
+        """
+        return self._run_command(b'u', '')
+
+    def stats(self):
+        """
+        Retrieve performance metrics of the remote server.
+
+        The result is a mapping of strings as described for
+        DataStoreServer.statistics().
+        """
+        res = self._run_command(b'I', '')
+        return {k.decode('ascii'): v.decode('utf-8') for k, v in res.items()}
+
+    def slowlog(self, clear=False):
+        """
+        Retrieve the slow-operation log of the remote server.
+
+        The result is a list of mappings of strings as described for
+        DataStoreServer.record_slow(), oldest first. If clear is true, the
+        log is emptied after retrieving it.
+        """
+        res = self._run_command(b'L', 'i', int(bool(clear)))
+        return [{k.decode('ascii'): v.decode('utf-8') for k, v in e.items()}
+                for e in res]
+
+    def hotkeys(self, clear=False):
+        """
+        Retrieve the most frequently accessed paths of the remote server.
+
+        The result is a list of mappings of strings as described for
+        HotKeyTracker.report(); if clear is true, the counts are reset after
+        retrieving them. The server must have hot-key tracking enabled.
+        """
+        res = self._run_command(b'K', 'i', int(bool(clear)))
+        return [{k.decode('ascii'): v.decode('utf-8') for k, v in e.items()}
+                for e in res]
+
+    def list_datastores(self):
+        """
+        Retrieve descriptions of the datastores of the remote server.
+
+        The result is a list of mappings of strings as described for
+        DataStoreServer.list_datastores().
+        """
+        res = self._run_command(b'E', '')
+        return [{k.decode('ascii'): v.decode('utf-8') for k, v in e.items()}
+                for e in res]
+
+    def drop_datastore(self, name):
+        """
+        Remove the datastore with the given name from the remote server.
+
+        If this object has that datastore open, it is closed (so that
+        datastore operations fail until another one is opened); see
+        DataStoreServer.drop_datastore() for details.
+        """
+        return self._run_command(b'U', 's', name)
+
+    def replication_info(self):
+        """
+        Retrieve the replication state of the remote server.
+
+        The result is a mapping of strings as described for
+        DataStoreServer.replication_info().
+        """
+        res = self._run_command(b'Y', '')
+        return {k.decode('ascii'): v.decode('utf-8') for k, v in res.items()}
+
+    def lock(self):
         "Lock this datastore; see BaseDataStore for details."
         self._lock.acquire()
-        self.lock()
+        try:
+            self.lock_remote()
+        except Exception:
+            self._lock.release()
+            raise
 
     def unlock(self):
         "Unlock this datastore; see BaseDataStore for details."
@@ -1202,41 +5505,652 @@ class RemoteDataStore(BaseDataStore):
             self._lock.release()
 
 
-    def get(self, path):
+    def get(self, path, with_version=False):
         "Retrieve a scalar at path; see BaseDataStore for details."
-        return self._run_operation(b'g', path)
+        return self._run_operation(b'g', path, with_version=with_version)
 
-    def get_all(self, path):
+    def get_all(self, path, with_version=False):
         "Retrieve key-value pairs below path; see BaseDataStore for details."
-        return self._run_operation(b'G', path)
+        return self._run_operation(b'G', path, with_version=with_version)
 
-    def list(self, path, lclass):
+    def list(self, path, lclass, with_version=False):
         "List some keys below path; see BaseDataStore for details."
-        return self._run_operation(b'l', path, lclass)
+        return self._run_operation(b'l', path, lclass,
+                                   with_version=with_version)
 
-    def put(self, path, value):
+    def put(self, path, value, if_version=None):
         "Store value at path; see BaseDataStore for details."
-        return self._run_operation(b'p', path, value)
+        return self._run_operation(b'p', path, value, if_version=if_version)
 
-    def put_all(self, path, values):
+    def put_all(self, path, values, if_version=None):
         "Merge pairs from values below path; see BaseDataStore for details."
-        return self._run_operation(b'P', path, values)
+        return self._run_operation(b'P', path, values, if_version=if_version)
 
-    def replace(self, path, values):
+    def replace(self, path, values, if_version=None):
         "Store values at path; see BaseDataStore for details."
-        return self._run_operation(b'r', path, values)
+        return self._run_operation(b'r', path, values, if_version=if_version)
 
-    def delete(self, path):
+    def delete(self, path, if_version=None):
         "Delete the value at path; see BaseDataStore for details."
-        return self._run_operation(b'd', path)
+        return self._run_operation(b'd', path, if_version=if_version)
 
-    def delete_all(self, path):
+    def delete_all(self, path, if_version=None):
         "Delete everything below path; see BaseDataStore for details."
-        return self._run_operation(b'D', path)
+        return self._run_operation(b'D', path, if_version=if_version)
+
+    def incr(self, path, delta=1, width=0, if_version=None):
+        "Increment a counter at path; see BaseDataStore for details."
+        if not COUNTER_MIN <= delta <= COUNTER_MAX:
+            raise HKVError.for_name('BADCOUNTER')
+        return self._run_operation(b'i', path, delta, width,
+                                   if_version=if_version)
+
+    def append(self, path, value, if_version=None):
+        "Append value to the scalar at path; see BaseDataStore for details."
+        return self._run_operation(b'a', path, value, if_version=if_version)
+
+    def cas(self, path, expected, value, if_version=None):
+        "Compare-and-swap the scalar at path; see BaseDataStore for details."
+        return bool(self._run_operation(b'c', path, expected, value,
+                                        if_version=if_version))
+
+    def put_if_absent(self, path, value, if_version=None):
+        "Store value at path if it is absent; see BaseDataStore for details."
+        return bool(self._run_operation(b'n', path, value,
+                                        if_version=if_version))
+
+    def put_stream(self, path, source, if_version=None):
+        """
+        Store the contents of a stream at path; see BaseDataStore for
+        details.
+
+        source is read and transmitted in chunks of at most CHUNK_BYTES
+        bytes. As the server cannot be told to discard a partially
+        transmitted value, this object is closed if reading from source
+        fails.
+        """
+        try:
+            self._run_operation(b'W', path, source, if_version=if_version)
+        except HKVError:
+            raise
+        except Exception:
+            self.close()
+            raise
+
+    def get_stream(self, path, with_version=False):
+        """
+        Retrieve the scalar at path as a file-like object; see BaseDataStore
+        for details.
+
+        The value is received incrementally while the ChunkedReader returned
+        is read from. Until the reader has reached its end or has been closed
+        (which skips any data not read yet), the connection is occupied and
+        this object's lock is held by the calling thread; the reader must
+        hence be used (and closed) by that thread, and no other operations
+        can be performed meanwhile. Hooks are not invoked.
+        """
+        cmd, format, args = self._encode_operation(b'B', (path,),
+            {'with_version': with_version})
+        def read_chunks():
+            try:
+                for chunk in self.codec.iter_chunks():
+                    yield chunk
+            except EOFError:
+                raise HKVError.for_name('CONNBROKEN')
+        self._lock.acquire()
+        started = False
+        try:
+            try:
+                self.codec.write_char(cmd)
+                self.codec.writef(format, *args)
+                self.codec.flush()
+            except IOError as exc:
+                if exc.errno != errno.EPIPE: raise
+                raise HKVError.for_name('CONNBROKEN')
+            try:
+                resp, version = self.codec.read_char(), None
+                if resp == b'v':
+                    version = self.codec.read_signed()
+                    resp = self.codec.read_char()
+                if resp == b'e':
+                    raise HKVError.for_code(self.codec.read_int())
+                elif resp != b'S':
+                    raise HKVError.for_name('NORESP')
+            except EOFError:
+                raise HKVError.for_name('CONNBROKEN')
+            ret = ChunkedReader(read_chunks(), self._lock.release)
+            started = True
+        finally:
+            if not started: self._lock.release()
+        if with_version: return (ret, version)
+        return ret
+
+    def copy(self, src, dst, if_version=None):
+        "Copy the value at src to dst; see BaseDataStore for details."
+        return self._run_operation(b'C', src, dst, if_version=if_version)
+
+    def move(self, src, dst, if_version=None):
+        "Move the value at src to dst; see BaseDataStore for details."
+        return self._run_operation(b'M', src, dst, if_version=if_version)
+
+    def version(self, path):
+        "Retrieve the version of path; see BaseDataStore for details."
+        return self._run_operation(b'v', path)
+
+    def handle(self, path):
+        """
+        Obtain a handle for the collection at path; see BaseDataStore for
+        details.
+
+        The handle is maintained by the server and only valid for the current
+        connection to the currently opened datastore; operations using it
+        transmit only the part of their paths following the handle's path.
+        """
+        return Handle(self, path, self._run_command(b'h', 'a', path))
+
+    def release_handle(self, handle):
+        "Dispose of a handle; see BaseDataStore for details."
+        self._run_command(b'j', 'i', handle.ident)
+
+    def stat(self, path, with_version=False):
+        "Retrieve aggregates of path; see BaseDataStore for details."
+        res = self._run_operation(b't', path, with_version=with_version)
+        if with_version: return (tuple(res[0]), res[1])
+        return tuple(res)
+
+    def query(self, pattern, limit=0, values_only=False, with_version=False):
+        """
+        Retrieve scalar values matching pattern; see BaseDataStore for
+        details.
+
+        The matches are streamed back by the server in chunks; if
+        values_only is true, their paths are not transmitted at all.
+        """
+        res = self._run_operation(b'Q', pattern, max(limit, 0),
+                                  int(bool(values_only)),
+                                  with_version=with_version)
+        if with_version: res, version = res
+        if values_only:
+            ret = [v for p, v in res]
+        else:
+            ret = [(tuple(p), v) for p, v in res]
+        if with_version: return (ret, version)
+        return ret
+
+    def create_index(self, pattern, if_version=None):
+        "Create a secondary index; see BaseDataStore for details."
+        return self._run_operation(b'X', pattern, if_version=if_version)
+
+    def drop_index(self, pattern, if_version=None):
+        "Remove a secondary index; see BaseDataStore for details."
+        return self._run_operation(b'Z', pattern, if_version=if_version)
+
+    def lookup(self, pattern, value, with_version=False):
+        "Look up paths holding value; see BaseDataStore for details."
+        res = self._run_operation(b'k', pattern, value,
+                                  with_version=with_version)
+        if with_version: return ([tuple(p) for p in res[0]], res[1])
+        return [tuple(p) for p in res]
+
+class ShardedDataStore(BaseDataStore):
+    """
+    ShardedDataStore(shards, depth=1, vnodes=64) -> new instance
+
+    A datastore distributing its contents across multiple other datastores.
+
+    shards is a mapping from shard names (byte strings) to datastores
+    (typically RemoteDataStore instances); depth is the amount of leading
+    path components that determine the shard a value is stored on; vnodes
+    is the amount of points every shard occupies on the consistent hashing
+    ring. All users of a set of shards must use the same names, depth, and
+    vnodes; when shards are added or removed, only the values whose shards
+    changed need to be moved, which rebalance() takes care of.
+
+    Operations on paths that are at least depth components long are routed
+    to exactly one shard and behave as for the underlying datastore. Shorter
+    paths refer to nested collections that may span all shards: get_all()
+    and list() query all shards in parallel and merge the results; put_all()
+    distributes the values among the shards; replace(), delete(), and
+    delete_all() are applied to all shards. Such operations are not atomic,
+    they report the sum of the shards' versions as the version, and they
+    raise a BADPATH error if if_version is specified. The remaining
+    operations (which concern scalar values) raise a BADPATH error for paths
+    shorter than depth; in particular, scalar values cannot be stored there.
+
+    lock() locks all shards in a fixed order (so that concurrent users of a
+    set of shards cannot deadlock); as this serializes all access to the
+    shards, it should be avoided.
+    """
+
+    def __init__(self, shards, depth=1, vnodes=64):
+        "Instance initializer; see class docstring for details."
+        if depth < 1: raise ValueError('Sharding depth must be positive')
+        self.shards = dict(shards)
+        self.depth = depth
+        self.vnodes = vnodes
+        ring = []
+        for name in self.shards:
+            for i in range(vnodes):
+                ring.append((self._hash(name + b'#' + str(i).encode('ascii')),
+                             name))
+        ring.sort()
+        self._points = [p for p, n in ring]
+        self._owners = [n for p, n in ring]
+
+    def _hash(self, data):
+        "Internal helper method."
+        return struct.unpack('!Q', hashlib.md5(data).digest()[:8])[0]
+
+    def shard_for(self, path):
+        """
+        Return the name of the shard responsible for path.
+
+        Only the first depth components of path are considered.
+        """
+        key = b''.join(INTEGER.pack(len(p)) + p for p in path[:self.depth])
+        index = bisect.bisect(self._points, self._hash(key))
+        return self._owners[index % len(self._owners)]
+
+    def _route(self, path, if_version=None):
+        """
+        Internal helper method.
+
+        Return the datastore responsible for path, or None if path spans all
+        shards.
+        """
+        if len(path) >= self.depth:
+            return self.shards[self.shard_for(path)]
+        elif if_version is not None:
+            raise HKVError.for_name('BADPATH')
+        return None
+
+    def _route_scalar(self, path):
+        "Internal helper method."
+        if len(path) < self.depth: raise HKVError.for_name('BADPATH')
+        return self.shards[self.shard_for(path)]
+
+    def _fan_out(self, method, *args, **kwds):
+        """
+        Internal helper method.
+
+        Invoke the named method on every shard (in parallel) and return a
+        list of the results. HKVError-s of the NOKEY kind are ignored unless
+        all shards raise them; other exceptions are propagated.
+        """
+        shards = list(self.shards.values())
+        outcomes = [None] * len(shards)
+        def run(index):
+            try:
+                res = getattr(shards[index], method)(*args, **kwds)
+                outcomes[index] = (res, None)
+            except Exception as exc:
+                outcomes[index] = (None, exc)
+        if len(shards) == 1:
+            run(0)
+        else:
+            for thr in [spawn_thread(run, i) for i in range(len(shards))]:
+                thr.join()
+        ret, missing = [], None
+        for res, exc in outcomes:
+            if exc is None:
+                ret.append(res)
+            elif isinstance(exc, HKVError) and exc.name == 'NOKEY':
+                missing = exc
+            else:
+                raise exc
+        if not ret and missing is not None: raise missing
+        return ret
+
+    def _merge_versions(self, results, with_version):
+        "Internal helper method."
+        if not with_version: return results, None
+        return [r[0] for r in results], sum(r[1] for r in results)
+
+    def lock(self):
+        "Lock this datastore; see the class docstring for details."
+        locked = []
+        try:
+            for name in sorted(self.shards):
+                self.shards[name].lock()
+                locked.append(self.shards[name])
+        except Exception:
+            for shard in reversed(locked): shard.unlock()
+            raise
+
+    def unlock(self):
+        "Unlock this datastore; see BaseDataStore for details."
+        for name in sorted(self.shards, reverse=True):
+            self.shards[name].unlock()
+
+    def close(self):
+        "Dispose of this datastore; see BaseDataStore for details."
+        for shard in self.shards.values():
+            shard.close()
+
+    def get(self, path, with_version=False):
+        "Retrieve a scalar at path; see BaseDataStore for details."
+        shard = self._route(path)
+        if shard is not None: return shard.get(path, with_version)
+        # Scalars cannot reside here, but the error should be accurate.
+        self._fan_out('list', path, LCLASS_NESTED)
+        raise HKVError.for_name('BADTYPE')
+
+    def get_all(self, path, with_version=False):
+        "Retrieve key-value pairs below path; see BaseDataStore for details."
+        shard = self._route(path)
+        if shard is not None: return shard.get_all(path, with_version)
+        results, version = self._merge_versions(
+            self._fan_out('get_all', path, with_version), with_version)
+        ret = {}
+        for res in results: ret.update(res)
+        if with_version: return (ret, version)
+        return ret
+
+    def list(self, path, lclass, with_version=False):
+        "List some keys below path; see BaseDataStore for details."
+        shard = self._route(path)
+        if shard is not None: return shard.list(path, lclass, with_version)
+        results, version = self._merge_versions(
+            self._fan_out('list', path, lclass, with_version), with_version)
+        ret, seen = [], set()
+        for res in results:
+            for key in res:
+                if key in seen: continue
+                seen.add(key)
+                ret.append(key)
+        if with_version: return (ret, version)
+        return ret
+
+    def put(self, path, value, if_version=None):
+        "Store value at path; see BaseDataStore for details."
+        self._route_scalar(path).put(path, value, if_version)
+
+    def put_all(self, path, values, if_version=None):
+        "Merge pairs from values below path; see BaseDataStore for details."
+        shard = self._route(path, if_version)
+        if shard is not None:
+            return shard.put_all(path, values, if_version)
+        path = tuple(path)
+        groups = {}
+        for k, v in values.items():
+            groups.setdefault(self._route_scalar(path + (k,)), {})[k] = v
+        for shard, group in groups.items():
+            shard.put_all(path, group)
+
+    def replace(self, path, values, if_version=None):
+        "Store values at path; see BaseDataStore for details."
+        shard = self._route(path, if_version)
+        if shard is not None:
+            return shard.replace(path, values, if_version)
+        path = tuple(path)
+        for k in values: self._route_scalar(path + (k,))
+        try:
+            self._fan_out('delete', path)
+        except HKVError as exc:
+            if exc.name != 'NOKEY': raise
+        self.put_all(path, values)
+
+    def delete(self, path, if_version=None):
+        "Delete the value at path; see BaseDataStore for details."
+        shard = self._route(path, if_version)
+        if shard is not None: return shard.delete(path, if_version)
+        self._fan_out('delete', path)
+
+    def delete_all(self, path, if_version=None):
+        "Delete everything below path; see BaseDataStore for details."
+        shard = self._route(path, if_version)
+        if shard is not None: return shard.delete_all(path, if_version)
+        self._fan_out('delete_all', path)
+
+    def incr(self, path, delta=1, width=0, if_version=None):
+        "Increment a counter at path; see BaseDataStore for details."
+        return self._route_scalar(path).incr(path, delta, width, if_version)
+
+    def append(self, path, value, if_version=None):
+        "Append value to the scalar at path; see BaseDataStore for details."
+        self._route_scalar(path).append(path, value, if_version)
+
+    def cas(self, path, expected, value, if_version=None):
+        "Compare-and-swap the scalar at path; see BaseDataStore for details."
+        return self._route_scalar(path).cas(path, expected, value, if_version)
+
+    def put_if_absent(self, path, value, if_version=None):
+        "Store value at path if it is absent; see BaseDataStore for details."
+        return self._route_scalar(path).put_if_absent(path, value,
+                                                      if_version)
+
+    def put_stream(self, path, source, if_version=None):
+        """
+        Store the contents of a stream at path; see BaseDataStore for
+        details.
+        """
+        self._route_scalar(path).put_stream(path, source, if_version)
+
+    def get_stream(self, path, with_version=False):
+        """
+        Retrieve the scalar at path as a file-like object; see BaseDataStore
+        for details.
+        """
+        shard = self._route(path)
+        if shard is not None: return shard.get_stream(path, with_version)
+        self._fan_out('list', path, LCLASS_NESTED)
+        raise HKVError.for_name('BADTYPE')
+
+    def _relocate(self, src, dst, if_version, remove):
+        """
+        Internal helper method.
+
+        Implements copy() (remove is false) and move() (remove is true).
+        """
+        source, dest = self._route_scalar(src), self._route_scalar(dst)
+        if source is dest:
+            if remove: return source.move(src, dst, if_version)
+            return source.copy(src, dst, if_version)
+        elif if_version is not None:
+            raise HKVError.for_name('BADPATH')
+        # Check that src exists before removing anything at dst.
+        if not source.version(src): raise HKVError.for_name('NOKEY')
+        try:
+            dest.delete(dst)
+        except HKVError as exc:
+            if exc.name != 'NOKEY': raise
+        self._copy(source, dest, tuple(src), tuple(dst))
+        if remove: source.delete(src)
+
+    def copy(self, src, dst, if_version=None):
+        """
+        Copy the value at src to dst; see BaseDataStore for details.
+
+        Both paths must be at least depth components long. If they reside on
+        different shards, the value is transferred through this client, which
+        is not atomic; in that case, if_version must be None.
+        """
+        self._relocate(src, dst, if_version, False)
+
+    def move(self, src, dst, if_version=None):
+        """
+        Move the value at src to dst; see BaseDataStore for details.
+
+        The same restrictions as for copy() apply; a move between shards is
+        a copy followed by a deletion.
+        """
+        if tuple(dst[:len(src)]) == tuple(src):
+            raise HKVError.for_name('BADMOVE')
+        self._relocate(src, dst, if_version, True)
+
+    def version(self, path):
+        "Retrieve the version of path; see BaseDataStore for details."
+        shard = self._route(path)
+        if shard is not None: return shard.version(path)
+        return sum(self._fan_out('version', path))
+
+    def handle(self, path):
+        """
+        Obtain a handle for the collection at path; see BaseDataStore for
+        details.
+
+        The handle only serves as a shorthand for its path; in particular,
+        it is not invalidated when the collection is replaced.
+        """
+        self.list(path, LCLASS_ANY)
+        return Handle(self, path)
+
+    def release_handle(self, handle):
+        "Dispose of a handle; see BaseDataStore for details."
+        pass
+
+    def stat(self, path, with_version=False):
+        """
+        Retrieve aggregates of path; see BaseDataStore for details.
+
+        For paths shorter than the routing depth, the aggregates of all
+        shards are summed up; as every shard holds its own copy of the
+        nested values along such paths, these may be counted multiple times.
+        """
+        shard = self._route(path)
+        if shard is not None: return shard.stat(path, with_version)
+        results, version = self._merge_versions(
+            self._fan_out('stat', path, with_version), with_version)
+        ret = tuple(sum(r[i] for r in results) for i in range(3))
+        if with_version: return (ret, version)
+        return ret
+
+    def query(self, pattern, limit=0, values_only=False, with_version=False):
+        """
+        Retrieve scalar values matching pattern; see BaseDataStore for
+        details.
+
+        If the first depth components of pattern contain no wildcards, the
+        query is routed to a single shard; otherwise, all shards are queried
+        in parallel (each with the full limit) and the results are
+        concatenated and truncated to limit.
+        """
+        shard = self._route_pattern(pattern)
+        if shard is not None:
+            return shard.query(pattern, limit, values_only, with_version)
+        results, version = self._merge_versions(
+            self._fan_out('query', pattern, limit, values_only, with_version),
+            with_version)
+        ret = []
+        for res in results: ret.extend(res)
+        if limit > 0: del ret[limit:]
+        if with_version: return (ret, version)
+        return ret
+
+    def _route_pattern(self, pattern):
+        """
+        Internal helper method.
+
+        Return the datastore responsible for everything matching pattern, or
+        None if matches may reside on any shard.
+        """
+        prefix = pattern[:self.depth]
+        if (len(prefix) < self.depth or QUERY_ONE in prefix or
+                QUERY_ANY in prefix):
+            return None
+        return self.shards[self.shard_for(pattern)]
+
+    def create_index(self, pattern, if_version=None):
+        """
+        Create a secondary index; see BaseDataStore for details.
+
+        The index is created on every shard; if_version must be None.
+        """
+        if if_version is not None: raise HKVError.for_name('BADPATH')
+        self._fan_out('create_index', pattern)
+
+    def drop_index(self, pattern, if_version=None):
+        "Remove a secondary index; see create_index() for details."
+        if if_version is not None: raise HKVError.for_name('BADPATH')
+        self._fan_out('drop_index', pattern)
+
+    def lookup(self, pattern, value, with_version=False):
+        """
+        Look up paths holding value; see BaseDataStore for details.
+
+        As for query(), this is routed to a single shard if possible.
+        """
+        shard = self._route_pattern(pattern)
+        if shard is not None: return shard.lookup(pattern, value, with_version)
+        results, version = self._merge_versions(
+            self._fan_out('lookup', pattern, value, with_version),
+            with_version)
+        ret = []
+        for res in results: ret.extend(res)
+        if with_version: return (ret, version)
+        return ret
+
+    def snapshot(self):
+        "Create a read-only view of this datastore; see BaseDataStore."
+        return ShardedDataStore({n: s.snapshot()
+                                 for n, s in self.shards.items()},
+                                self.depth, self.vnodes)
+
+    def _walk(self, shard, path=()):
+        """
+        Internal helper method.
+
+        Yield every path that is depth components long (or shorter and
+        refers to a scalar) and exists on the given shard.
+        """
+        for key in shard.list(path, LCLASS_SCALAR):
+            yield path + (key,)
+        if len(path) + 1 >= self.depth:
+            for key in shard.list(path, LCLASS_NESTED):
+                yield path + (key,)
+        else:
+            for key in shard.list(path, LCLASS_NESTED):
+                for res in self._walk(shard, path + (key,)):
+                    yield res
+
+    def _copy(self, source, dest, path, target=None):
+        """
+        Internal helper method.
+
+        Copy the value at path from the datastore source to the path target
+        (which defaults to path) in the datastore dest. Every nested node is
+        created on dest, including empty ones.
+        """
+        if target is None: target = path
+        try:
+            dest.put(target, source.get(path))
+            return
+        except HKVError as exc:
+            if exc.name != 'BADTYPE': raise
+        stack = [()]
+        while stack:
+            cur = stack.pop()
+            # put_all() creates the node even if values is empty.
+            dest.put_all(target + cur, source.get_all(path + cur))
+            stack.extend(cur + (k,) for k in source.list(path + cur,
+                                                         LCLASS_NESTED))
+
+    def rebalance(self, callback=None):
+        """
+        Move every value that is stored on a shard other than the one it
+        belongs to (e.g. after shards have been added) there.
+
+        Each value is copied to its new shard and then deleted from its old
+        one; concurrent modifications of the affected values may be lost, so
+        writers should be paused while this runs. If callback is not None, it
+        is invoked with the path, the old shard's name, and the new shard's
+        name after every move. Returns the amount of values moved.
+        """
+        moved = 0
+        for name in sorted(self.shards):
+            source = self.shards[name]
+            for path in list(self._walk(source)):
+                owner = self.shard_for(path)
+                if owner == name: continue
+                self._copy(source, self.shards[owner], path)
+                source.delete(path)
+                moved += 1
+                if callback is not None: callback(path, name, owner)
+        return moved
 
 class TextDataStore(ConvertingDataStore):
     """
-    TextDataStore(wrapped, nulldelim=False) -> new instance
+    TextDataStore(wrapped, nulldelim=False, cache_size=0) -> new instance
 
     A sample implementation of ConvertingDataStore that converts data into
     Unicode strings.
@@ -1245,7 +6159,8 @@ class TextDataStore(ConvertingDataStore):
     slashes themselves cannot be used), or, if nulldelim is true, NUL
     characters (in that case, keys containing NUL characters are unusable);
     in either case, empty strings are not permitted as path components and are
-    silently elided if present in composite paths.
+    silently elided if present in composite paths. cache_size is passed on to
+    ConvertingDataStore.
 
     Because of this ambiguity (and because decoding errors are silently mapped
     to replacement characters for both keys and values), this class is not
@@ -1253,9 +6168,10 @@ class TextDataStore(ConvertingDataStore):
     export list.
     """
 
-    def __init__(self, wrapped, nulldelim=False):
-        super(TextDataStore, self).__init__(wrapped)
+    def __init__(self, wrapped, nulldelim=False, cache_size=0):
+        super(TextDataStore, self).__init__(wrapped, cache_size)
         self.delimiter = '\0' if nulldelim else '/'
+        self._bdelimiter = self.delimiter.encode('utf-8')
 
     def import_key(self, key, fragment):
         "Import the given key; see ConvertingDataStore for details."
@@ -1266,14 +6182,50 @@ class TextDataStore(ConvertingDataStore):
                 raise ValueError('Non-path keys may not contain delimiters')
         key = key.encode('utf-8')
         if not fragment:
-            key = [p for p in key.split(self.delimiter.encode('utf-8')) if p]
+            key = [p for p in key.split(self._bdelimiter) if p]
         return key
 
     def export_key(self, key, fragment):
         "Export the given key; see ConvertingDataStore for details."
-        if not fragment: key = self.delimiter.encode('utf-8').join(key)
+        if not fragment: key = self._bdelimiter.join(key)
         return key.decode('utf-8', errors='replace')
 
+    # The batch conversion methods join all items (keys or values) using a
+    # separator and convert the result in one go; if splitting it yields a
+    # different amount of items (as some contained the separator), they fall
+    # back to converting the items individually.
+
+    def import_keys(self, keys, fragment):
+        "Import the given keys; see ConvertingDataStore for details."
+        if fragment and keys and '' not in keys:
+            ret = self.delimiter.join(keys).encode('utf-8').split(
+                self._bdelimiter)
+            if len(ret) == len(keys): return ret
+        return super(TextDataStore, self).import_keys(keys, fragment)
+
+    def export_keys(self, keys, fragment):
+        "Export the given keys; see ConvertingDataStore for details."
+        if fragment and keys:
+            ret = self._bdelimiter.join(keys).decode('utf-8',
+                errors='replace').split(self.delimiter)
+            if len(ret) == len(keys): return ret
+        return super(TextDataStore, self).export_keys(keys, fragment)
+
+    def import_values(self, values):
+        "Import the given values; see ConvertingDataStore for details."
+        if values:
+            ret = '\0'.join(values).encode('utf-8').split(b'\0')
+            if len(ret) == len(values): return ret
+        return super(TextDataStore, self).import_values(values)
+
+    def export_values(self, values):
+        "Export the given values; see ConvertingDataStore for details."
+        if values:
+            ret = b'\0'.join(values).decode('utf-8',
+                errors='replace').split('\0')
+            if len(ret) == len(values): return ret
+        return super(TextDataStore, self).export_values(values)
+
     def import_value(self, value):
         "Import the given value; see ConvertingDataStore for details."
         return value.encode('utf-8')
@@ -1282,45 +6234,659 @@ class TextDataStore(ConvertingDataStore):
         "Export the given value; see ConvertingDataStore for details."
         return value.decode('utf-8', errors='replace')
 
-def main_listen(params, no_timestamps, loglevel):
+class ArrayDataStore(ConvertingDataStore):
+    """
+    ArrayDataStore(wrapped, use_numpy=None, cache_size=0) -> new instance
+
+    A ConvertingDataStore storing typed arrays of numbers as scalar values.
+
+    Keys and paths are passed through unchanged. The values stored may be any
+    objects supporting the buffer protocol with a numeric element type (such
+    as array.array or memoryview instances, or NumPy arrays); they are
+    serialized as a small header describing the element type (as a NumPy
+    type string, e.g. "<f8") and the shape, followed by the raw elements.
+    Retrieved values without such a header (e.g. stored by other clients)
+    are returned unchanged.
+
+    If use_numpy is None, NumPy is used if it can be imported; if it is
+    true, NumPy must be importable; if it is false, NumPy is not used. With
+    NumPy, retrieved values are read-only NumPy arrays created by
+    numpy.frombuffer() directly over the received bytes, i.e. without
+    copying the elements; without it, they are (one-dimensional, i.e.
+    flattened) array.array instances, which necessarily hold a copy.
+    cache_size is passed on to ConvertingDataStore.
+    """
+
+    # Magic bytes preceding serialized arrays.
+    MAGIC = b'\x93HKA'
+    # Fixed part of the header: magic, length of type string, dimensions.
+    HEADER = struct.Struct('!4sBB')
+    # Alignment of the elements relative to the start of serialized arrays.
+    ALIGN = 16
+    # Candidate array.array type codes for the kinds of NumPy type strings.
+    TYPECODES = {'b': 'B', 'i': 'bhilq', 'u': 'BHILQ', 'f': 'fd'}
+
+    def __init__(self, wrapped, use_numpy=None, cache_size=0):
+        "Instance initializer; see class docstring for details."
+        super(ArrayDataStore, self).__init__(wrapped, cache_size)
+        self.numpy = None
+        if use_numpy or use_numpy is None:
+            try:
+                import numpy
+                self.numpy = numpy
+            except ImportError:
+                if use_numpy: raise
+
+    def import_key(self, key, fragment):
+        "Import the given key; see ConvertingDataStore for details."
+        return key
+
+    def export_key(self, key, fragment):
+        "Export the given key; see ConvertingDataStore for details."
+        return key
+
+    def _typestr(self, format, itemsize):
+        """
+        Internal helper method.
+
+        Convert a struct module format string (as found in memoryview
+        objects) describing a single number to a NumPy type string.
+        """
+        native = '<' if sys.byteorder == 'little' else '>'
+        order = native
+        if format[:1] in ('@', '=', '<', '>', '!'):
+            if format[0] in '<>!': order = '<' if format[0] == '<' else '>'
+            format = format[1:]
+        if len(format) != 1:
+            kind = None
+        elif format == '?':
+            kind = 'b'
+        elif format in 'bhilqn':
+            kind = 'i'
+        elif format in 'BHILQN':
+            kind = 'u'
+        elif format in 'efd':
+            kind = 'f'
+        else:
+            kind = None
+        if kind is None:
+            raise ValueError('Unsupported array format: %r' % format)
+        if itemsize == 1: order = '|'
+        return '%s%s%d' % (order, kind, itemsize)
+
+    def import_value(self, value):
+        "Import the given value; see ConvertingDataStore for details."
+        view = memoryview(value)
+        typestr = self._typestr(view.format, view.itemsize).encode('ascii')
+        shape = view.shape or ()
+        header = (self.HEADER.pack(self.MAGIC, len(typestr), len(shape)) +
+                  typestr + struct.pack('!%dQ' % len(shape), *shape))
+        header += b'\0' * (-len(header) % self.ALIGN)
+        data = view if view.c_contiguous else view.tobytes()
+        return b''.join((header, data))
+
+    def _parse_header(self, value):
+        """
+        Internal helper method.
+
+        Return the type string, shape, and offset of the elements of the
+        array serialized in value, or None if value does not start with a
+        valid header or its length does not match the header.
+        """
+        if (len(value) < self.HEADER.size or
+                value[:len(self.MAGIC)] != self.MAGIC):
+            return None
+        _, length, ndim = self.HEADER.unpack_from(value)
+        offset = self.HEADER.size
+        end = offset + length + ndim * 8
+        if end > len(value): return None
+        typestr = value[offset:offset + length]
+        if (length < 3 or typestr[:1] not in (b'<', b'>', b'|') or
+                typestr[1:2] not in (b'b', b'i', b'u', b'f') or
+                not typestr[2:].isdigit()):
+            return None
+        typestr = typestr.decode('ascii')
+        shape = struct.unpack_from('!%dQ' % ndim, value, offset + length)
+        offset = end + (-end % self.ALIGN)
+        size = int(typestr[2:])
+        for dim in shape: size *= dim
+        if len(value) - offset != size: return None
+        return (typestr, shape, offset)
+
+    def export_value(self, value):
+        """
+        Export the given value; see ConvertingDataStore for details.
+
+        Values without a valid header (see _parse_header()) are returned
+        unchanged.
+        """
+        header = self._parse_header(value)
+        if header is None: return value
+        typestr, shape, offset = header
+        if self.numpy is not None:
+            dtype = self.numpy.dtype(typestr)
+            count = (len(value) - offset) // dtype.itemsize
+            if not count: return self.numpy.empty(shape, dtype)
+            return self.numpy.frombuffer(value, dtype, count,
+                                         offset).reshape(shape)
+        size = int(typestr[2:])
+        for typecode in self.TYPECODES.get(typestr[1], ''):
+            try:
+                ret = array.array(typecode)
+            except ValueError:
+                continue
+            if ret.itemsize == size: break
+        else:
+            raise ValueError('Unsupported array type: %s' % typestr)
+        if hasattr(ret, 'frombytes'):
+            ret.frombytes(memoryview(value)[offset:])
+        else:
+            ret.fromstring(value[offset:])
+        if size > 1 and typestr[0] != ('<' if sys.byteorder == 'little'
+                                       else '>'):
+            ret.byteswap()
+        return ret
+
+class LoadGenerator(object):
+    """
+    LoadGenerator(params, mix, keys=1000, depth=1, sizes=(100, 100),
+                  pipeline=1) -> new instance
+
+    A synthetic workload for benchmarking a datastore server, as used by
+    main_bench().
+
+    params are keyword arguments for creating RemoteDataStore instances (as
+    returned by parse_url(), including a datastore name); mix is a mapping
+    from operation names (see OPERATIONS) to relative weights; keys is the
+    amount of scalar values operated upon, which are arranged in a tree of
+    the given depth (so that get, put, and put_all operations concern leaves
+    of the tree, and get_all and list operations concern their parents);
+    sizes is a (min, max) pair of bounds of the (uniformly distributed)
+    lengths of values written; pipeline is the amount of operations submitted
+    per round trip (see RemoteDataStore.pipeline()).
+    """
+
+    OPERATIONS = ('get', 'put', 'get_all', 'list', 'put_all')
+
+    def __init__(self, params, mix, keys=1000, depth=1, sizes=(100, 100),
+                 pipeline=1):
+        "Instance initializer; see class docstring for details."
+        for name in mix:
+            if name not in self.OPERATIONS:
+                raise ValueError('Unknown operation: %s' % name)
+        if keys < 1 or depth < 1 or pipeline < 1:
+            raise ValueError('Key count, depth, and pipelining depth must '
+                'be positive')
+        if not 0 <= sizes[0] <= sizes[1]:
+            raise ValueError('Invalid value size range')
+        self.params = params
+        self.mix = mix
+        self.keys = keys
+        self.depth = depth
+        self.sizes = sizes
+        self.pipeline = pipeline
+        self.fanout = max(2, int(math.ceil(keys ** (1.0 / depth))))
+        self._names = sorted(name for name in mix if mix[name] > 0)
+        if not self._names: raise ValueError('Empty operation mix')
+        self._weights, total = [], 0
+        for name in self._names:
+            total += mix[name]
+            self._weights.append(total)
+        self._payload = b'x' * sizes[1]
+
+    def path(self, index):
+        """
+        Return the path of the index-th leaf of the key tree.
+        """
+        ret = []
+        for _ in range(self.depth):
+            index, digit = divmod(index, self.fanout)
+            ret.append(str(digit).encode('ascii'))
+        ret.reverse()
+        return ret
+
+    def siblings(self, index):
+        """
+        Return the range of indices of the leaves sharing a parent with the
+        index-th leaf.
+        """
+        base = index - index % self.fanout
+        return range(base, min(base + self.fanout, self.keys))
+
+    def value(self, rng):
+        """
+        Return a value of random length drawn using the random.Random rng.
+        """
+        return self._payload[:rng.randint(*self.sizes)]
+
+    def request(self, rng):
+        """
+        Return a random (name, args) operation as accepted by
+        RemoteDataStore.pipeline().
+        """
+        point = rng.random() * self._weights[-1]
+        name = self._names[bisect.bisect_right(self._weights, point)]
+        index = rng.randrange(self.keys)
+        path = self.path(index)
+        if name == 'get':
+            return (name, (path,))
+        elif name == 'put':
+            return (name, (path, self.value(rng)))
+        elif name == 'get_all':
+            return (name, (path[:-1],))
+        elif name == 'list':
+            return (name, (path[:-1], LCLASS_ANY))
+        else:
+            return (name, (path[:-1],
+                dict((self.path(i)[-1], self.value(rng))
+                     for i in self.siblings(index))))
+
+    def populate(self, client, seed=0):
+        """
+        Write every key of the workload using client.
+        """
+        rng = random.Random(seed)
+        for base in range(0, self.keys, self.fanout):
+            client.put_all(self.path(base)[:-1],
+                dict((self.path(i)[-1], self.value(rng))
+                     for i in self.siblings(base)))
+
+    def run(self, client, count, seed=0):
+        """
+        Perform count random operations using client.
+
+        Returns a (histograms, errors, elapsed) tuple, where histograms maps
+        operation names to Histograms of the round-trip times of the
+        operations, errors is the amount of operations that failed, and
+        elapsed is the total time taken (in seconds).
+        """
+        rng = random.Random(seed)
+        histograms = dict((name, Histogram()) for name in self._names)
+        errors, done = 0, 0
+        begin = timer()
+        while done < count:
+            batch = [self.request(rng)
+                     for _ in range(min(self.pipeline, count - done))]
+            start = timer()
+            if len(batch) == 1:
+                name, args = batch[0]
+                try:
+                    getattr(client, name)(*args)
+                except HKVError:
+                    errors += 1
+            else:
+                for result in client.pipeline(batch):
+                    if isinstance(result, HKVError): errors += 1
+            duration = timer() - start
+            for name, args in batch:
+                histograms[name].add(duration)
+            done += len(batch)
+        return (histograms, errors, timer() - begin)
+
+class Exporter(object):
+    """
+    Exporter(store, path=(), batch=64) -> new instance
+
+    Streams the contents of a subtree of a datastore into a file, as used by
+    main_transfer().
+
+    store is the datastore to read from, and path is the root of the subtree
+    to export (which may be empty to export everything). The subtree is
+    traversed depth-first, fetching the scalars and nested keys of up to
+    batch nodes per round trip (which are pipelined if store is a
+    RemoteDataStore), so that the memory required is bounded by the size of
+    batch nodes (plus the keys of the nodes pending traversal) rather than
+    by the size of the subtree. A RemoteDataStore is read in consistent-read
+    mode, and other datastores are read from a snapshot() (if they support
+    that), so that the export reflects a single point in time.
+
+    The following formats are supported:
+    jsonl : JSON Lines. Every scalar is represented by an object of the form
+            {"path": [...], "value": ...}, where the path is relative to the
+            root of the export, and every path component and the value are
+            strings if they are valid UTF-8, or otherwise objects of the form
+            {"base64": "..."}. Nodes without any contents are represented by
+            objects with a path but no value.
+    binary : EXPORT_MAGIC, followed by records encoded by a Codec using
+             version 2 of the wire format. Every node that contains scalars
+             or nothing at all is represented by (one or more) records
+             consisting of the character b"N", the relative path of the node,
+             and a mapping of (at most CHUNK_ITEMS of) its scalars; the last
+             record is the character b"E".
+
+    The nodes, values, and bytes attributes count the nodes traversed, the
+    scalars exported, and the total size of their keys and values so far.
+    """
+
+    FORMATS = ('jsonl', 'binary')
+
+    def __init__(self, store, path=(), batch=64):
+        "Instance initializer; see class docstring for details."
+        if batch < 1:
+            raise ValueError('Batch size must be positive')
+        self.store = store
+        self.path = tuple(path)
+        self.batch = batch
+        self.nodes = 0
+        self.values = 0
+        self.bytes = 0
+
+    def _fetch(self, store, paths):
+        """
+        Internal helper method.
+
+        Returns a list of (scalars, nested keys) pairs of the given nodes.
+        """
+        if not isinstance(store, RemoteDataStore):
+            return [(store.get_all(p), store.list(p, LCLASS_NESTED))
+                    for p in paths]
+        operations = []
+        for p in paths:
+            operations.append(('get_all', (p,)))
+            operations.append(('list', (p, LCLASS_NESTED)))
+        results = store.pipeline(operations)
+        for res in results:
+            if isinstance(res, HKVError): raise res
+        return list(zip(results[::2], results[1::2]))
+
+    @staticmethod
+    def _encode_item(data):
+        "Internal helper method."
+        try:
+            return data.decode('utf-8')
+        except UnicodeDecodeError:
+            encoded = binascii.b2a_base64(data).strip()
+            return {'base64': encoded.decode('ascii')}
+
+    def walk(self):
+        """
+        Traverse the subtree to export.
+
+        This is a generator yielding (path, scalars) pairs for every node
+        that contains scalars or nothing at all, where path is a tuple
+        relative to the root of the export and scalars is a mapping as
+        returned by get_all().
+        """
+        store, consistent = self.store, False
+        if isinstance(store, RemoteDataStore):
+            store.begin_consistent_read()
+            consistent = True
+        else:
+            try:
+                store = store.snapshot()
+            except NotImplementedError:
+                pass
+        try:
+            pending = [()]
+            while pending:
+                paths = pending[-self.batch:]
+                del pending[-self.batch:]
+                paths.reverse()
+                nodes = list(zip(paths, self._fetch(store,
+                    [self.path + p for p in paths])))
+                for path, (scalars, nested) in nodes:
+                    self.nodes += 1
+                    if scalars or not nested:
+                        yield (path, scalars)
+                # Push the children of the first node last, so that they
+                # are visited next.
+                for path, (_, nested) in reversed(nodes):
+                    pending.extend(path + (k,)
+                                   for k in sorted(nested, reverse=True))
+        finally:
+            if consistent: store.end_consistent_read()
+
+    def run(self, file, format='jsonl', progress=None):
+        """
+        Export the subtree into the binary file-like object file.
+
+        format is one of the FORMATS described in the class docstring;
+        progress, if not None, is called with this instance as the only
+        argument after every node exported.
+        """
+        if format not in self.FORMATS:
+            raise ValueError('Unknown export format: %s' % format)
+        if format == 'binary':
+            file.write(EXPORT_MAGIC)
+            codec = Codec(None, file, 2)
+        for path, scalars in self.walk():
+            if format == 'binary':
+                items = sorted(scalars.items())
+                for i in range(0, max(len(items), 1), CHUNK_ITEMS):
+                    codec.writef('cam', b'N', path,
+                                 dict(items[i:i + CHUNK_ITEMS]))
+            elif not scalars:
+                file.write(('{"path": %s}\n' % json.dumps(
+                    [self._encode_item(k) for k in path])).encode('ascii'))
+            else:
+                for key in sorted(scalars):
+                    file.write(('{"path": %s, "value": %s}\n' % (
+                        json.dumps([self._encode_item(k)
+                                    for k in path + (key,)]),
+                        json.dumps(self._encode_item(scalars[key])))
+                    ).encode('ascii'))
+            self.values += len(scalars)
+            self.bytes += sum(len(k) + len(v) for k, v in scalars.items())
+            if progress is not None: progress(self)
+        if format == 'binary':
+            codec.write_char(b'E')
+        file.flush()
+
+class Importer(object):
+    """
+    Importer(store, path=(), batch=CHUNK_ITEMS, pipeline=16) -> new instance
+
+    Streams the contents of a file written by Exporter into a datastore, as
+    used by main_transfer().
+
+    store is the datastore to write to, and path is prepended to the paths
+    read from the file. The format of the file is detected automatically.
+    Scalars are written using put_all() operations of at most batch values
+    each, of which up to pipeline are submitted per round trip if store is a
+    RemoteDataStore; hence, the memory required is bounded by the size of
+    batch * pipeline values (or of the largest node in a binary export,
+    whichever is larger). Values already present in store are overwritten if
+    the file contains the same keys, and retained otherwise.
+
+    The values and bytes attributes count the scalars imported and the total
+    size of their keys and values so far.
+    """
+
+    def __init__(self, store, path=(), batch=CHUNK_ITEMS, pipeline=16):
+        "Instance initializer; see class docstring for details."
+        if batch < 1 or pipeline < 1:
+            raise ValueError('Batch size and pipelining depth must be '
+                'positive')
+        self.store = store
+        self.path = tuple(path)
+        self.batch = batch
+        self.pipeline = pipeline
+        self.values = 0
+        self.bytes = 0
+
+    @staticmethod
+    def _decode_item(obj):
+        "Internal helper method."
+        if isinstance(obj, dict):
+            return binascii.a2b_base64(obj['base64'].encode('ascii'))
+        return obj.encode('utf-8')
+
+    def records(self, file):
+        """
+        Parse the binary file-like object file.
+
+        This is a generator yielding (path, scalars) pairs, where path is a
+        tuple relative to the root of the export and scalars is a mapping of
+        at most batch items to be stored at that path; consecutive scalars
+        of the same node are grouped together. ValueError is raised if the
+        file is malformed.
+        """
+        head = file.read(len(EXPORT_MAGIC))
+        if head == EXPORT_MAGIC:
+            codec = Codec(file, None, 2)
+            try:
+                while 1:
+                    cmd = codec.read_char()
+                    if cmd == b'E': break
+                    if cmd != b'N':
+                        raise ValueError('Invalid record in export file')
+                    path, scalars = codec.readf('am')
+                    items = list(scalars.items())
+                    for i in range(0, max(len(items), 1), self.batch):
+                        yield (tuple(path), dict(items[i:i + self.batch]))
+            except EOFError:
+                raise ValueError('Truncated export file')
+            return
+        parent, scalars = None, {}
+        for line in itertools.chain(io.BytesIO(head + file.readline()),
+                                    file):
+            if not line.strip(): continue
+            try:
+                record = json.loads(line.decode('utf-8'))
+                path = tuple(self._decode_item(i) for i in record['path'])
+                value = record.get('value')
+                if value is not None:
+                    if not path: raise ValueError('Empty path')
+                    value = self._decode_item(value)
+            except (ValueError, TypeError, KeyError, AttributeError):
+                raise ValueError('Invalid record in export file: %r' %
+                                 (line,))
+            if value is None:
+                if scalars: yield (parent, scalars)
+                parent, scalars = None, {}
+                yield (path, {})
+                continue
+            if scalars and (path[:-1] != parent or
+                            len(scalars) >= self.batch):
+                yield (parent, scalars)
+                scalars = {}
+            parent = path[:-1]
+            scalars[path[-1]] = value
+        if scalars: yield (parent, scalars)
+
+    def run(self, file, progress=None):
+        """
+        Import the contents of the binary file-like object file.
+
+        progress, if not None, is called with this instance as the only
+        argument after every round trip.
+        """
+        store, remote = self.store, isinstance(self.store, RemoteDataStore)
+        def submit(batch):
+            if remote and len(batch) > 1:
+                for res in store.pipeline([('put_all', args)
+                                           for args in batch]):
+                    if isinstance(res, HKVError): raise res
+            else:
+                for args in batch:
+                    store.put_all(*args)
+            for _, scalars in batch:
+                self.values += len(scalars)
+                self.bytes += sum(len(k) + len(v)
+                                  for k, v in scalars.items())
+            if progress is not None: progress(self)
+        batch = []
+        for path, scalars in self.records(file):
+            batch.append((self.path + path, scalars))
+            if len(batch) >= self.pipeline:
+                submit(batch)
+                batch = []
+        if batch: submit(batch)
+
+def main_listen(params, no_timestamps, loglevel, backlog=0, primary=None,
+                slowlog=None, capture=None, hotkeys=None, hotkeys_sample=16,
+                spill_dir=None, spill_after=60):
     """
     Helper function for running a server from the command line.
 
-    Invoked by main().
+    primary, if not None, is a dictionary as returned by parse_url()
+    describing the server to replicate from; slowlog is the slow-operation
+    threshold in milliseconds (or None); capture is the name of a file to
+    record a Capture into (or None); hotkeys is a comma-separated list of
+    path prefix lengths to track the hottest paths at (or None), sampling
+    one in hotkeys_sample accesses; spill_dir is the directory to spill
+    datastores idle for spill_after minutes to (or None). Invoked by main().
     """
     if 'dsname' in params:
         raise SystemExit('ERROR: Must not specify datastore name when '
             'listening')
+    if primary is not None:
+        if 'dsname' in primary:
+            raise SystemExit('ERROR: Must not specify datastore name when '
+                'replicating')
+        params = dict(params, primary=primary['addr'],
+                      primary_family=primary['addrfamily'])
     if no_timestamps:
         logging.basicConfig(format='[%(name)s %(levelname)s] %(message)s',
                             level=loglevel)
     else:
         logging.basicConfig(format='[%(asctime)s %(name)s %(levelname)s] '
             '%(message)s', datefmt='%Y-%m-%d %H:%M:%S', level=loglevel)
-    server = DataStoreServer(**params)
+    if slowlog is not None: slowlog /= 1000.0
+    if hotkeys is not None:
+        try:
+            hotkeys = HotKeyTracker([int(d) for d in hotkeys.split(',')],
+                                    hotkeys_sample)
+        except ValueError:
+            raise SystemExit('ERROR: Invalid hot-key tracking settings')
+    try:
+        server = DataStoreServer(backlog=backlog, slowlog_threshold=slowlog,
+                                 hotkeys=hotkeys, spill_dir=spill_dir,
+                                 spill_after=spill_after * 60, **params)
+    except (IOError, OSError) as exc:
+        raise SystemExit('ERROR: %s' % exc)
+    if capture is not None:
+        try:
+            server.start_capture(open(capture, 'wb'))
+        except IOError as exc:
+            raise SystemExit('ERROR: %s' % exc)
     try:
         server.main()
     except KeyboardInterrupt:
         pass
+    finally:
+        server.stop_capture()
 
-def main_command(params, command, *args):
-    """
-    Helper function for running a single-command client from the command line.
+# Commands of the command-line client that concern the server rather than a
+# datastore, and the corresponding RemoteDataStore methods.
+SERVER_COMMANDS = {'replication': 'replication_info', 'stats': 'stats',
+                   'slowlog': 'slowlog', 'hotkeys': 'hotkeys',
+                   'datastores': 'list_datastores', 'drop': 'drop_datastore'}
 
-    Invoked by main().
+def parse_command(command, args):
+    """
+    Helper function converting the arguments of a command-line client
+    command into the arguments of the corresponding method.
+
+    The method is named by SERVER_COMMANDS for the commands listed there
+    (being one of RemoteDataStore) and equal to the command for others
+    (being one of TextDataStore). Commands not corresponding to a single
+    method (such as put_stream) are not handled. ValueError is raised if the
+    command or its arguments are invalid. Used by main_command() and
+    main_pipe().
     """
     def ensure_args(min=1, max=None):
         "Helper function for checking the argument count of a command,"
         if len(args) < min:
-            raise SystemExit('ERROR: Too few arguments for %s' % command)
+            raise ValueError('Too few arguments for %s' % command)
         if max is not None and len(args) > max:
-            raise SystemExit('ERROR: Too many arguments for %s' % command)
-    if 'dsname' not in params:
-        raise SystemExit('ERROR: Must specify datastore name when connecting')
-    # Parse command line
-    if command in ('get', 'get_all', 'delete', 'delete_all'):
+            raise ValueError('Too many arguments for %s' % command)
+    if command in ('slowlog', 'hotkeys'):
+        ensure_args(0, 1)
+        if args and args[0] != 'clear':
+            raise ValueError('Invalid argument for %s: %s' %
+                             (command, args[0]))
+        return (bool(args),)
+    elif command == 'drop':
         ensure_args(1, 1)
-        cmdargs = args
+        return (args[0].encode('utf-8'),)
+    elif command in SERVER_COMMANDS:
+        ensure_args(0, 0)
+        return tuple(args)
+    elif command in ('get', 'get_all', 'delete', 'delete_all',
+                     'version', 'stat', 'create_index', 'drop_index'):
+        ensure_args(1, 1)
+        return tuple(args)
     elif command == 'list':
         ensure_args(1, 2)
         raw_flags, flags = (args[1] if len(args) == 2 else 'a'), 0
@@ -1332,21 +6898,125 @@ def main_command(params, command, *args):
             elif char == 'a':
                 flags |= LCLASS_ANY
             else:
-                raise SystemExit('ERROR: Unrecognized listing class '
-                    'character: %s' % char)
-        cmdargs = (args[0], flags)
-    elif command == 'put':
+                raise ValueError('Unrecognized listing class character: '
+                                 '%s' % char)
+        return (args[0], flags)
+    elif command == 'query':
+        ensure_args(1, 3)
+        limit, values_only = 0, False
+        for arg in args[1:]:
+            if arg == 'values':
+                values_only = True
+                continue
+            try:
+                limit = int(arg)
+            except ValueError:
+                raise ValueError('Invalid argument for query: %s' % arg)
+        return (args[0], limit, values_only)
+    elif command in ('put', 'append', 'put_if_absent', 'copy', 'move',
+                     'lookup'):
         ensure_args(2, 2)
-        cmdargs = args
+        return tuple(args)
+    elif command == 'cas':
+        ensure_args(3, 3)
+        return tuple(args)
+    elif command == 'incr':
+        ensure_args(1, 3)
+        try:
+            numbers = tuple(int(a) for a in args[1:])
+        except ValueError:
+            raise ValueError('Invalid integer argument for incr')
+        if len(numbers) == 2 and numbers[1] < 0:
+            raise ValueError('Invalid width for incr: %s' % numbers[1])
+        return (args[0],) + numbers
     elif command in ('put_all', 'replace'):
         ensure_args(1)
         values = {}
         for item in args[1:]:
             k, _, v = item.partition('=')
             values[k] = v
-        cmdargs = (args[0], values)
+        return (args[0], values)
+    else:
+        raise ValueError('Unknown command: %s' % command)
+
+def format_result(command, cmdargs, result):
+    """
+    Helper function converting the result of a command-line client command
+    into a list of lines of output.
+
+    cmdargs are the arguments the command was invoked with, as returned by
+    parse_command(). Used by main_command() and main_pipe().
+    """
+    if command == 'stat':
+        result = collections.OrderedDict(zip(('keys', 'nodes', 'bytes'),
+                                             result))
+    elif command == 'query' and not cmdargs[2]:
+        result = collections.OrderedDict(result)
+    if result is None:
+        return []
+    elif isinstance(result, (str, int)):
+        return [str(result)]
+    elif isinstance(result, list):
+        ret = []
+        for item in result:
+            if isinstance(item, dict):
+                item = ' '.join('%s=%s' % i for i in sorted(item.items()))
+            ret.append(str(item))
+        return ret
+    elif isinstance(result, dict):
+        return ['%s=%s' % item for item in result.items()]
+    else:
+        raise RuntimeError('Unrecognized result: %r' % (result,))
+
+def main_command(params, command, *args):
+    """
+    Helper function for running a single-command client from the command line.
+
+    Invoked by main().
+    """
+    def ensure_args(min=1, max=None):
+        "Helper function for checking the argument count of a command,"
+        if len(args) < min:
+            raise SystemExit('ERROR: Too few arguments for %s' % command)
+        if max is not None and len(args) > max:
+            raise SystemExit('ERROR: Too many arguments for %s' % command)
+    if ('dsname' not in params and command not in SERVER_COMMANDS and
+            command not in ('bench', 'replay')):
+        raise SystemExit('ERROR: Must specify datastore name when connecting')
+    # Parse command line
+    if command == 'get_stream':
+        ensure_args(1, 1)
+        cmdargs = args
+    elif command == 'put_stream':
+        ensure_args(1, 2)
+        if len(args) == 1 or args[1] == '-':
+            source = getattr(sys.stdin, 'buffer', sys.stdin)
+        else:
+            try:
+                source = open(args[1], 'rb')
+            except IOError as exc:
+                raise SystemExit('ERROR: %s' % exc)
+        cmdargs = (args[0], source)
+    elif command == 'rebalance':
+        ensure_args(1)
+        main_rebalance(params['dsname'], *args)
+        return
+    elif command in ('export', 'import'):
+        ensure_args(1)
+        main_transfer(params, command, *args)
+        return
+    elif command == 'bench':
+        main_bench(params, *args)
+        return
+    elif command == 'replay':
+        ensure_args(1, 2)
+        main_replay(params, *args)
+        return
     else:
-        raise SystemExit('ERROR: Unknown command: %s' % command)
+        try:
+            cmdargs = parse_command(command, args)
+        except ValueError as exc:
+            raise SystemExit('ERROR: %s' % exc)
     # Create client and execute command
     client = RemoteDataStore(**params)
     try:
@@ -1355,23 +7025,477 @@ def main_command(params, command, *args):
         raise SystemExit('ERROR: %s' % exc)
     wrapper = TextDataStore(client)
     try:
-        result = getattr(wrapper, command)(*cmdargs)
+        if command in SERVER_COMMANDS:
+            result = getattr(client, SERVER_COMMANDS[command])(*cmdargs)
+        else:
+            result = getattr(wrapper, command)(*cmdargs)
+        if command == 'get_stream':
+            output = getattr(sys.stdout, 'buffer', sys.stdout)
+            for chunk in read_chunks(result):
+                output.write(chunk)
+            output.flush()
+            result = None
     except (HKVError, ValueError) as exc:
         raise SystemExit('ERROR: %s' % exc)
     finally:
         client.close()
-    if result is None:
-        pass
-    elif isinstance(result, str):
-        print (result)
-    elif isinstance(result, list):
-        for item in result:
-            print (item)
-    elif isinstance(result, dict):
-        for key, value in result.items():
-            print ('%s=%s' % (key, value))
+    for line in format_result(command, cmdargs, result):
+        print (line)
+
+def main_pipe(params, depth=64):
+    """
+    Helper function for running many commands over a single connection from
+    the command line.
+
+    Commands are read from standard input, one per line, using the same
+    syntax as single commands (with shell-like quoting; blank lines and
+    comments starting with "#" are ignored); commands that do not
+    correspond to a single datastore or server method (such as put_stream
+    or bench) are not supported. Up to depth commands are submitted per
+    round trip (see RemoteDataStore.pipeline_calls()); hence, their
+    results are not printed until that many commands have been read or
+    the input ends. The output of each command is printed in order;
+    errors are reported on standard error, prefixed with the line number,
+    and the exit status indicates whether any command failed. Invoked by
+    main().
+    """
+    import shlex
+    if depth < 1: raise SystemExit('ERROR: Pipelining depth must be positive')
+    client = RemoteDataStore(**params)
+    try:
+        client.connect()
+    except IOError as exc:
+        raise SystemExit('ERROR: %s' % exc)
+    wrapper = TextDataStore(client)
+    def make_call(command, cmdargs):
+        if isinstance(cmdargs, Exception):
+            # Report invalid lines in order with the others.
+            def fail():
+                raise cmdargs
+            return fail
+        elif command in SERVER_COMMANDS:
+            method = getattr(client, SERVER_COMMANDS[command])
+        else:
+            method = getattr(wrapper, command)
+        return lambda: method(*cmdargs)
+    def flush():
+        results = client.pipeline_calls([call for _, _, _, call in batch])
+        for (lineno, command, cmdargs, _), result in zip(batch, results):
+            if isinstance(result, Exception):
+                report(lineno, result)
+                continue
+            for line in format_result(command, cmdargs, result):
+                print (line)
+        sys.stdout.flush()
+        del batch[:]
+    def report(lineno, exc):
+        sys.stdout.flush()
+        sys.stderr.write('ERROR: line %s: %s\n' % (lineno, exc))
+        failed[0] += 1
+    batch, failed = [], [0]
+    try:
+        for lineno, line in enumerate(sys.stdin, 1):
+            try:
+                words = shlex.split(line, comments=True)
+                if not words: continue
+                command, cmdargs = words[0], parse_command(words[0],
+                                                           words[1:])
+                if 'dsname' not in params and command not in SERVER_COMMANDS:
+                    raise ValueError('Must specify datastore name when '
+                                     'connecting')
+            except ValueError as exc:
+                command, cmdargs = None, exc
+            batch.append((lineno, command, cmdargs,
+                          make_call(command, cmdargs)))
+            if len(batch) >= depth: flush()
+        if batch: flush()
+    except (IOError, HKVError) as exc:
+        raise SystemExit('ERROR: %s' % exc)
+    finally:
+        client.close()
+    if failed[0]:
+        raise SystemExit('ERROR: %s commands failed' % failed[0])
+
+def main_rebalance(dsname, *args):
+    """
+    Helper function for rebalancing a set of shards from the command line.
+
+    args are URLs of the shards (all of them, including new ones), optionally
+    preceded by depth=N and vnodes=N settings (see ShardedDataStore). The
+    shards are named by the host:port parts of their URLs. Invoked by
+    main_command().
+    """
+    options, urls = {'depth': 1, 'vnodes': 64}, []
+    for arg in args:
+        name, sep, value = arg.partition('=')
+        if sep and name in options:
+            try:
+                options[name] = int(value)
+            except ValueError:
+                raise SystemExit('ERROR: Invalid value for %s' % name)
+        else:
+            urls.append(arg)
+    if not urls: raise SystemExit('ERROR: No shards specified')
+    shards = {}
+    try:
+        for url in urls:
+            params = parse_url(url)
+            params['dsname'] = dsname
+            client = RemoteDataStore(**params)
+            shards[('%s:%s' % params['addr']).encode('utf-8')] = client
+    except ValueError:
+        raise SystemExit('ERROR: Invalid hkv:// URL: %s' % url)
+    store = ShardedDataStore(shards, **options)
+    def report(path, source, dest):
+        print ('%s: %s -> %s' % (b'/'.join(path).decode('utf-8', 'replace'),
+                                 source.decode('utf-8'),
+                                 dest.decode('utf-8')))
+    try:
+        for client in shards.values():
+            client.connect()
+        moved = store.rebalance(report)
+    except (IOError, HKVError) as exc:
+        raise SystemExit('ERROR: %s' % exc)
+    finally:
+        store.close()
+    print ('Moved %s values' % moved)
+
+def main_transfer(params, command, *args):
+    """
+    Helper function for exporting or importing a datastore from the command
+    line.
+
+    command is either "export" or "import"; args are the name of the file to
+    write to or read from ("-" for standard output or input, respectively),
+    optionally followed by a slash-delimited path of the subtree to export
+    or import into (defaulting to the whole datastore) and key=value
+    settings:
+    format : Format of the export, either jsonl or binary (default jsonl;
+             export only, as imports detect the format). See Exporter.
+    batch : Nodes fetched per round trip when exporting (default 64), or
+            values per put_all operation when importing (default
+            CHUNK_ITEMS).
+    pipeline : put_all operations submitted per round trip (default 16;
+               import only).
+    Progress is reported on standard error about once per second, followed
+    by a summary including the throughput. Invoked by main_command().
+    """
+    export = (command == 'export')
+    if export:
+        options = {'format': 'jsonl', 'batch': 64}
     else:
-        raise RuntimeError('Unrecognized result: %r' % (result,))
+        options = {'batch': CHUNK_ITEMS, 'pipeline': 16}
+    path = []
+    for arg in args[1:]:
+        name, sep, value = arg.partition('=')
+        if not sep:
+            path = [p.encode('utf-8') for p in arg.split('/') if p]
+        elif name == 'format' and export:
+            if value not in Exporter.FORMATS:
+                raise SystemExit('ERROR: Unknown export format: %s' % value)
+            options[name] = value
+        elif name in options:
+            try:
+                options[name] = int(value)
+            except ValueError:
+                raise SystemExit('ERROR: Invalid value for %s' % name)
+        else:
+            raise SystemExit('ERROR: Invalid argument for %s: %s' %
+                             (command, arg))
+    client = RemoteDataStore(**params)
+    try:
+        if export:
+            worker = Exporter(client, path, options['batch'])
+        else:
+            worker = Importer(client, path, options['batch'],
+                              options['pipeline'])
+    except ValueError as exc:
+        raise SystemExit('ERROR: %s' % exc)
+    def report():
+        elapsed = timer() - begin
+        sys.stderr.write('%s values, %s bytes in %.3f s (%.0f values/s, '
+            '%.3f MB/s)\n' % (worker.values, worker.bytes, elapsed,
+                              worker.values / (elapsed or 1),
+                              worker.bytes / (elapsed or 1) / 1e6))
+    def progress(worker):
+        if timer() - last[0] >= 1:
+            last[0] = timer()
+            report()
+    if args[0] == '-':
+        stream = sys.stdout if export else sys.stdin
+        file = getattr(stream, 'buffer', stream)
+    else:
+        try:
+            file = open(args[0], 'wb' if export else 'rb')
+        except IOError as exc:
+            raise SystemExit('ERROR: %s' % exc)
+    begin = timer()
+    last = [begin]
+    try:
+        client.connect()
+        if export:
+            worker.run(file, options['format'], progress)
+        else:
+            worker.run(file, progress)
+    except (IOError, HKVError, ValueError) as exc:
+        raise SystemExit('ERROR: %s' % exc)
+    finally:
+        client.close()
+        if args[0] != '-': file.close()
+    report()
+
+def bench_worker(task):
+    """
+    Helper function running one client of a benchmark.
+
+    task is a (generator, count, seed) tuple; see LoadGenerator.run() for
+    the return value. Invoked by main_bench(), possibly in a separate
+    process.
+    """
+    generator, count, seed = task
+    client = RemoteDataStore(**generator.params)
+    client.connect()
+    try:
+        return generator.run(client, count, seed)
+    finally:
+        client.close()
+
+def main_bench(params, *args):
+    """
+    Helper function for benchmarking a server from the command line.
+
+    args are key=value settings:
+    clients : Amount of concurrent clients (default 1).
+    processes : If nonzero, run each client in its own process instead of a
+                thread (default 0).
+    ops : Total amount of operations to perform (default 100000).
+    mix : Operation mix as comma-separated NAME:WEIGHT pairs, where NAME is
+          one of get, put, get_all, list, and put_all (default get:80,put:20).
+    keys : Amount of distinct keys (default 1000).
+    depth : Length of the paths of the keys (default 1).
+    size : Length of values written, either a number or a MIN-MAX range
+           (default 100).
+    pipeline : Operations submitted per round trip (default 1).
+    local : If nonzero, benchmark a server started in this process on an
+            ephemeral loopback port instead of the one configured (default
+            0).
+    seed : Seed for the random number generators (default 0).
+    The datastore to use defaults to "bench"; it is populated with all keys
+    before the measurement starts. Invoked by main_command().
+    """
+    import multiprocessing
+    options = {'clients': 1, 'processes': 0, 'ops': 100000, 'keys': 1000,
+               'depth': 1, 'pipeline': 1, 'local': 0, 'seed': 0}
+    mix, sizes = {'get': 80, 'put': 20}, (100, 100)
+    try:
+        for arg in args:
+            name, sep, value = arg.partition('=')
+            if name in options and sep:
+                options[name] = int(value)
+            elif name == 'mix' and sep:
+                mix = {}
+                for item in value.split(','):
+                    opname, _, weight = item.partition(':')
+                    mix[opname] = int(weight or 1)
+            elif name == 'size' and sep:
+                low, _, high = value.partition('-')
+                sizes = (int(low), int(high or low))
+            else:
+                raise SystemExit('ERROR: Invalid argument for bench: %s' %
+                                 arg)
+    except ValueError:
+        raise SystemExit('ERROR: Invalid value in argument for bench: %s' %
+                         arg)
+    if options['clients'] < 1 or options['ops'] < 1:
+        raise SystemExit('ERROR: Client and operation counts must be '
+                         'positive')
+    params = dict(params)
+    params.setdefault('dsname', b'bench')
+    if options['local']:
+        server = DataStoreServer(('127.0.0.1', 0))
+        server.listen()
+        def accept_loop():
+            while 1:
+                server.accept()
+        spawn_thread(accept_loop)
+        params.update(addr=server.socket.getsockname(),
+                      addrfamily=socket.AF_INET)
+    try:
+        generator = LoadGenerator(params, mix, options['keys'],
+                                  options['depth'], sizes,
+                                  options['pipeline'])
+    except ValueError as exc:
+        raise SystemExit('ERROR: %s' % exc)
+    clients, ops = options['clients'], options['ops']
+    tasks = [(generator, ops // clients + (i < ops % clients),
+              options['seed'] + i + 1) for i in range(clients)]
+    try:
+        client = RemoteDataStore(**params)
+        client.connect()
+        try:
+            generator.populate(client, options['seed'])
+        finally:
+            client.close()
+        if options['processes']:
+            pool = multiprocessing.Pool(clients)
+            try:
+                results = pool.map(bench_worker, tasks)
+            finally:
+                pool.close()
+        else:
+            results = [None] * clients
+            def run(index):
+                results[index] = bench_worker(tasks[index])
+            threads = [spawn_thread(run, i) for i in range(clients)]
+            for thr in threads: thr.join()
+            if None in results:
+                raise SystemExit('ERROR: Benchmark client failed')
+    except (IOError, HKVError) as exc:
+        raise SystemExit('ERROR: %s' % exc)
+    histograms = dict((name, Histogram()) for name in mix)
+    total, errors = Histogram(), 0
+    for hists, errs, _ in results:
+        for name, hist in hists.items():
+            histograms[name].merge(hist)
+            total.merge(hist)
+        errors += errs
+    elapsed = max(r[2] for r in results)
+    print ('%s clients, %s operations, pipeline %s, %s keys, depth %s, '
+           'values %s-%s bytes' % (clients, ops, options['pipeline'],
+                                   options['keys'], options['depth'],
+                                   sizes[0], sizes[1]))
+    fmt = '%-8s %10s ops %10.0f ops/s  p50 %9.3f  p99 %9.3f  p999 %9.3f ms'
+    for name in sorted(histograms) + ['total']:
+        hist = total if name == 'total' else histograms[name]
+        if not hist.count: continue
+        print (fmt % (name, hist.count, hist.count / elapsed,
+                      hist.quantile(0.5) * 1000, hist.quantile(0.99) * 1000,
+                      hist.quantile(0.999) * 1000))
+    print ('%s errors in %.3f s' % (errors, elapsed))
+
+def replay_worker(params, frames, speed, origin, begin):
+    """
+    Helper function replaying the command frames of one connection of a
+    Capture.
+
+    params are keyword arguments for RemoteDataStore; frames is a list of
+    (timestamp, frame) pairs; speed is the factor by which to accelerate the
+    replay (zero meaning as fast as possible); origin is the timestamp of the
+    start of the capture and begin the timer() value corresponding to it.
+    Returns a (histograms, errors, lag) tuple, where histograms maps command
+    names to Histograms of response times, errors is the amount of commands
+    that failed, and lag is the maximum delay (in seconds) by which a command
+    was sent later than scheduled. Invoked by main_replay().
+    """
+    histograms, errors, lag = {}, 0, 0.0
+    # The frames are encoded in the protocol version the original client
+    # negotiated, so that the negotiation has to be replayed as well.
+    client = RemoteDataStore(protocol=1, **params)
+    client.connect()
+    try:
+        for ts, frame in frames:
+            if speed:
+                delay = begin + (ts - origin) / speed - timer()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    lag = max(lag, -delay)
+            header = Codec(io.BytesIO(frame), None, client.codec.protocol)
+            cmd = header.read_char()
+            if cmd == b'H':
+                header.read_int()
+                cmd = header.read_char()
+            if cmd == b'V':
+                cmd = header.read_char()
+            elif cmd == b'w':
+                header.read_signed()
+                cmd = header.read_char()
+            name = COMMAND_NAMES.get(cmd, repr(cmd))
+            start = timer()
+            try:
+                if cmd == b'N':
+                    client.negotiate(ord(header.read_char()))
+                elif cmd == b'z':
+                    method, threshold = header.readf('si')
+                    client.compress(method.decode('ascii') or None,
+                                    threshold)
+                else:
+                    client._run_frame(frame)
+            except HKVError as exc:
+                if exc.code == ERRORS['CONNBROKEN'][0]: raise
+                errors += 1
+            hist = histograms.get(name)
+            if hist is None: hist = histograms[name] = Histogram()
+            hist.add(timer() - start)
+    finally:
+        client.close()
+    return (histograms, errors, lag)
+
+def main_replay(params, *args):
+    """
+    Helper function for replaying a Capture against a server from the
+    command line.
+
+    args are the name of the capture file, optionally followed by a
+    speed=FACTOR setting, which accelerates (or, if less than 1, slows down)
+    the replay relative to the original timing; speed=0 replays as fast as
+    possible. The default is 1. Every connection of the capture is replayed
+    by a thread of its own, preserving the order of commands within each
+    connection. Invoked by main_command().
+    """
+    speed = 1.0
+    for arg in args[1:]:
+        name, sep, value = arg.partition('=')
+        try:
+            if name != 'speed' or not sep: raise ValueError
+            speed = float(value)
+            if speed < 0: raise ValueError
+        except ValueError:
+            raise SystemExit('ERROR: Invalid argument for replay: %s' % arg)
+    params = dict(params)
+    params.pop('dsname', None)
+    connections, origin = collections.OrderedDict(), None
+    try:
+        with open(args[0], 'rb') as f:
+            for ts, connid, frame in Capture.read(f):
+                if origin is None: origin = ts
+                frames = connections.setdefault(connid, [])
+                if frame is not None: frames.append((ts, frame))
+    except (IOError, ValueError, EOFError) as exc:
+        raise SystemExit('ERROR: Could not read capture: %s' % exc)
+    results = []
+    def run(frames):
+        try:
+            results.append(replay_worker(params, frames, speed, origin,
+                                         begin))
+        except (IOError, HKVError) as exc:
+            sys.stderr.write('ERROR: Replaying connection failed: %s\n' %
+                             exc)
+    begin = timer()
+    threads = [spawn_thread(run, frames) for frames in connections.values()
+               if frames]
+    for thr in threads: thr.join()
+    elapsed = timer() - begin
+    total, histograms, errors, lag = Histogram(), {}, 0, 0.0
+    for hists, errs, lg in results:
+        for name, hist in hists.items():
+            histograms.setdefault(name, Histogram()).merge(hist)
+            total.merge(hist)
+        errors += errs
+        lag = max(lag, lg)
+    print ('%s connections, %s commands, speed %s' % (len(threads),
+                                                      total.count, speed))
+    fmt = '%-14s %10s cmds  p50 %9.3f  p99 %9.3f  p999 %9.3f ms'
+    for name in sorted(histograms) + ['total']:
+        hist = total if name == 'total' else histograms[name]
+        print (fmt % (name, hist.count, hist.quantile(0.5) * 1000,
+                      hist.quantile(0.99) * 1000,
+                      hist.quantile(0.999) * 1000))
+    print ('%s errors in %.3f s, max lag %.3f ms' % (errors, elapsed,
+                                                     lag * 1000))
+    if len(results) != len(threads):
+        raise SystemExit('ERROR: %s connections failed' %
+                         (len(threads) - len(results)))
 
 def main():
     """
@@ -1389,13 +7513,49 @@ def main():
                    help='No timestamps on logs')
     p.add_argument('--loglevel', '-L', default='INFO', metavar='LEVEL',
                    help='Logging level (defaults to INFO)')
+    p.add_argument('--backlog', '-B', type=int, default=0, metavar='N',
+                   help='Serve replicas, retaining the last N modifications '
+                       '(server mode only)')
+    p.add_argument('--replicate-from', '-R', metavar='URL',
+                   help='Replicate the server at URL (server mode only)')
+    p.add_argument('--slowlog', '-S', type=float, metavar='MS',
+                   help='Log operations taking at least MS milliseconds '
+                       '(server mode only)')
+    p.add_argument('--capture', '-C', metavar='FILE',
+                   help='Record all commands received into FILE for '
+                       'replaying (server mode only)')
+    p.add_argument('--hotkeys', '-H', metavar='DEPTHS',
+                   help='Track the hottest path prefixes of the given '
+                       'comma-separated lengths (server mode only)')
+    p.add_argument('--hotkeys-sample', type=int, default=16, metavar='N',
+                   help='Sample one in N accesses for hot-key tracking '
+                       '(defaults to 16)')
+    p.add_argument('--spill-dir', metavar='DIR',
+                   help='Move idle datastores from memory into files in DIR '
+                       '(server mode only)')
+    p.add_argument('--spill-after', type=float, default=60,
+                   metavar='MINUTES',
+                   help='Consider datastores idle after MINUTES minutes '
+                       'without clients (defaults to 60)')
+    p.add_argument('--compress', '-z', metavar='METHOD',
+                   choices=sorted(COMPRESSION_METHODS),
+                   help='Compress large transfers using METHOD if the '
+                       'server supports it (client mode only)')
+    p.add_argument('--pipe', '-p', action='store_true',
+                   help='Execute commands read from standard input, one '
+                       'per line, over a single connection (client mode '
+                       'only)')
+    p.add_argument('--pipe-depth', type=int, default=64, metavar='N',
+                   help='Submit up to N commands per round trip in pipe '
+                       'mode (defaults to 64)')
     p.add_argument('command', nargs='?',
                    help='Command to execute (client mode only)')
     p.add_argument('arg', nargs='*',
                    help='Additional arguments to the command')
     result = p.parse_args()
-    if bool(result.listen) == bool(result.command):
-        raise SystemExit('ERROR: Must specify either -l or command.')
+    if (bool(result.listen) + bool(result.command) +
+            bool(result.pipe)) != 1:
+        raise SystemExit('ERROR: Must specify either -l, -p, or command.')
     try:
         if result.url is not None:
             params = parse_url(result.url)
@@ -1413,8 +7573,23 @@ def main():
         dsname_string = os.environ.get('HKV_DATASTORE')
         if dsname_string:
             params['dsname'] = dsname_string.encode('utf-8')
+    if result.compress is not None:
+        params['compression'] = result.compress
+    if result.replicate_from is not None:
+        try:
+            primary = parse_url(result.replicate_from)
+        except ValueError:
+            raise SystemExit('ERROR: Invalid hkv:// URL: %s' %
+                             result.replicate_from)
+    else:
+        primary = None
     if result.listen:
-        main_listen(params, result.no_timestamps, result.loglevel)
+        main_listen(params, result.no_timestamps, result.loglevel,
+                    result.backlog, primary, result.slowlog,
+                    result.capture, result.hotkeys, result.hotkeys_sample,
+                    result.spill_dir, result.spill_after)
+    elif result.pipe:
+        main_pipe(params, result.pipe_depth)
     else:
         main_command(params, result.command, *result.arg)
 
@@ -0,0 +1,56 @@
+# -*- coding: ascii -*-
+
+"""
+Shared helpers for the hkv test suite.
+"""
+
+import sys, os
+import io
+import socket
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+import hkv
+
+def start_server(**kwds):
+    """
+    Create a DataStoreServer listening on an ephemeral local port, run its
+    accept loop in a background thread, and return it.
+
+    The address actually bound is stored in the server's addr attribute;
+    calling close() on the server stops the accept loop.
+    """
+    server = hkv.DataStoreServer(('127.0.0.1', 0), **kwds)
+    server.listen()
+    server.addr = server.socket.getsockname()
+    def accept_loop():
+        while 1:
+            try:
+                server.accept()
+            except (IOError, socket.error):
+                break
+    hkv.spawn_thread(accept_loop)
+    return server
+
+def connect(server, dsname=b'test', **kwds):
+    """
+    Create a RemoteDataStore for the datastore dsname of server, connect it,
+    and return it.
+    """
+    client = hkv.RemoteDataStore(server.addr, dsname, **kwds)
+    client.connect()
+    return client
+
+class FailingReader(object):
+    """
+    A binary stream yielding data and then, instead of signalling the end of
+    the stream, raising an IOError.
+    """
+
+    def __init__(self, data):
+        self.file = io.BytesIO(data)
+
+    def read(self, size=-1):
+        ret = self.file.read(size)
+        if not ret: raise IOError('Simulated read failure')
+        return ret
@@ -0,0 +1,72 @@
+# -*- coding: ascii -*-
+
+"""
+Tests for Codec.
+"""
+
+import io
+import unittest
+
+from support import hkv
+
+class VarintTest(unittest.TestCase):
+
+    def encode(self, value):
+        buf = io.BytesIO()
+        hkv.Codec(None, buf, 2).write_varint(value)
+        return buf.getvalue()
+
+    def decoder(self, data):
+        return hkv.Codec(io.BytesIO(data), None, 2)
+
+    def test_roundtrip(self):
+        for value in (0, 1, 0x7F, 0x80, 300, 1 << 14, 1 << 63,
+                      (1 << 64) - 1):
+            data = self.encode(value)
+            codec = self.decoder(data)
+            self.assertEqual(codec.read_varint(), value)
+            self.assertEqual(codec.bytes_read, len(data))
+
+    def test_sequence(self):
+        values = [5, 0x80, 0, 0x7F, 1 << 20, 1]
+        codec = self.decoder(b''.join(map(self.encode, values)))
+        self.assertEqual([codec.read_varint() for v in values], values)
+
+    def test_truncated(self):
+        for data in (b'', b'\x80', b'\xFF\xFF'):
+            self.assertRaises(EOFError, self.decoder(data).read_varint)
+
+    def test_too_long(self):
+        for data in (b'\x80' * 10 + b'\x01', b'\xff' * 9 + b'\x7f',
+                     b'\x80' * 9 + b'\x02', b'\xff' * 9 + b'\x81\x00'):
+            codec = self.decoder(data)
+            self.assertRaises(ValueError, codec.read_varint)
+        codec = self.decoder(b'\xff' * 9 + b'\x01')
+        self.assertEqual(codec.read_varint(), (1 << 64) - 1)
+
+class FrameTest(unittest.TestCase):
+
+    def roundtrip(self, items):
+        buf = io.BytesIO()
+        writer = hkv.Codec(None, buf, 2)
+        writer.set_compression('zlib')
+        for item in items:
+            writer.write_bytes(item)
+        writer.wfile.flush()
+        reader = hkv.Codec(io.BytesIO(buf.getvalue()), None, 2)
+        reader.set_compression('zlib')
+        self.assertEqual([reader.read_bytes() for item in items], items)
+        self.assertEqual(reader.rfile.read(), b'')
+        return writer.compression_stats
+
+    def test_small_writes(self):
+        items = [('%08d' % i).encode() * 8 for i in range(80000)]
+        stats = self.roundtrip(items)
+        self.assertGreater(stats['compressed_frames'], 3)
+
+    def test_large_writes(self):
+        items = [b'x' * 1000, b'y' * (hkv.FRAME_BYTES * 2 + 5), b'z',
+                 b'w' * hkv.FRAME_BYTES, b'v' * (hkv.FRAME_BYTES - 3)]
+        self.roundtrip(items)
+
+if __name__ == '__main__': unittest.main()
@@ -0,0 +1,60 @@
+# -*- coding: ascii -*-
+
+"""
+Tests for ConvertingDataStore and its subclasses.
+"""
+
+import array
+import unittest
+
+from support import hkv
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+class ArrayTest(unittest.TestCase):
+
+    use_numpy = False
+
+    def setUp(self):
+        self.store = hkv.ArrayDataStore(hkv.DataStore(), self.use_numpy)
+
+    def roundtrip(self, value):
+        self.store.put((b'k',), value)
+        return self.store.get((b'k',))
+
+    def test_plain_values(self):
+        magic = hkv.ArrayDataStore.MAGIC
+        for value in (b'', b'plain', magic, magic + b'\x03',
+                      magic + b'\x03\x00<f8', magic + b'\xff\x05' + b'x' * 8,
+                      magic + b'\x03\x00xyz' + b'\0' * 7 + b'a' * 8,
+                      magic + b'\x03\x01<f8' + b'\0' * 8,
+                      magic + b'\x03\x00<f8' + b'\0' * 7 + b'a' * 9):
+            self.store.wrapped.put((b'k',), value)
+            self.assertEqual(self.store.get((b'k',)), value)
+
+    def test_arrays(self):
+        for typecode in ('b', 'B', 'h', 'i', 'l', 'f', 'd'):
+            value = array.array(typecode, [1, 2, 3])
+            self.assertEqual(list(self.roundtrip(value)), [1, 2, 3])
+        self.assertEqual(list(self.roundtrip(array.array('d'))), [])
+
+class NumPyArrayTest(ArrayTest):
+
+    use_numpy = True
+
+    def setUp(self):
+        if numpy is None: self.skipTest('NumPy is not available')
+        super(NumPyArrayTest, self).setUp()
+
+    def test_shapes(self):
+        value = numpy.arange(12, dtype='>i4').reshape(3, 4)
+        result = self.roundtrip(value)
+        self.assertEqual(result.shape, (3, 4))
+        self.assertEqual(result.dtype, value.dtype)
+        self.assertTrue((result == value).all())
+        self.assertEqual(self.roundtrip(numpy.float64(2.5)).shape, ())
+
+if __name__ == '__main__': unittest.main()
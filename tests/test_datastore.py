@@ -0,0 +1,492 @@
+# -*- coding: ascii -*-
+
+"""
+Tests for the local datastore implementations.
+"""
+
+import io
+import unittest
+
+from support import hkv, FailingReader
+
+class CounterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.store = hkv.DataStore()
+
+    def assertError(self, name, func, *args):
+        try:
+            func(*args)
+        except hkv.HKVError as exc:
+            self.assertEqual(exc.name, name)
+        else:
+            self.fail('%s error not raised' % name)
+
+    def test_upper_bound(self):
+        self.assertEqual(self.store.incr((b'c',), hkv.COUNTER_MAX - 1),
+                         hkv.COUNTER_MAX - 1)
+        self.assertEqual(self.store.incr((b'c',)), hkv.COUNTER_MAX)
+        version = self.store.version((b'c',))
+        self.assertError('BADCOUNTER', self.store.incr, (b'c',), 1)
+        self.assertEqual(self.store.get((b'c',)),
+                         str(hkv.COUNTER_MAX).encode('ascii'))
+        self.assertEqual(self.store.version((b'c',)), version)
+
+    def test_lower_bound(self):
+        self.assertEqual(self.store.incr((b'c',), hkv.COUNTER_MIN),
+                         hkv.COUNTER_MIN)
+        self.assertError('BADCOUNTER', self.store.incr, (b'c',), -1)
+        self.assertError('BADCOUNTER', self.store.incr, (b'd',),
+                         hkv.COUNTER_MIN - 1)
+        self.assertError('NOKEY', self.store.get, (b'd',))
+
+    def test_fixed_width_wraps(self):
+        self.store.incr((b'c',), hkv.COUNTER_MAX, 8)
+        self.assertEqual(self.store.incr((b'c',), 1, 8), hkv.COUNTER_MIN)
+
+class VersionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.store = hkv.DataStore()
+
+    def test_put_all_stamps(self):
+        self.store.put_all((b'a', b'b'), {b'x': b'1', b'y': b'2'})
+        version = self.store.version(())
+        for path in ((b'a',), (b'a', b'b'), (b'a', b'b', b'x'),
+                     (b'a', b'b', b'y')):
+            self.assertEqual(self.store.version(path), version)
+        self.store.put_all((b'a', b'b'), {b'y': b'3'})
+        self.assertLess(self.store.version((b'a', b'b', b'x')),
+                        self.store.version((b'a', b'b', b'y')))
+
+    def test_failed_create_stamps(self):
+        self.assertRaises(hkv.HKVError, self.store.incr, (b'a', b'b', b'c'),
+                          hkv.COUNTER_MAX + 1)
+        self.assertEqual(self.store.list((b'a',), hkv.LCLASS_ANY), [b'b'])
+        self.assertNotEqual(self.store.version((b'a',)), 0)
+        self.assertEqual(self.store.version((b'a', b'b')),
+                         self.store.version(()))
+
+class SnapshotTest(unittest.TestCase):
+
+    def setUp(self):
+        self.store = hkv.DataStore()
+        self.store.put((b'a', b'b'), b'1')
+        self.store.create_index((b'a', hkv.QUERY_ONE))
+        self.snapshot = self.store.snapshot()
+
+    def test_writes(self):
+        path, other = (b'a', b'b'), (b'a', b'c')
+        for name, args in (('put', (path, b'2')), ('put_all', (path, {})),
+                           ('replace', ((b'a',), {})), ('delete', (path,)),
+                           ('delete_all', ((b'a',),)), ('incr', (other,)),
+                           ('append', (path, b'2')),
+                           ('cas', (path, b'1', b'2')),
+                           ('put_if_absent', (other, b'2')),
+                           ('put_stream', (other, io.BytesIO(b'2'))),
+                           ('copy', (path, other)), ('move', (path, other)),
+                           ('create_index', ((hkv.QUERY_ANY,),)),
+                           ('drop_index', ((b'a', hkv.QUERY_ONE),))):
+            try:
+                getattr(self.snapshot, name)(*args)
+            except hkv.HKVError as exc:
+                self.assertEqual(exc.name, 'READONLY', name)
+            else:
+                self.fail('%s succeeded on a snapshot' % name)
+        self.assertEqual(self.snapshot.get_all((b'a',)), {b'b': b'1'})
+
+    def test_restore(self):
+        buf = io.BytesIO()
+        hkv.DataStore().dump(hkv.Codec(None, buf))
+        codec = hkv.Codec(io.BytesIO(buf.getvalue()), None)
+        try:
+            self.snapshot.restore(codec)
+        except hkv.HKVError as exc:
+            self.assertEqual(exc.name, 'READONLY')
+        else:
+            self.fail('READONLY error not raised')
+        self.assertEqual(self.snapshot.get((b'a', b'b')), b'1')
+        self.assertEqual(self.snapshot.lookup((b'a', hkv.QUERY_ONE), b'1'),
+                         [(b'a', b'b')])
+
+class PutAllTest(unittest.TestCase):
+
+    def setUp(self):
+        self.store = hkv.DataStore()
+
+    def assertAggregates(self, path):
+        expected = self.store.stat(path)
+        node = self.store._follow_path(path)
+        node = node.clone(node.generation)
+        node.recount()
+        self.assertEqual((node.nkeys, node.nnodes, node.nbytes), expected)
+        root = self.store.data.clone(self.store.data.generation)
+        root.recount()
+        self.assertEqual((root.nkeys, root.nnodes, root.nbytes),
+                         self.store.stat(()))
+
+    def test_aggregates(self):
+        path = (b'a', b'b')
+        self.store.put_all(path, {b'x': b'1', b'y': b'', b'z': b'333'})
+        self.assertAggregates(path)
+        self.store.put_all(path, {b'x': b'11', b'y': b'22'})
+        self.assertAggregates(path)
+        self.store.put_all(path, {b'y': b'', b'new': b'4', b'z': b''})
+        self.assertAggregates(path)
+        self.store.put_all(path, {})
+        self.assertAggregates(path)
+        self.store.put_all(path + (b'n',), {b'k': b'v'})
+        self.store.put_all(path, {b'n': b'scalar', b'm': b'5'})
+        self.assertAggregates(path)
+        self.assertEqual(self.store.stat(path), (6, 0, 18))
+
+    def test_indexes(self):
+        self.store.create_index((b'users', hkv.QUERY_ONE, b'name'))
+        self.store.create_index((b'other', b'name'))
+        self.store.put_all((b'users', b'u1'), {b'name': b'alice',
+                                               b'age': b'30'})
+        self.store.put_all((b'users', b'u2'), {b'name': b'bob'})
+        self.store.put_all((b'users', b'u1'), {b'name': b'carol'})
+        self.store.put_all((b'unrelated',), {b'name': b'alice'})
+        self.assertEqual(self.store.lookup((b'users', hkv.QUERY_ONE,
+                                            b'name'), b'alice'), [])
+        self.assertEqual(self.store.lookup((b'users', hkv.QUERY_ONE,
+                                            b'name'), b'carol'),
+                         [(b'users', b'u1', b'name')])
+        self.assertAggregates((b'users',))
+
+class HandleTest(unittest.TestCase):
+
+    def setUp(self):
+        self.store = hkv.DataStore()
+        self.store.put((b'a', b'b', b'c', b'x'), b'1')
+        self.handle = self.store.handle((b'a', b'b', b'c'))
+
+    def test_write_updates_ancestors(self):
+        path = self.handle.join((b'y',))
+        self.store.put(path, b'22')
+        self.store.put(path, b'333')
+        self.assertEqual(self.store.stat((b'a',)), (2, 2, 8))
+        self.assertEqual(self.store.version((b'a',)), self.store.version(()))
+        self.assertEqual(self.store.version((b'a', b'b', b'c', b'y')),
+                         self.store.version(()))
+        self.assertEqual(self.store.get((b'a', b'b', b'c', b'y')), b'333')
+
+    def test_write_after_snapshot(self):
+        path = self.handle.join((b'x',))
+        self.store.put(path, b'2')
+        snapshot = self.store.snapshot()
+        self.store.put(path, b'3')
+        self.assertEqual(snapshot.get((b'a', b'b', b'c', b'x')), b'2')
+        self.assertEqual(self.store.get((b'a', b'b', b'c', b'x')), b'3')
+        self.assertEqual(snapshot.stat(()), self.store.stat(()))
+
+    def test_write_after_replacement(self):
+        path = self.handle.join((b'x',))
+        self.store.put(path, b'2')
+        self.store.delete((b'a', b'b'))
+        self.store.put((b'a', b'b', b'c', b'x'), b'3')
+        try:
+            self.store.put(path, b'4')
+        except hkv.HKVError as exc:
+            self.assertEqual(exc.name, 'BADHANDLE')
+        else:
+            self.fail('BADHANDLE error not raised')
+        self.assertEqual(self.store.get((b'a', b'b', b'c', b'x')), b'3')
+
+class CopyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.store = hkv.DataStore()
+        self.store.put((b'src', b'a', b'b', b'x'), b'1')
+        self.store.put((b'src', b'a', b'y'), b'2')
+        self.store.put_all((b'sibling',), {b'k%d' % i: b'v'
+                                           for i in range(100)})
+
+    def test_independent(self):
+        sibling = self.store.data[b'sibling']
+        self.store.copy((b'src',), (b'dst',))
+        self.assertIs(self.store.data[b'sibling'], sibling)
+        self.store.put((b'dst', b'a', b'b', b'x'), b'3')
+        self.store.put((b'src', b'a', b'y'), b'4')
+        self.store.delete((b'src', b'a', b'b'))
+        self.assertEqual(self.store.get_all((b'src', b'a')), {b'y': b'4'})
+        self.assertEqual(self.store.get_all((b'dst', b'a')), {b'y': b'2'})
+        self.assertEqual(self.store.get((b'dst', b'a', b'b', b'x')), b'3')
+        self.assertEqual(self.store.stat((b'dst',)), (2, 2, 6))
+        self.assertEqual(self.store.stat((b'src',)), (1, 1, 3))
+
+    def test_into_descendant(self):
+        self.store.copy((b'src',), (b'src', b'a', b'b', b'c'))
+        self.store.put((b'src', b'a', b'b', b'c', b'a', b'y'), b'5')
+        self.assertEqual(self.store.get((b'src', b'a', b'y')), b'2')
+        self.assertEqual(self.store.list((b'src', b'a', b'b', b'c', b'a',
+                                          b'b'), hkv.LCLASS_ANY), [b'x'])
+
+    def test_handles(self):
+        src = self.store.handle((b'src', b'a'))
+        sibling = self.store.handle((b'sibling',))
+        self.store.put(src.join((b'z',)), b'6')
+        self.store.copy((b'src',), (b'dst',))
+        self.assertIs(sibling.node, self.store._resolve(sibling))
+        dst = self.store.handle((b'dst', b'a'))
+        self.store.put(dst.join((b'z',)), b'7')
+        self.store.put(src.join((b'z',)), b'8')
+        self.assertEqual(self.store.get(src.join((b'z',))), b'8')
+        self.assertEqual(self.store.get(dst.join((b'z',))), b'7')
+        self.assertEqual(self.store.get((b'dst', b'a', b'z')), b'7')
+
+    def test_repeated(self):
+        self.store.copy((b'src',), (b'dst',))
+        self.store.put((b'src', b'a', b'new', b'z'), b'1')
+        self.store.copy((b'src',), (b'dst2',))
+        self.store.copy((b'dst2', b'a'), (b'dst3',))
+        self.store.put((b'dst2', b'a', b'new', b'z'), b'2')
+        self.store.put((b'dst3', b'new', b'z'), b'3')
+        self.store.put((b'src', b'a', b'b', b'x'), b'4')
+        self.assertEqual(self.store.get((b'src', b'a', b'new', b'z')), b'1')
+        self.assertEqual(self.store.get((b'dst2', b'a', b'new', b'z')), b'2')
+        self.assertEqual(self.store.get((b'dst3', b'new', b'z')), b'3')
+        self.assertEqual(self.store.get((b'dst', b'a', b'b', b'x')), b'1')
+        self.assertEqual(self.store.get((b'dst2', b'a', b'b', b'x')), b'1')
+        self.assertEqual(self.store.get((b'dst3', b'b', b'x')), b'1')
+        self.assertEqual(self.store.list((b'dst', b'a'), hkv.LCLASS_ANY),
+                         [b'b', b'y'])
+
+    def test_move_shared(self):
+        self.store.copy((b'src',), (b'dst',))
+        self.store.move((b'dst', b'a'), (b'moved',))
+        self.store.put((b'moved', b'b', b'x'), b'5')
+        self.assertEqual(self.store.get((b'src', b'a', b'b', b'x')), b'1')
+        self.assertEqual(self.store.get((b'moved', b'b', b'x')), b'5')
+
+    def test_snapshot(self):
+        self.store.copy((b'src',), (b'dst',))
+        snapshot = self.store.snapshot()
+        self.store.put((b'dst', b'a', b'y'), b'9')
+        self.store.put((b'src', b'a', b'y'), b'10')
+        self.assertEqual(snapshot.get((b'dst', b'a', b'y')), b'2')
+        self.assertEqual(snapshot.get((b'src', b'a', b'y')), b'2')
+
+class QueryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.store = hkv.DataStore()
+        self.store.put_all((b'users', b'u1'), {b'name': b'alice',
+                                               b'age': b'30'})
+        self.store.put_all((b'users', b'u2'), {b'name': b'bob'})
+        self.store.put((b'users', b'u2', b'meta', b'name'), b'nested')
+        self.store.put((b'users', b'count'), b'2')
+        self.store.put((b'name',), b'root')
+
+    def query(self, pattern, **kwds):
+        return sorted(self.store.query(pattern, **kwds))
+
+    def test_literal(self):
+        self.assertEqual(self.query((b'users', b'u1', b'name')),
+                         [((b'users', b'u1', b'name'), b'alice')])
+        self.assertEqual(self.query((b'users', b'u3', b'name')), [])
+        self.assertEqual(self.query((b'users', b'u1')), [])
+
+    def test_one(self):
+        one = hkv.QUERY_ONE
+        self.assertEqual(self.query((b'users', one, b'name')),
+                         [((b'users', b'u1', b'name'), b'alice'),
+                          ((b'users', b'u2', b'name'), b'bob')])
+        # Nested collections are not matched themselves.
+        self.assertEqual(self.query((b'users', one)),
+                         [((b'users', b'count'), b'2')])
+        self.assertEqual(self.query((one, one, one, one)),
+                         [((b'users', b'u2', b'meta', b'name'), b'nested')])
+
+    def test_any(self):
+        deep = hkv.QUERY_ANY
+        self.assertEqual([p for p, v in self.query((deep, b'name'))],
+                         [(b'name',), (b'users', b'u1', b'name'),
+                          (b'users', b'u2', b'meta', b'name'),
+                          (b'users', b'u2', b'name')])
+        self.assertEqual(len(self.query((deep,))), 6)
+        self.assertEqual([p for p, v in self.query((b'users', b'u2', deep))],
+                         [(b'users', b'u2', b'meta', b'name'),
+                          (b'users', b'u2', b'name')])
+        # Several ways of matching the same path yield it only once.
+        self.assertEqual(self.query((deep, deep, b'name', deep)),
+                         self.query((deep, b'name')))
+        self.assertEqual(self.query((deep, b'missing')), [])
+
+    def test_options(self):
+        deep = hkv.QUERY_ANY
+        self.assertEqual(len(self.query((deep,), limit=2)), 2)
+        self.assertEqual(len(self.query((deep,), limit=0)), 6)
+        self.assertEqual(self.query((deep, b'name'), values_only=True),
+                         [b'alice', b'bob', b'nested', b'root'])
+        result, version = self.store.query((deep,), with_version=True)
+        self.assertEqual(version, self.store.version(()))
+
+    def test_handle(self):
+        handle = self.store.handle((b'users', b'u2'))
+        pattern = handle.join((hkv.QUERY_ANY, b'name'))
+        self.assertEqual(self.query(pattern),
+                         [((b'users', b'u2', b'meta', b'name'), b'nested'),
+                          ((b'users', b'u2', b'name'), b'bob')])
+        self.store.put((b'users', b'u2', b'name'), b'carol')
+        self.assertEqual(self.query(pattern, values_only=True),
+                         [b'carol', b'nested'])
+
+class IndexTest(unittest.TestCase):
+
+    pattern = (b'users', hkv.QUERY_ONE, b'name')
+
+    def setUp(self):
+        self.store = hkv.DataStore()
+        self.store.create_index(self.pattern)
+        self.store.create_index((hkv.QUERY_ANY, b'tag'))
+        self.store.put_all((b'users', b'u1'), {b'name': b'alice',
+                                               b'tag': b'x'})
+        self.store.put_all((b'users', b'u2'), {b'name': b'bob'})
+
+    def assertConsistent(self):
+        # Every index must equal one built from scratch.
+        for pattern, index in self.store._indexes.items():
+            fresh = hkv.DataStore.Index(pattern)
+            for path, value in self.store.query(pattern):
+                fresh.add(path, value)
+            self.assertEqual(index.entries, fresh.entries)
+            self.assertEqual((index.npaths, index.nbytes),
+                             (fresh.npaths, fresh.nbytes))
+
+    def lookup(self, value):
+        return sorted(self.store.lookup(self.pattern, value))
+
+    def test_put_delete(self):
+        self.store.put((b'users', b'u3', b'name'), b'alice')
+        self.assertEqual(self.lookup(b'alice'),
+                         [(b'users', b'u1', b'name'),
+                          (b'users', b'u3', b'name')])
+        self.store.put((b'users', b'u1', b'name'), b'carol')
+        self.assertEqual(self.lookup(b'alice'), [(b'users', b'u3', b'name')])
+        self.store.delete((b'users', b'u3'))
+        self.assertEqual(self.lookup(b'alice'), [])
+        self.store.put((b'users', b'u2'), b'scalar')
+        self.assertEqual(self.lookup(b'bob'), [])
+        self.assertConsistent()
+
+    def test_delete_all_replace(self):
+        self.store.delete_all((b'users', b'u1'))
+        self.assertEqual(self.lookup(b'alice'), [])
+        self.store.replace((b'users', b'u2'), {b'name': b'dave',
+                                               b'tag': b'y'})
+        self.assertEqual(self.lookup(b'bob'), [])
+        self.assertEqual(self.lookup(b'dave'), [(b'users', b'u2', b'name')])
+        self.assertConsistent()
+        self.store.delete_all((b'users',))
+        self.assertEqual(self.store._indexes[self.pattern].entries, {})
+        self.assertConsistent()
+
+    def test_move_copy(self):
+        self.store.copy((b'users', b'u1'), (b'users', b'u4'))
+        self.assertEqual(self.lookup(b'alice'),
+                         [(b'users', b'u1', b'name'),
+                          (b'users', b'u4', b'name')])
+        self.store.move((b'users', b'u2'), (b'archive', b'u2'))
+        self.assertEqual(self.lookup(b'bob'), [])
+        self.store.move((b'archive', b'u2'), (b'users', b'u5'))
+        self.assertEqual(self.lookup(b'bob'), [(b'users', b'u5', b'name')])
+        self.store.copy((b'users',), (b'backup',))
+        self.assertEqual(len(self.store.lookup((hkv.QUERY_ANY, b'tag'),
+                                               b'x')), 4)
+        self.assertConsistent()
+
+    def test_other_writes(self):
+        self.store.append((b'users', b'u1', b'name'), b'!')
+        self.store.incr((b'users', b'u6', b'name'), 7)
+        self.store.cas((b'users', b'u2', b'name'), b'bob', b'bobby')
+        self.store.put_if_absent((b'users', b'u7', b'name'), b'eve')
+        self.assertEqual(self.lookup(b'alice!'),
+                         [(b'users', b'u1', b'name')])
+        self.assertEqual(self.lookup(b'bobby'), [(b'users', b'u2', b'name')])
+        self.assertEqual(self.lookup(b'eve'), [(b'users', b'u7', b'name')])
+        self.assertConsistent()
+
+    def test_measure(self):
+        sizes = self.store.measure()
+        # Paths: users/u1/name, users/u2/name, users/u1/tag.
+        self.assertEqual((sizes['indexes'], sizes['index_paths']), (2, 3))
+        self.assertEqual(sizes['index_bytes'],
+                         len(b'alice') + len(b'bob') + len(b'x') +
+                         len(b'usersu1name') + len(b'usersu2name') +
+                         len(b'usersu1tag'))
+        self.store.put((b'users', b'u2', b'name'), b'alice')
+        sizes = self.store.measure()
+        self.assertEqual(sizes['index_paths'], 3)
+        self.assertEqual(sizes['index_bytes'],
+                         len(b'alice') + len(b'x') +
+                         len(b'usersu1name') + len(b'usersu2name') +
+                         len(b'usersu1tag'))
+        self.store.drop_index(self.pattern)
+        sizes = self.store.measure()
+        self.assertEqual((sizes['indexes'], sizes['index_paths'],
+                          sizes['index_bytes']),
+                         (1, 1, len(b'x') + len(b'usersu1tag')))
+
+class StreamTest(unittest.TestCase):
+
+    def setUp(self):
+        self.store = hkv.DataStore()
+        self.data = bytes(bytearray(range(256))) * (hkv.CHUNK_BYTES // 100)
+        self.store.put_stream((b'a', b's'), io.BytesIO(self.data))
+
+    def read(self, path, store=None):
+        reader = (store or self.store).get_stream(path)
+        try:
+            return b''.join(hkv.read_chunks(reader))
+        finally:
+            reader.close()
+
+    def test_roundtrip(self):
+        value = self.store.data[b'a'][b's']
+        self.assertIsInstance(value, hkv.ChunkedValue)
+        self.assertGreater(len(value.chunks), 1)
+        self.assertEqual(self.read((b'a', b's')), self.data)
+        self.assertEqual(self.store.get((b'a', b's')), self.data)
+        self.assertEqual(self.store.get_all((b'a',)), {b's': self.data})
+        self.assertEqual(self.store.query((b'a', hkv.QUERY_ONE)),
+                         [((b'a', b's'), self.data)])
+        self.assertEqual(self.store.stat((b'a',)),
+                         (1, 0, 1 + len(self.data)))
+        self.store.append((b'a', b's'), b'tail')
+        self.assertEqual(self.read((b'a', b's')), self.data + b'tail')
+
+    def test_snapshot_copy(self):
+        snapshot = self.store.snapshot()
+        self.store.copy((b'a',), (b'b',))
+        self.store.put_stream((b'a', b's'), io.BytesIO(b'new'))
+        self.assertEqual(self.read((b'a', b's'), snapshot), self.data)
+        self.assertEqual(self.read((b'b', b's')), self.data)
+        self.assertEqual(self.read((b'a', b's')), b'new')
+
+    def test_dump_restore(self):
+        buf = io.BytesIO()
+        self.store.dump(hkv.Codec(None, buf))
+        restored = hkv.DataStore()
+        restored.restore(hkv.Codec(io.BytesIO(buf.getvalue()), None))
+        self.assertEqual(self.read((b'a', b's'), restored), self.data)
+        self.assertEqual(restored.version((b'a', b's')),
+                         self.store.version((b'a', b's')))
+
+    def test_failed_source(self):
+        version = self.store.version(())
+        self.assertRaises(IOError, self.store.put_stream, (b'a', b't'),
+                          FailingReader(self.data))
+        self.assertRaises(hkv.HKVError, self.store.get, (b'a', b't'))
+        self.assertEqual(self.store.version(()), version)
+
+    def test_nested(self):
+        try:
+            self.store.get_stream((b'a',))
+        except hkv.HKVError as exc:
+            self.assertEqual(exc.name, 'BADTYPE')
+        else:
+            self.fail('BADTYPE error not raised')
+
+if __name__ == '__main__': unittest.main()
@@ -0,0 +1,525 @@
+# -*- coding: ascii -*-
+
+"""
+Tests for RemoteDataStore and DataStoreServer.
+"""
+
+import io
+import os
+import shutil
+import socket
+import tempfile
+import time
+import unittest
+
+from support import hkv, start_server, connect, FailingReader
+
+class RemoteTestCase(unittest.TestCase):
+
+    server_options = {}
+    client_options = {}
+
+    def setUp(self):
+        self.server = start_server(**self.server_options)
+        self.client = connect(self.server, **self.client_options)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.close()
+
+    def assertError(self, name, func, *args):
+        try:
+            func(*args)
+        except hkv.HKVError as exc:
+            self.assertEqual(exc.name, name)
+        else:
+            self.fail('%s error not raised' % name)
+
+    def wait_until(self, predicate, timeout=5):
+        # The servers process connections in background threads.
+        deadline = time.time() + timeout
+        while not predicate():
+            if time.time() > deadline: self.fail('Timed out')
+            time.sleep(0.01)
+
+class CounterTest(RemoteTestCase):
+
+    def test_result_out_of_range(self):
+        self.client.incr((b'c',), hkv.COUNTER_MAX)
+        self.assertError('BADCOUNTER', self.client.incr, (b'c',), 1)
+        self.client.incr((b'd',), hkv.COUNTER_MIN)
+        self.assertError('BADCOUNTER', self.client.incr, (b'd',), -1)
+        self.assertEqual(self.client.get((b'c',)),
+                         str(hkv.COUNTER_MAX).encode('ascii'))
+        self.assertEqual(self.client.incr((b'c',), -1), hkv.COUNTER_MAX - 1)
+
+    def test_delta_out_of_range(self):
+        self.assertError('BADCOUNTER', self.client.incr, (b'c',), 10 ** 30)
+        self.assertError('BADCOUNTER', self.client.incr, (b'c',),
+                         hkv.COUNTER_MIN - 1)
+        self.assertError('NOKEY', self.client.get, (b'c',))
+        self.assertEqual(self.client.incr((b'c',), 2), 2)
+
+    def test_command_line(self):
+        args = hkv.parse_command('incr', ['c', '-3', '8'])
+        self.assertEqual(args, ('c', -3, 8))
+        with self.assertRaises(ValueError) as cm:
+            hkv.parse_command('incr', ['c', '1', '-1'])
+        self.assertEqual(str(cm.exception), 'Invalid width for incr: -1')
+        self.assertRaises(ValueError, hkv.parse_command, 'incr',
+                          ['c', 'x'])
+
+class HookTest(RemoteTestCase):
+
+    def setUp(self):
+        super(HookTest, self).setUp()
+        self.events = []
+
+    def record(self, event):
+        self.events.append(event)
+
+    def fail_hook(self, event):
+        raise RuntimeError('Hook failure')
+
+    def test_remove_unregistered(self):
+        self.client.remove_hook(self.record, self.record)
+        self.client.add_hook(post=self.record)
+        hooks = self.client.post_hooks
+        self.client.remove_hook(self.record, self.record)
+        self.assertEqual(self.client.post_hooks, [])
+        self.assertEqual(hooks, [self.record])
+
+    def test_exceptions_logged(self):
+        self.client.add_hook(self.fail_hook, self.fail_hook)
+        self.client.add_hook(post=self.record)
+        self.client.logger.disabled = True
+        try:
+            self.client.put((b'k',), b'v')
+            self.assertEqual(self.client.get((b'k',)), b'v')
+            self.assertError('BADTYPE', self.client.get, ())
+        finally:
+            self.client.logger.disabled = False
+        self.assertEqual([e.error for e in self.events[:2]], [None, None])
+        self.assertEqual(self.events[2].error.name, 'BADTYPE')
+
+class PipelineTest(RemoteTestCase):
+
+    def test_encoding_error(self):
+        client, k, c = self.client, (b'x',), (b'c',)
+        results = client.pipeline_calls([
+            lambda: client.put(k, b'1'),
+            lambda: client.incr(c, 1, -1),
+            lambda: client.put(k, b'2'),
+            lambda: client.get(k),
+            lambda: client.get(c)])
+        self.assertEqual(results[0], None)
+        self.assertIsInstance(results[1], ValueError)
+        self.assertEqual(results[2:4], [None, b'2'])
+        self.assertEqual(results[4].name, 'NOKEY')
+        self.assertEqual(client.get(k), b'2')
+
+class QueryTest(RemoteTestCase):
+
+    def setUp(self):
+        super(QueryTest, self).setUp()
+        # More matches than fit into a few chunks of a pair stream.
+        self.count = hkv.CHUNK_ITEMS * 2 + 88
+        self.values = dict((('%04d' % i).encode(), str(i).encode())
+                           for i in range(self.count))
+        self.client.put_all((b'a', b'b'), self.values)
+        self.client.put((b'a', b'x'), b'other')
+
+    def test_chunked(self):
+        result = self.client.query((b'a', hkv.QUERY_ONE, hkv.QUERY_ONE))
+        self.assertEqual(dict((p[2], v) for p, v in result), self.values)
+        self.assertEqual(set(p[:2] for p, v in result), set([(b'a', b'b')]))
+        result = self.client.query((hkv.QUERY_ANY,), values_only=True)
+        self.assertEqual(sorted(result),
+                         sorted(list(self.values.values()) + [b'other']))
+
+    def test_limit(self):
+        pattern = (b'a', b'b', hkv.QUERY_ONE)
+        limit = hkv.CHUNK_ITEMS + 1
+        result = self.client.query(pattern, limit=limit)
+        self.assertEqual(len(result), limit)
+        for path, value in result:
+            self.assertEqual(self.values[path[2]], value)
+        self.assertEqual(len(self.client.query(pattern, limit=-1)),
+                         self.count)
+
+    def test_version_and_handle(self):
+        result, version = self.client.query((b'a', b'x'), with_version=True)
+        self.assertEqual(result, [((b'a', b'x'), b'other')])
+        self.assertEqual(version, self.client.version(()))
+        handle = self.client.handle((b'a',))
+        result = self.client.query(handle.join((hkv.QUERY_ANY,)))
+        self.assertEqual(len(result), self.count + 1)
+        self.assertIn(((b'a', b'x'), b'other'), result)
+
+class IndexTest(RemoteTestCase):
+
+    def test_stats(self):
+        self.client.put_all((b'u',), {b'a': b'xy', b'b': b'xy'})
+        self.client.create_index((b'u', hkv.QUERY_ONE))
+        self.assertEqual(sorted(self.client.lookup((b'u', hkv.QUERY_ONE),
+                                                   b'xy')),
+                         [(b'u', b'a'), (b'u', b'b')])
+        stats = self.client.stats()
+        self.assertEqual(stats['datastore.test.indexes'], '1')
+        self.assertEqual(stats['datastore.test.index_paths'], '2')
+        self.assertEqual(stats['datastore.test.index_bytes'], '6')
+        self.client.delete((b'u', b'a'))
+        stats = self.client.stats()
+        self.assertEqual(stats['datastore.test.index_paths'], '1')
+        self.assertEqual(stats['datastore.test.index_bytes'], '4')
+
+class StreamTest(RemoteTestCase):
+
+    def setUp(self):
+        super(StreamTest, self).setUp()
+        self.data = bytes(bytearray(range(256))) * (hkv.CHUNK_BYTES // 100)
+
+    def test_roundtrip(self):
+        self.client.put_stream((b's',), io.BytesIO(self.data))
+        reader, version = self.client.get_stream((b's',), True)
+        try:
+            data = b''.join(hkv.read_chunks(reader))
+        finally:
+            reader.close()
+        self.assertEqual(data, self.data)
+        self.assertEqual(version, self.client.version((b's',)))
+        self.assertEqual(self.client.get((b's',)), self.data)
+        stored = self.server.datastores[b'test'].data[b's']
+        self.assertGreater(len(stored.chunks), 1)
+
+    def test_early_close(self):
+        self.client.put_stream((b's',), io.BytesIO(self.data))
+        reader = self.client.get_stream((b's',))
+        self.assertTrue(reader.read(10))
+        reader.close()
+        self.client.put((b'k',), b'v')
+        self.assertEqual(self.client.get((b'k',)), b'v')
+
+    def test_errors(self):
+        self.client.put((b'a', b'b'), b'v')
+        self.assertError('NOKEY', self.client.get_stream, (b'x',))
+        self.assertError('BADTYPE', self.client.get_stream, (b'a',))
+        self.assertEqual(self.client.get((b'a', b'b')), b'v')
+
+    def test_failed_source(self):
+        self.assertRaises(IOError, self.client.put_stream, (b's',),
+                          FailingReader(self.data))
+        # The client gives up on the connection, and the server discards
+        # the partial value.
+        self.client = connect(self.server)
+        self.assertError('NOKEY', self.client.get, (b's',))
+        self.client.put_stream((b's',), io.BytesIO(b'short'))
+        self.assertEqual(self.client.get((b's',)), b'short')
+
+class SpillTest(RemoteTestCase):
+
+    def setUp(self):
+        self.spill_dir = tempfile.mkdtemp()
+        self.server_options = {'spill_dir': self.spill_dir,
+                               'spill_after': 0}
+        super(SpillTest, self).setUp()
+        self.values = dict((('key%06d' % i).encode(),
+                            ('value-%d' % i).encode())
+                           for i in range(60000))
+        self.client.put_all((b'a',), self.values)
+        self.client.create_index((b'a', b'*'))
+        self.client.close()
+
+    def tearDown(self):
+        super(SpillTest, self).tearDown()
+        shutil.rmtree(self.spill_dir)
+
+    def spill(self):
+        self.wait_until(lambda: not self.server._attached.get(b'test'))
+        return self.server.spill_idle()
+
+    def test_roundtrip(self):
+        self.assertEqual(self.spill(), 1)
+        self.assertNotIn(b'test', self.server.datastores)
+        self.client = connect(self.server)
+        self.assertEqual(self.client.get_all((b'a',)), self.values)
+        self.assertEqual(self.client.lookup((b'a', b'*'), b'value-7'),
+                         [(b'a', b'key000007')])
+        self.assertEqual(os.listdir(self.spill_dir), [])
+
+    def test_index_change(self):
+        read_spilled = self.server._read_spilled
+        def create_index(*args, **kwds):
+            # Runs after the dump, before the datastore is swapped out.
+            self.server.datastores[b'test'].create_index((b'b', b'*'))
+            return read_spilled(*args, **kwds)
+        self.server._read_spilled = create_index
+        self.assertEqual(self.spill(), 0)
+        self.assertIn(b'test', self.server.datastores)
+        self.assertEqual(os.listdir(self.spill_dir), [])
+        del self.server._read_spilled
+        self.assertEqual(self.server.spill_idle(), 1)
+        self.client = connect(self.server)
+        self.assertEqual(self.client.lookup((b'b', b'*'), b'x'), [])
+
+    def test_failed_check(self):
+        def fail(*args, **kwds):
+            raise ValueError('Corrupt spill file')
+        self.server._read_spilled = fail
+        self.server.logger.disabled = True
+        try:
+            self.assertEqual(self.spill(), 0)
+        finally:
+            self.server.logger.disabled = False
+        self.assertIn(b'test', self.server.datastores)
+        self.assertEqual(os.listdir(self.spill_dir), [])
+        self.client = connect(self.server)
+        self.assertEqual(self.client.get_all((b'a',)), self.values)
+
+class ReplicationTest(RemoteTestCase):
+
+    server_options = {'backlog': 100}
+
+    def setUp(self):
+        super(ReplicationTest, self).setUp()
+        self.server.replog.heartbeat = 0.05
+        self.replicas = []
+        self.replica = self.start_replica()
+
+    def tearDown(self):
+        super(ReplicationTest, self).tearDown()
+        for replica in self.replicas:
+            replica.close()
+
+    def start_replica(self):
+        replica = start_server(primary=self.server.addr)
+        self.replicas.append(replica)
+        self.run_replica(replica)
+        return replica
+
+    def run_replica(self, replica):
+        # Instead of Replica.main(), which reconnects on its own, run a
+        # single connection, so that tests control reconnecting.
+        def sync():
+            try:
+                replica.replica.sync()
+            except (IOError, EOFError, ValueError, hkv.HKVError):
+                pass
+        self.wait_until(lambda: not replica.replica.connected)
+        return hkv.spawn_thread(sync)
+
+    def disconnect_replicas(self):
+        for handler in list(self.server.handlers):
+            if handler.dsname is None:
+                handler.conn.shutdown(socket.SHUT_RDWR)
+        for replica in self.replicas:
+            self.wait_until(lambda: not replica.replica.connected)
+        self.wait_until(lambda: not self.server.replog.replicas)
+
+    def wait_synced(self, replica=None):
+        if replica is None: replica = self.replica
+        self.wait_until(lambda: replica.replica.offset >=
+                        self.server.replog.offset)
+
+    def drop(self, name):
+        self.wait_until(lambda: not self.server._attached.get(name))
+        self.server.drop_datastore(name)
+
+    def test_drop(self):
+        other = connect(self.server, b'other')
+        other.put((b'k',), b'v')
+        other.close()
+        self.wait_synced()
+        self.assertIn(b'other', self.replica.datastores)
+        self.drop(b'other')
+        self.wait_synced()
+        self.assertNotIn(b'other', self.replica.datastores)
+        fresh = self.start_replica()
+        self.wait_synced(fresh)
+        self.assertEqual(sorted(fresh.datastores),
+                         sorted(self.server.datastores))
+
+    def test_full_sync(self):
+        self.client.put_all((b'a',), {b'x': b'1', b'y': b'2'})
+        self.client.put((b'b', b'c'), b'3')
+        self.client.create_index((b'a', b'*'))
+        fresh = self.start_replica()
+        self.wait_synced(fresh)
+        self.assertEqual(fresh.replica.full_syncs, 1)
+        reader = connect(fresh)
+        try:
+            self.assertEqual(reader.get_all((b'a',)),
+                             {b'x': b'1', b'y': b'2'})
+            self.assertEqual(reader.get((b'b', b'c')), b'3')
+            self.assertEqual(reader.lookup((b'a', b'*'), b'2'),
+                             [(b'a', b'y')])
+        finally:
+            reader.close()
+
+    def test_stream(self):
+        self.wait_synced()
+        self.client.put((b'k',), b'v')
+        self.client.put_all((b'a',), {b'x': b'1', b'y': b'2'})
+        self.client.incr((b'n',), 5)
+        self.client.delete((b'a', b'x'))
+        self.wait_synced()
+        reader = connect(self.replica)
+        try:
+            self.assertEqual(reader.get((b'k',)), b'v')
+            self.assertEqual(reader.get_all((b'a',)), {b'y': b'2'})
+            self.assertEqual(reader.get((b'n',)), hkv.encode_counter(5))
+        finally:
+            reader.close()
+        self.assertEqual(self.replica.replica.applied, 4)
+
+    def test_readonly(self):
+        self.client.put((b'k',), b'v')
+        self.wait_synced()
+        reader = connect(self.replica)
+        try:
+            self.assertEqual(reader.get((b'k',)), b'v')
+            self.assertError('READONLY', reader.put, (b'k',), b'w')
+            self.assertError('READONLY', reader.delete, (b'k',))
+            self.assertEqual(reader.get((b'k',)), b'v')
+        finally:
+            reader.close()
+        self.assertError('READONLY', self.replica.drop_datastore, b'test')
+
+    def test_partial_resume(self):
+        self.client.put((b'k',), b'1')
+        self.wait_synced()
+        self.disconnect_replicas()
+        self.client.put((b'k',), b'2')
+        self.client.put((b'l',), b'3')
+        self.run_replica(self.replica)
+        self.wait_synced()
+        replica = self.replica.replica
+        self.assertEqual((replica.full_syncs, replica.partial_syncs), (1, 1))
+        datastore = self.replica.datastores[b'test']
+        self.assertEqual(datastore.get((b'k',)), b'2')
+        self.assertEqual(datastore.get((b'l',)), b'3')
+
+    def test_backlog_overflow(self):
+        self.wait_synced()
+        self.disconnect_replicas()
+        for i in range(150):
+            self.client.put((b'k',), str(i).encode('ascii'))
+        self.run_replica(self.replica)
+        self.wait_synced()
+        replica = self.replica.replica
+        self.assertEqual((replica.full_syncs, replica.partial_syncs), (2, 0))
+        self.assertEqual(self.replica.datastores[b'test'].get((b'k',)),
+                         b'149')
+
+    def test_metrics(self):
+        self.client.put((b'k',), b'v')
+        self.wait_synced()
+        self.wait_until(lambda: self.replica.replica.primary_offset ==
+                        self.server.replog.offset)
+        info = self.replica.replication_info()
+        self.assertEqual(info['role'], 'replica')
+        self.assertEqual(info['replica_connected'], '1')
+        self.assertEqual(info['replica_offset'],
+                         str(self.server.replog.offset))
+        self.assertEqual(info['replica_lag_ops'], '0')
+        self.assertLess(float(info['replica_lag_seconds']), 5)
+        self.assertLess(float(info['replica_last_contact_age']), 5)
+        info = self.server.replication_info()
+        self.assertEqual(info['role'], 'primary')
+        self.assertEqual(info['replicas'], '1')
+        self.assertEqual(info['backlog'], '100')
+        self.disconnect_replicas()
+        info = self.replica.replication_info()
+        self.assertEqual(info['replica_connected'], '0')
+
+class CaptureTest(RemoteTestCase):
+
+    client_options = {'compression': 'zlib', 'compress_threshold': 16}
+
+    def setUp(self):
+        super(CaptureTest, self).setUp()
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        super(CaptureTest, self).tearDown()
+        os.remove(self.path)
+
+    def capture(self):
+        # self.client is connected before the capture starts, so that its
+        # negotiation is recorded as synthesized frames; other is
+        # connected afterwards, so that the actual frames are recorded.
+        self.server.start_capture(open(self.path, 'wb'))
+        other = connect(self.server, b'other', **self.client_options)
+        try:
+            self.client.put((b'k',), b'v')
+            self.client.put_all((b'a',), dict((str(i).encode(), b'x' * 64)
+                                              for i in range(100)))
+            other.incr((b'n',), 3)
+            self.client.delete((b'a', b'7'))
+            other.put((b'p', b'q'), b'r')
+        finally:
+            other.close()
+        # Frames are recorded after their responses are sent; a further
+        # round trip ensures the last one has been.
+        self.client.get((b'k',))
+        self.wait_until(lambda: not self.server._attached.get(b'other'))
+        self.server.stop_capture()
+
+    def read(self):
+        with open(self.path, 'rb') as f:
+            return list(hkv.Capture.read(f))
+
+    def test_read(self):
+        self.capture()
+        connections = {}
+        for ts, connid, frame in self.read():
+            connections.setdefault(connid, []).append(frame)
+        self.assertEqual(len(connections), 2)
+        for frames in connections.values():
+            self.assertEqual([f[:1] for f in frames[:2]], [b'N', b'z'])
+            if b'o\x05other' in frames:
+                self.assertEqual(frames[-1], None)
+            else:
+                self.assertEqual(frames[2], b'o\x04test')
+                self.assertNotIn(None, frames)
+
+    def test_truncated(self):
+        self.capture()
+        records = self.read()
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        with open(self.path, 'wb') as f:
+            f.write(data[:-3])
+        self.assertEqual(self.read(), records[:-1])
+        with open(self.path, 'wb') as f:
+            f.write(b'garbage')
+        self.assertRaises(ValueError, self.read)
+
+    def test_replay(self):
+        self.capture()
+        connections, origin = {}, None
+        for ts, connid, frame in self.read():
+            if origin is None: origin = ts
+            if frame is not None:
+                connections.setdefault(connid, []).append((ts, frame))
+        target = start_server()
+        try:
+            for frames in connections.values():
+                hists, errors, lag = hkv.replay_worker(
+                    {'addr': target.addr}, frames, 0, origin, hkv.timer())
+                self.assertEqual(errors, 0)
+            self.assertIn('put', hists)
+            for name in (b'test', b'other'):
+                source = self.server.datastores[name]
+                replayed = target.datastores[name]
+                self.assertEqual(replayed.measure(), source.measure())
+            self.assertEqual(target.datastores[b'test'].get_all((b'a',)),
+                             self.server.datastores[b'test'].get_all(
+                                 (b'a',)))
+            self.assertEqual(target.datastores[b'other'].get((b'p', b'q')),
+                             b'r')
+        finally:
+            target.close()
+
+if __name__ == '__main__': unittest.main()
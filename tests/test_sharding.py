@@ -0,0 +1,60 @@
+# -*- coding: ascii -*-
+
+"""
+Tests for ShardedDataStore.
+"""
+
+import unittest
+
+from support import hkv, start_server, connect
+
+class EmptyNodeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.servers = [start_server(), start_server()]
+        self.shards = {b'a': connect(self.servers[0]),
+                       b'b': connect(self.servers[1])}
+
+    def tearDown(self):
+        for shard in self.shards.values(): shard.close()
+        for server in self.servers: server.close()
+
+    def keys_on(self, store, name, count):
+        keys = (b'k%d' % i for i in range(1000))
+        ret = [k for k in keys if store.shard_for((k,)) == name]
+        return ret[:count]
+
+    def populate(self, store, key):
+        store.put((key, b'value'), b'1')
+        store.put_all((key, b'empty'), {})
+        store.put_all((key, b'nested', b'empty'), {})
+
+    def assertPopulated(self, store, key):
+        self.assertEqual(sorted(store.list((key,), hkv.LCLASS_ANY)),
+                         [b'empty', b'nested', b'value'])
+        self.assertEqual(store.list((key, b'empty'), hkv.LCLASS_ANY), [])
+        self.assertEqual(store.list((key, b'nested'), hkv.LCLASS_ANY),
+                         [b'empty'])
+
+    def test_move(self):
+        store = hkv.ShardedDataStore(self.shards)
+        src, back = self.keys_on(store, b'a', 2)
+        dst = self.keys_on(store, b'b', 1)[0]
+        self.populate(store, src)
+        store.move((src,), (dst,))
+        self.assertPopulated(store, dst)
+        self.assertEqual(self.shards[b'a'].list((), hkv.LCLASS_ANY), [])
+        store.move((dst, b'empty'), (back,))
+        self.assertEqual(store.list((back,), hkv.LCLASS_ANY), [])
+        self.assertEqual(store.list((dst,), hkv.LCLASS_NESTED), [b'nested'])
+
+    def test_rebalance(self):
+        single = hkv.ShardedDataStore({b'a': self.shards[b'a']})
+        store = hkv.ShardedDataStore(self.shards)
+        keys = self.keys_on(store, b'b', 3)
+        for key in keys: self.populate(single, key)
+        self.assertEqual(store.rebalance(), len(keys))
+        self.assertEqual(self.shards[b'a'].list((), hkv.LCLASS_ANY), [])
+        for key in keys: self.assertPopulated(store, key)
+
+if __name__ == '__main__': unittest.main()
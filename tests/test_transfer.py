@@ -0,0 +1,122 @@
+# -*- coding: ascii -*-
+
+"""
+Tests for Exporter and Importer.
+"""
+
+import io
+import unittest
+
+from support import hkv, start_server, connect
+
+def tree(store, path=()):
+    """
+    Return the subtree of store at path as nested dictionaries.
+    """
+    ret = store.get_all(path)
+    for key in store.list(path, hkv.LCLASS_NESTED):
+        ret[key] = tree(store, path + (key,))
+    return ret
+
+class TransferTest(unittest.TestCase):
+
+    format = 'jsonl'
+
+    def setUp(self):
+        self.source = hkv.DataStore()
+        self.source.put_all((b'a',), {b'x': b'1', b'y': b'\xff\xfe'})
+        self.source.put_all((b'a', b'\x80key'), {b'v': b'text'})
+        self.source.put_all((b'a', b'empty'), {})
+        self.source.put_all((b'a', b'wide'), dict(
+            (('%04d' % i).encode(), ('v%d' % i).encode())
+            for i in range(hkv.CHUNK_ITEMS + 10)))
+        self.source.put((b'b', b'c', b'd'), b'')
+        self.source.put_all((b'top',), {})
+
+    def export(self, store=None, path=()):
+        buf = io.BytesIO()
+        exporter = hkv.Exporter(store or self.source, path, batch=3)
+        exporter.run(buf, self.format)
+        return exporter, buf.getvalue()
+
+    def load(self, data, store=None, path=()):
+        store = store or hkv.DataStore()
+        importer = hkv.Importer(store, path, batch=100, pipeline=2)
+        importer.run(io.BytesIO(data))
+        return store, importer
+
+    def test_roundtrip(self):
+        exporter, data = self.export()
+        target, importer = self.load(data)
+        self.assertEqual(tree(target), tree(self.source))
+        self.assertEqual(target.stat(()), self.source.stat(()))
+        self.assertEqual(exporter.values, self.source.stat(())[0])
+        self.assertEqual((importer.values, importer.bytes),
+                         (exporter.values, exporter.bytes))
+
+    def test_subtree(self):
+        exporter, data = self.export(path=(b'a',))
+        target = hkv.DataStore()
+        target.put((b'x', b'y', b'x'), b'old')
+        target.put((b'x', b'y', b'keep'), b'kept')
+        self.load(data, target, (b'x', b'y'))
+        expected = tree(self.source, (b'a',))
+        expected[b'keep'] = b'kept'
+        self.assertEqual(tree(target, (b'x', b'y')), expected)
+        self.assertEqual(target.list((), hkv.LCLASS_ANY), [b'x'])
+
+    def test_truncated(self):
+        exporter, data = self.export()
+        # Cut inside lines, as a JSON Lines file truncated between lines
+        # is indistinguishable from a shorter export.
+        for size in (len(data) - 3, data.index(b'\n', len(data) // 2) - 2):
+            self.assertRaises(ValueError, self.load, data[:size])
+
+    def test_remote(self):
+        server = start_server()
+        try:
+            client = connect(server)
+            try:
+                client.put_all((), {b'k': b'v'})
+                client.put((b'n', b'\xc0'), b'\x00\x01')
+                client.put_all((b'e',), {})
+                exporter, data = self.export(client)
+                other = connect(server, b'other')
+                try:
+                    self.load(data, other, (b'p',))
+                    self.assertEqual(tree(other, (b'p',)), tree(client))
+                finally:
+                    other.close()
+            finally:
+                client.close()
+        finally:
+            server.close()
+
+class BinaryTransferTest(TransferTest):
+
+    format = 'binary'
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, self.load,
+                          hkv.EXPORT_MAGIC + b'X')
+
+class JSONLinesTransferTest(TransferTest):
+
+    def test_format(self):
+        exporter, data = self.export(path=(b'a', b'\x80key'))
+        self.assertEqual(data, b'{"path": ["v"], "value": "text"}\n')
+        exporter, data = self.export(path=(b'a',))
+        lines = data.decode('ascii').splitlines()
+        self.assertIn('{"path": [{"base64": "gGtleQ=="}, "v"], '
+                      '"value": "text"}', lines)
+        self.assertIn('{"path": ["y"], "value": {"base64": "//4="}}', lines)
+        self.assertIn('{"path": ["empty"]}', lines)
+
+    def test_invalid(self):
+        for data in (b'garbage\n', b'{"value": "x"}\n',
+                     b'{"path": [], "value": "x"}\n'):
+            self.assertRaises(ValueError, self.load, data)
+
+del TransferTest
+
+if __name__ == '__main__': unittest.main()